@@ -1,21 +1,48 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from enum import Enum
 from sqlalchemy import create_engine, MetaData, Table, inspect, text
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 from pydantic import BaseModel
-from typing import Optional
-import subprocess
+from typing import Optional, List, Any
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import json
+import time
 import math
 
 from data.database import get_db
-from data.model import Connections
-from functions.metadata_manage_func import metadata_dict, get_primary_keys, table_list, get_primary_and_unique_columns
-from functions.dbt_yml_file_func import add_new_profiles_yml, update_target_profiles_yaml
-from functions.dbt_sql_file_func import create_sql_query, delete_sql_file
+from data.model import Connections, ConnectionSettings
+from functions.metadata_manage_func import metadata_dict, get_primary_keys, table_list, get_primary_and_unique_columns, reflect_metadata, select_reflected, reflect_metadata_sharded
+from functions.dbt_yml_file_func import add_new_profiles_yml, add_connections_profiles_yml
+from functions.dbt_runner_func import model_selector
+from functions.join_job_func import join_jobs
+from functions.engine_pool_func import engine_registry, export_engine_registry, async_engine_registry, source_db_url, check_source_connection
+from functions.admission_func import source_bulkhead, apply_connection_settings
+from functions.query_control_func import query_control, source_query_scope
+from functions.cache_func import reflection_cache, row_count_cache, page_cache
+from functions.catalog_func import load_catalog, refresh_source_catalog
+from functions.search_index_func import search_index
+from functions.export_func import build_export_query, stream_batches, ndjson_chunks, csv_chunks, arrow_ipc_chunks, write_parquet, import_pyarrow
+from functions.profile_func import profile_table
+from functions.response_func import NegotiatedRoute
+from functions.table_data_func import source_table, decode_cursor, get_seek_columns, get_ordered_seek_columns, build_filter_clauses, build_page_query, next_page_cursor, count_rows, estimate_row_count, get_sample_key, sample_rows, column_major
 
 import yaml
+import os
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute)
+
+# Directory where Parquet exports are written
+EXPORT_DIR = os.getenv('EXPORT_DIR', './exports')
+
+# Maximum number of concurrent reflection shards of one source
+REFLECTION_MAX_WORKERS = int(os.getenv('SOURCE_REFLECTION_MAX_WORKERS', 4))
 
 # A table need to be created in database for storing supported database along with description and credential requirements
 class SupportedDatabases(str, Enum):
@@ -30,6 +57,15 @@ class DatabaseCredentials(BaseModel):
     password: str
     database: str
 
+class NewConnection(DatabaseCredentials):
+    connection_name: str
+
+class BulkConnections(BaseModel):
+    connections: List[NewConnection]
+    add: bool = Query(True, description="Add the valid connections, only validate them if false")
+    connect_timeout: float = Query(10, description="Seconds to wait for each connection", gt=0, le=120)
+    max_concurrency: int = Query(16, description="Number of connections validated at the same time", ge=1, le=64)
+
 class SupportedJoins(str, Enum):
     cross = "CROSS"
     inner = "INNER"
@@ -42,6 +78,12 @@ class ViewOrTable(str, Enum):
     table = "table"
     view = "view"
 
+class JoinGraph(str, Enum):
+    none = "none"
+    upstream = "upstream"
+    downstream = "downstream"
+    both = "both"
+
 class JoinDetails(BaseModel):
     connection_id: int
     make : ViewOrTable
@@ -52,10 +94,194 @@ class JoinDetails(BaseModel):
     table2: Optional[str] = None
     table2_col: Optional[dict] = None
     match_pair: Optional[dict] = None
+    graph: JoinGraph = Query(JoinGraph.none, description="Also run the models upstream and/or downstream of the new model, only the new model if none")
+
+class CountMode(str, Enum):
+    exact = "exact"
+    estimate = "estimate"
+    none = "none"
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+    arrow = "arrow"
+    parquet = "parquet"
+
+class FilterOperator(str, Enum):
+    eq = "eq"
+    ne = "ne"
+    lt = "lt"
+    le = "le"
+    gt = "gt"
+    ge = "ge"
+    between = "between"
+    in_ = "in"
+    is_null = "is_null"
+    not_null = "not_null"
+
+class ColumnFilter(BaseModel):
+    column: str
+    op: FilterOperator
+    value: Optional[Any] = None
+
+class SortDirection(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+class OrderBy(BaseModel):
+    column: str
+    direction: SortDirection = SortDirection.asc
+
+class SampleMethod(str, Enum):
+    auto = "auto"
+    system = "system"
+    bernoulli = "bernoulli"
+    key_range = "key_range"
+    random = "random"
+
+class DataLayout(str, Enum):
+    rows = "rows"
+    columns = "columns"
+
+class SourceLimits(BaseModel):
+    max_in_flight: Optional[int] = Query(None, description="Maximum number of concurrent queries on the source, default if not given", ge=1)
+    max_queue: Optional[int] = Query(None, description="Maximum number of requests waiting for a free slot, default if not given", ge=0)
+    queue_timeout_seconds: Optional[float] = Query(None, description="Seconds a request waits for a free slot, default if not given", gt=0)
+    statement_timeout_ms: Optional[int] = Query(None, description="Statement timeout of queries on the source in milliseconds, 0 for none, default if not given", ge=0)
 
 class PaginationParams(BaseModel):
     page: int = Query(1, description="Page number", ge=1)
     per_page: int = Query(10, description="Items per page", ge=1)
+    use_cursor: bool = Query(False, description="Page with next_cursor, seeking on the primary or unique key instead of OFFSET")
+    cursor: Optional[str] = Query(None, description="next_cursor returned by the previous page")
+    count: CountMode = Query(CountMode.exact, description="exact: cached COUNT(*), estimate: row count from the database catalog, none: no count")
+    columns: Optional[List[str]] = Query(None, description="Columns to return, all columns if not given")
+    filters: Optional[List[ColumnFilter]] = Query(None, description="Filters combined with AND, eg: {\"column\": \"id\", \"op\": \"between\", \"value\": [1, 100]}")
+    order_by: Optional[List[OrderBy]] = Query(None, description="Columns to order by, eg: {\"column\": \"created\", \"direction\": \"desc\"}")
+    cache: bool = Query(True, description="Serve the page from the result cache when available")
+    layout: DataLayout = Query(DataLayout.rows, description="rows: table_values holds a list per row, columns: column_values holds a list per column")
+
+
+
+
+# Function to get a saved source connection or raise 404
+def get_source_connection(db: Session, connection_id: int):
+    connection = db.query(Connections).filter(Connections.connection_id == connection_id).first()
+    if not connection:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    return connection
+
+
+# Function to get reflected tables and metadata of a source connection, served from cache within the TTL.
+# Only the given tables, or tables starting with one of the prefixes, are reflected when any is given.
+# With parallel > 1 the tables are reflected in shards on concurrent pooled connections.
+# Schemas stored in the catalog are served from it, and refresh only re-reflects changed tables.
+def get_reflected_metadata(connection, db: Session, schema: Optional[str] = None, refresh: bool = False,
+                           tables: Optional[List[str]] = None, prefixes: Optional[List[str]] = None,
+                           parallel: int = 1, shard_size: int = 200):
+    def load():
+        stored = load_catalog(db, connection.connection_id, schema)
+        if stored is not None:
+            if refresh:
+                refresh_source_catalog(db, connection, schema=schema)
+                stored = load_catalog(db, connection.connection_id, schema)
+            return select_reflected(stored, tables=tables, prefixes=prefixes) if tables or prefixes else stored
+        if parallel > 1:
+            # Shards never use more connections than the pool of the source holds or its bulkhead admits
+            max_workers = min(parallel, REFLECTION_MAX_WORKERS, engine_registry.pool_size,
+                              source_bulkhead.get_limits(connection.connection_id)["max_in_flight"])
+            reflected = reflect_metadata_sharded(lambda: engine_registry.connect(connection), schema=schema, tables=tables,
+                                                 prefixes=prefixes, max_workers=max_workers, shard_size=shard_size)
+        else:
+            with engine_registry.connect(connection) as source_connection:
+                reflected = reflect_metadata(source_connection, schema=schema, tables=tables, prefixes=prefixes)
+        # Keep the column search index in step with the reflected tables
+        search_index.update_tables(connection.connection_id, reflected["metadata"], schema=schema,
+                                   replace_schema=not tables and not prefixes)
+        return reflected
+
+    full_key = (connection.connection_id, schema)
+    if not tables and not prefixes:
+        return reflection_cache.get_or_load(full_key, load, refresh=refresh)
+
+    # A selection is served from the whole schema when that is already cached
+    if not refresh:
+        reflected = reflection_cache.get(full_key)
+        if reflected is not None:
+            return select_reflected(reflected, tables=tables, prefixes=prefixes)
+    key = (connection.connection_id, schema, tuple(sorted(tables or [])), tuple(sorted(prefixes or [])))
+    return reflection_cache.get_or_load(key, load, refresh=refresh)
+
+
+# Function to get reflected tables and metadata like get_reflected_metadata, reflecting the source on the async engine.
+# Cached and stored metadata is served without a worker thread. Refreshing the catalog, sharded reflection
+# and sources without an installed async driver go through get_reflected_metadata in the threadpool.
+async def get_reflected_metadata_async(connection, db: Session, schema: Optional[str] = None, refresh: bool = False,
+                                       tables: Optional[List[str]] = None, prefixes: Optional[List[str]] = None,
+                                       parallel: int = 1, shard_size: int = 200):
+    def reflect_sync():
+        return get_reflected_metadata(connection, db, schema=schema, refresh=refresh, tables=tables, prefixes=prefixes,
+                                      parallel=parallel, shard_size=shard_size)
+
+    if parallel > 1 or not async_engine_registry.available(connection.source):
+        return await run_in_threadpool(reflect_sync)
+
+    full_key = (connection.connection_id, schema)
+    key = full_key
+    if tables or prefixes:
+        key = (connection.connection_id, schema, tuple(sorted(tables or [])), tuple(sorted(prefixes or [])))
+    if not refresh:
+        reflected = reflection_cache.get(key)
+        if reflected is not None:
+            return reflected
+        reflected = reflection_cache.get(full_key) if key != full_key else None
+        if reflected is not None:
+            return select_reflected(reflected, tables=tables, prefixes=prefixes)
+
+    # Refreshing a schema kept in the catalog also refreshes the catalog, which the sync path does
+    if refresh and await run_in_threadpool(load_catalog, db, connection.connection_id, schema) is not None:
+        return await run_in_threadpool(reflect_sync)
+
+    async def load():
+        stored = None if refresh else await run_in_threadpool(load_catalog, db, connection.connection_id, schema)
+        if stored is not None:
+            return select_reflected(stored, tables=tables, prefixes=prefixes) if tables or prefixes else stored
+        async with async_engine_registry.connect(connection) as source_connection:
+            reflected = await source_connection.run_sync(reflect_metadata, schema=schema, tables=tables, prefixes=prefixes)
+        search_index.update_tables(connection.connection_id, reflected["metadata"], schema=schema,
+                                   replace_schema=not tables and not prefixes)
+        return reflected
+
+    # Concurrent requests for the same schema wait for one load
+    return await reflection_cache.get_or_load_async(key, load, refresh=refresh)
+
+
+# Function to get columns of a source table from the inspector, served from cache within the TTL
+def get_table_columns(connection, source_connection, table: str, refresh: bool = False):
+    return reflection_cache.get_or_load((connection.connection_id, "columns", table),
+                                        lambda: inspect(source_connection).get_columns(table), refresh=refresh)
+
+
+# Function to get key columns of a source table usable for keyset pagination, served from cache within the TTL
+def get_table_seek_columns(connection, source_connection, table: str, columns):
+    return reflection_cache.get_or_load((connection.connection_id, "seek_columns", table),
+                                        lambda: get_seek_columns(inspect(source_connection), table, columns))
+
+
+# Function to get table names of a source connection without reflecting the tables
+def get_table_names(connection, db: Session, schema: Optional[str] = None, refresh: bool = False):
+    if not refresh:
+        reflected = reflection_cache.get((connection.connection_id, schema))
+        if reflected is not None:
+            return reflected["tables"]
+        stored = load_catalog(db, connection.connection_id, schema)
+        if stored is not None:
+            return stored["tables"]
+
+    def load():
+        with engine_registry.connect(connection) as source_connection:
+            return inspect(source_connection).get_table_names(schema=schema)
+    return reflection_cache.get_or_load((connection.connection_id, schema, "table_names"), load, refresh=refresh)
 
 
 
@@ -86,29 +312,31 @@ def list_supported_sources():
 
 # API to Perform a Connection to Pull Metadata
 @router.post("/connections/connect", tags=["connection"])
-def perform_connection_to_source(source_info: DatabaseCredentials):
+def perform_connection_to_source(source_info: DatabaseCredentials,
+                                 schema: Optional[str] = Query(None, description="Schema to reflect, default schema if not given"),
+                                 refresh: bool = Query(False, description="Reflect again even if cached metadata is available")):
     """
     Perform a connection to a data source and pull metadata.
     """
     # Use source_info to connect to the source and pull metadata.
-    source_db_url = ""
     db = source_info.source
-    connection_string = source_info.user+':'+source_info.password+'@'+source_info.host+':'+source_info.port+'/'+source_info.database
     try:
         if db not in SupportedDatabases:
             return {"error": "Unsupported database type"}
-        if db in ["mysql", "postgres"]:
-            if db == 'mysql':
-                source_db_url = "mysql+mysqlconnector://"+connection_string
-            else:
-                source_db_url = "postgresql://"+connection_string
-            
-            SessionLocal = sessionmaker()
-            engine = create_engine(source_db_url)
-            SessionLocal.configure(bind=engine)
-            metadata = MetaData()
-            metadata.reflect(bind=engine)
-            return {"source_info": source_info, "metadata": metadata_dict(metadata.tables.values())}
+        url = source_db_url(source=db, user=source_info.user, password=source_info.password,
+                            host=source_info.host, port=source_info.port, database=source_info.database)
+
+        def load():
+            # Credentials are not saved, so the engine is not kept in the pool registry
+            engine = create_engine(url, poolclass=NullPool)
+            try:
+                return reflect_metadata(engine, schema=schema)
+            finally:
+                engine.dispose()
+        # Cached by a hash of the url so that the password is not kept in the key
+        cache_key = ("connect", hashlib.sha256(url.encode()).hexdigest(), schema)
+        reflected = reflection_cache.get_or_load(cache_key, load, refresh=refresh)
+        return {"source_info": source_info, "metadata": reflected["metadata"]}
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Error: {e}")
     
@@ -144,39 +372,28 @@ async def create_new_connection(
         "database": database
     }
     # Need to Validate the connection before saving to the database
-    source_db_url = ""
-    dataB = source
-    if password:
-        pswd = password
-    else:
-        pswd = ""
-    connection_string = user + ':' + pswd + '@' + host + ':' + port + '/' + database
     try:
-        if dataB not in SupportedDatabases:
+        if source not in SupportedDatabases:
             return {"error": "Unsupported database type"}
-        if dataB in ["mysql", "postgres"]:
-            if dataB == 'mysql':
-                source_db_url = "mysql+mysqlconnector://"+connection_string
-            else:
-                source_db_url = "postgresql://"+connection_string
-            
-            SessionLocal = sessionmaker()
-            engine = create_engine(source_db_url)
-            with engine.connect() as connection:
-                message = "Connection succesfull"
+        # Connect in a worker thread, so the event loop is not blocked while the source answers
+        await run_in_threadpool(check_source_connection, source=source, user=user, password=password, host=host, port=port, database=database)
+        message = "Connection succesfull"
     except Exception as e:
         return {"Message": "Connection error, check", "error": str(e)}
     else:
-        # Adding connection details to database
-        # Need to Encrypt the password before storing in the database
-        connection = Connections(**connection_data)
-        db.add(connection)
-        db.commit()
-        db.refresh(connection)
-
-        # Update profile.yml file with connection details
-        add_new_profiles_yml(connection=connection)
-        
+        def add_connection():
+            # Adding connection details to database
+            # Need to Encrypt the password before storing in the database
+            connection = Connections(**connection_data)
+            db.add(connection)
+            db.commit()
+            db.refresh(connection)
+
+            # Update profile.yml file with connection details
+            add_new_profiles_yml(connection=connection)
+            return connection
+
+        connection = await run_in_threadpool(add_connection)
         return {"Message": message, "Connection": connection}
 
 
@@ -186,6 +403,86 @@ async def create_new_connection(
 
 
 
+# API to Validate and Add many Connections at once
+@router.post("/connections/bulk", tags=["connection"])
+async def create_new_connections_bulk(bulk: BulkConnections, db: Session = Depends(get_db)):
+    """
+    Validate many source connections concurrently, each with its own connect timeout, and add the valid ones.
+    Returns the connect latency or error of every connection. Valid connections are added in a single transaction.
+    """
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    # Connects run on their own threads, at most max_concurrency at once. A check only starts once it has a slot, so
+    # checks waiting for one are not timed, and a connect that hangs is ended by the connect timeout of the driver.
+    executor = ThreadPoolExecutor(max_workers=min(bulk.max_concurrency, max(1, len(bulk.connections))))
+    slots = asyncio.Semaphore(bulk.max_concurrency)
+
+    async def validate(index, new_connection):
+        result = {"index": index, "connection_name": new_connection.connection_name, "valid": False, "latency_ms": None, "error": None}
+        async with slots:
+            start = time.perf_counter()
+            try:
+                result["latency_ms"] = round(await loop.run_in_executor(executor, lambda: check_source_connection(
+                    source=new_connection.source, user=new_connection.user, password=new_connection.password, host=new_connection.host,
+                    port=new_connection.port, database=new_connection.database, connect_timeout=bulk.connect_timeout)), 3)
+                result["valid"] = True
+            except Exception as e:
+                result["latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+                result["error"] = str(e)
+        return result
+
+    try:
+        results = await asyncio.gather(*[validate(index, new_connection) for index, new_connection in enumerate(bulk.connections)])
+    finally:
+        executor.shutdown(wait=False)
+    valid = [bulk.connections[result["index"]] for result in results if result["valid"]]
+
+    def add_connections():
+        # Need to Encrypt the password before storing in the database
+        connections = [
+            Connections(connection_name=new_connection.connection_name, source=new_connection.source.value, host=new_connection.host,
+                        user=new_connection.user, password=new_connection.password, port=new_connection.port, database=new_connection.database)
+            for new_connection in valid
+        ]
+        db.expire_on_commit = False
+        try:
+            db.add_all(connections)
+            db.flush()
+            # Update profile.yml file with details of all connections at once, before the commit so that
+            # connections are only added with their dbt profiles
+            profiles = add_connections_profiles_yml(connections)
+            if not profiles["success"]:
+                raise RuntimeError(f"profiles.yml was not updated, {profiles['error']}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return connections
+
+    if bulk.add and valid:
+        try:
+            added = await run_in_threadpool(add_connections)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error: no connection was added, {e}")
+        valid_results = [result for result in results if result["valid"]]
+        for result, connection in zip(valid_results, added):
+            result["connection_id"] = connection.connection_id
+
+    return {
+        "validated": len(results),
+        "valid": len(valid),
+        "added": len(valid) if bulk.add else 0,
+        "took_ms": round((time.perf_counter() - started) * 1000, 3),
+        "results": results,
+    }
+
+
+
+
+
+
+
+
 # API to Provide List of Connection Sources
 @router.get("/connections/sources/all", tags=["connection"]) # Modified url path as it gives error with a previous path
 def list_connection_sources(db: Session = Depends(get_db)):
@@ -204,6 +501,74 @@ def list_connection_sources(db: Session = Depends(get_db)):
 
 
 
+# API to Provide Pool Statistics of Source Connection Engines
+@router.get("/connections/pool/stats", tags=["connection"])
+def get_source_pool_stats():
+    """
+    Get hit/miss, eviction and checkout-wait statistics of the pooled source connection engines, sync, export and async, and of the join queue.
+    """
+    stats = engine_registry.stats()
+    stats["export_engines"] = export_engine_registry.stats()
+    stats["async_engines"] = async_engine_registry.stats()
+    stats["join_jobs"] = join_jobs.stats()
+    return stats
+
+
+
+
+
+
+
+
+# API to Provide Admission Statistics of Source Connections
+@router.get("/connections/admission/stats", tags=["connection"])
+def get_source_admission_stats():
+    """
+    Get limits, running queries, queue depth, wait times and rejections of each source connection.
+    """
+    return source_bulkhead.stats()
+
+
+
+
+
+
+
+
+# API to Provide Statement Timeout and Cancellation Statistics of Source Connections
+@router.get("/connections/query/stats", tags=["connection"])
+def get_source_query_stats():
+    """
+    Get the statement timeout, and the number of queries, timeouts, cancel requests and cancelled queries of each source connection.
+    """
+    return query_control.stats()
+
+
+
+
+
+
+
+
+# API to Provide Statistics of the Metadata, Row Count and Page Caches
+@router.get("/connections/cache/stats", tags=["connection"])
+def get_source_cache_stats():
+    """
+    Get hit/miss, entry and size statistics of the caches of source connection results.
+    """
+    return {
+        "reflection": reflection_cache.stats(),
+        "row_count": row_count_cache.stats(),
+        "page": page_cache.stats(),
+    }
+
+
+
+
+
+
+
+
 # API to Get Connection Details
 @router.get("/connections/{connection_id}", tags=["connection"])
 def get_connection_details(connection_id: int, db: Session = Depends(get_db)):
@@ -223,41 +588,54 @@ def get_connection_details(connection_id: int, db: Session = Depends(get_db)):
 
 
 
+# API to Set Concurrency Limits of a Source Connection
+@router.put("/connections/{connection_id}/limits", tags=["connection"])
+def set_source_connection_limits(connection_id: int, limits: SourceLimits, db: Session = Depends(get_db)):
+    """
+    Set the maximum number of concurrent queries on a source, and how many requests may wait for a free slot and for how long.
+    Requests beyond the limits are rejected with 429 when the queue is full and 503 when the wait timed out.
+    statement_timeout_ms is the default timeout of queries on the source, requests can set their own with timeout_ms.
+    """
+    get_source_connection(db, connection_id)
+    settings = db.query(ConnectionSettings).filter(ConnectionSettings.connection_id == connection_id).first()
+    if not settings:
+        settings = ConnectionSettings(connection_id=connection_id)
+        db.add(settings)
+    settings.max_in_flight = limits.max_in_flight
+    settings.max_queue = limits.max_queue
+    settings.queue_timeout_seconds = limits.queue_timeout_seconds
+    settings.statement_timeout_ms = limits.statement_timeout_ms
+    db.commit()
+    db.refresh(settings)
+    apply_connection_settings(settings)
+    return {"connection_id": connection_id, "limits": source_bulkhead.get_limits(connection_id),
+            "statement_timeout_ms": query_control.get_timeout(connection_id)}
+
+
+
+
+
+
+
+
 # API to Provide a List of Data Source Tables in a Connection
-@router.get("/connections/{connection_id}/tables", tags=["connection"])
-def list_source_connection_tables(connection_id: int, db: Session = Depends(get_db)):
+@router.get("/connections/{connection_id}/tables", tags=["connection"], dependencies=[Depends(source_query_scope)])
+def list_source_connection_tables(connection_id: int,
+                                  schema: Optional[str] = Query(None, description="Schema to reflect, default schema if not given"),
+                                  refresh: bool = Query(False, description="Reflect again even if cached metadata is available"),
+                                  db: Session = Depends(get_db)):
     """
     Provide a list of tables available in a source connection.
     """
     # Implement logic to list tables in the specified connection.
     try:
-        connection = db.query(Connections).filter(Connections.connection_id == connection_id).first()
-        if not connection:
-            return HTTPException(status_code=404, detail="Connection not found")
-        
-        source_db_url = ""
-        dbs = connection.source
-        if connection.password:
-            password = connection.password
-        else:
-            password = ""
-        
-        connection_string = connection.user+':'+password+'@'+connection.host+':'+connection.port+'/'+connection.database
-        
-        if dbs not in ["mysql", "postgres"]:
+        connection = get_source_connection(db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
             return {"error": "Unsupported database type"}
-        if dbs in ["mysql", "postgres"]:
-            if dbs == 'mysql':
-                source_db_url = "mysql+mysqlconnector://"+connection_string
-            else:
-                source_db_url = "postgresql://"+connection_string
-            
-            SessionLocal = sessionmaker()
-            engine = create_engine(source_db_url)
-            SessionLocal.configure(bind=engine)
-            metadata = MetaData()
-            metadata.reflect(bind=engine)
-            return {"metadata": table_list(metadata.tables.values())}
+
+        return {"metadata": get_table_names(connection, db, schema=schema, refresh=refresh)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Error: {e}")
 
@@ -279,40 +657,30 @@ def list_source_connection_tables(connection_id: int, db: Session = Depends(get_
 
 
 # API to Fetch Metadata from a Source Connection's Tables
-@router.get("/connections/{connection_id}/tables/metadata", tags=["connection"])
-def get_source_connection_tables_metadata(connection_id: int, db: Session = Depends(get_db)):
+@router.get("/connections/{connection_id}/tables/metadata", tags=["connection"], dependencies=[Depends(source_query_scope)])
+async def get_source_connection_tables_metadata(connection_id: int,
+                                          schema: Optional[str] = Query(None, description="Schema to reflect, default schema if not given"),
+                                          tables: Optional[List[str]] = Query(None, description="Reflect only these tables"),
+                                          prefix: Optional[List[str]] = Query(None, description="Reflect only tables whose name starts with one of these prefixes"),
+                                          refresh: bool = Query(False, description="Reflect again even if cached metadata is available"),
+                                          parallel: int = Query(1, description="Number of table shards reflected concurrently, capped per source", ge=1),
+                                          shard_size: int = Query(200, description="Tables per shard when reflecting in parallel", ge=1),
+                                          db: Session = Depends(get_db)):
     """
     Fetch metadata for tables in a source connection.
+    All tables of the schema are reflected unless tables or prefix are given.
     """
     # Implement logic to retrieve table metadata for the specified connection.
     try:
-        connection = db.query(Connections).filter(Connections.connection_id == connection_id).first()
-        if not connection:
-            return HTTPException(status_code=404, detail="Connection not found")
-        
-        source_db_url = ""
-        dbs = connection.source
-        if connection.password:
-            password = connection.password
-        else:
-            password = ""
-        
-        connection_string = connection.user+':'+password+'@'+connection.host+':'+connection.port+'/'+connection.database
-    
-        if dbs not in ["mysql", "postgres"]:
+        connection = await run_in_threadpool(get_source_connection, db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
             return {"error": "Unsupported database type"}
-        if dbs in ["mysql", "postgres"]:
-            if dbs == 'mysql':
-                source_db_url = "mysql+mysqlconnector://"+connection_string
-            else:
-                source_db_url = "postgresql://"+connection_string
-            
-            SessionLocal = sessionmaker()
-            engine = create_engine(source_db_url)
-            SessionLocal.configure(bind=engine)
-            metadata = MetaData()
-            metadata.reflect(bind=engine)
-            return {"metadata": metadata_dict(metadata.tables.values())}
+
+        reflected = await get_reflected_metadata_async(connection, db, schema=schema, refresh=refresh, tables=tables, prefixes=prefix,
+                                                       parallel=parallel, shard_size=shard_size)
+        return {"metadata": reflected["metadata"]}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Error: {e}")
     
@@ -323,43 +691,82 @@ def get_source_connection_tables_metadata(connection_id: int, db: Session = Depe
 
 
 
+# API to Invalidate Cached Metadata of a Source Connection
+@router.delete("/connections/{connection_id}/tables/metadata/cache", tags=["connection"])
+def invalidate_source_connection_metadata_cache(connection_id: int):
+    """
+    Remove cached metadata of a source connection, so that the next call reflects the source again.
+    """
+    removed = reflection_cache.invalidate_connection(connection_id)
+    removed += row_count_cache.invalidate_connection(connection_id)
+    removed += page_cache.invalidate_connection(connection_id)
+    return {"connection_id": connection_id, "invalidated_entries": removed}
+
+
+
+
+
+
+
+
+# API to Fetch Metadata of one Table in a Source Connection
+@router.get("/connections/{connection_id}/tables/{table}/metadata", tags=["connection"], dependencies=[Depends(source_query_scope)])
+async def get_source_table_metadata(connection_id: int, table: str,
+                              schema: Optional[str] = Query(None, description="Schema of the table, default schema if not given"),
+                              refresh: bool = Query(False, description="Reflect again even if cached metadata is available"),
+                              db: Session = Depends(get_db)):
+    """
+    Fetch metadata of a single table in a source connection, reflecting only that table.
+    """
+    try:
+        connection = await run_in_threadpool(get_source_connection, db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
+            return {"error": "Unsupported database type"}
+
+        reflected = await get_reflected_metadata_async(connection, db, schema=schema, refresh=refresh, tables=[table])
+        if table not in reflected["metadata"]:
+            raise HTTPException(status_code=404, detail=f"Table '{table}' not found")
+        return {"metadata": reflected["metadata"][table]}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Error: {e}")
+
+
+
+
+
+
+
+
 # API to Provide a List of Unique Identifiers for a Table in a Source
-@router.get("/connections/{connection_id}/tables/{table}/unique-identifiers", tags=["connection"])
-def get_unique_identifiers(connection_id: int, table: str, db: Session = Depends(get_db)):
+@router.get("/connections/{connection_id}/tables/{table}/unique-identifiers", tags=["connection"], dependencies=[Depends(source_query_scope)])
+async def get_unique_identifiers(connection_id: int, table: str, db: Session = Depends(get_db)):
     """
     Get the unique identifiers for a table in a source.
     """
     # Implement logic to retrieve unique identifiers for the specified table.
+    def read_unique_identifiers(source_connection):
+        inspector = inspect(source_connection)
+        return get_primary_and_unique_columns(inspector, table)
+
     try:
-        connection = db.query(Connections).filter(Connections.connection_id == connection_id).first()
-        if not connection:
-            raise HTTPException(status_code=404, detail="Connection not found")
-        
-        source_db_url = ""
-        dbs = connection.source
-        if connection.password:
-            password = connection.password
-        else:
-            password = ""
-        
-        connection_string = connection.user+':'+password+'@'+connection.host+':'+connection.port+'/'+connection.database
-    
-        if dbs not in ["mysql", "postgres"]:
+        connection = await run_in_threadpool(get_source_connection, db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
             return {"error": "Unsupported database type"}
-        if dbs in ["mysql", "postgres"]:
-            if dbs == 'mysql':
-                source_db_url = "mysql+mysqlconnector://"+connection_string
-            else:
-                source_db_url = "postgresql://"+connection_string
-            
-            SessionLocal = sessionmaker()
-            engine = create_engine(source_db_url)
-            SessionLocal.configure(bind=engine)
-            inspector = inspect(engine)
-            
-            unique_identifiers = get_primary_and_unique_columns(inspector, table)
-            return unique_identifiers
+
+        if not async_engine_registry.available(connection.source):
+            def read_sync():
+                with engine_registry.connect(connection) as source_connection:
+                    return read_unique_identifiers(source_connection)
+            return await run_in_threadpool(read_sync)
+
+        async with async_engine_registry.connect(connection) as source_connection:
+            unique_identifiers = await source_connection.run_sync(read_unique_identifiers)
+        return unique_identifiers
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Error: {e}")
 
@@ -375,80 +782,187 @@ def get_unique_identifiers(connection_id: int, table: str, db: Session = Depends
 
 
 
+# Function to read one page of data of a source table on a checked out source connection, with the count of rows
+def read_page(connection, source_connection, table: str, pagination: PaginationParams):
+    # Fetch columns information
+    columns = get_table_columns(connection, source_connection, table)
+    column_names = [column["name"] for column in columns]
+    source = source_table(table, columns)
+
+    # Projection, filters and order are checked against the columns of the table
+    filters = [{"column": column_filter.column, "op": column_filter.op.value, "value": column_filter.value}
+               for column_filter in pagination.filters or []]
+    order_by = [(order.column, order.direction == SortDirection.desc) for order in pagination.order_by or []]
+    requested = (pagination.columns or []) + [column_filter["column"] for column_filter in filters] + [name for name, _ in order_by]
+    unknown = [name for name in requested if name not in column_names]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns {unknown} in table '{table}'")
+    selected_names = pagination.columns or column_names
+    try:
+        where = build_filter_clauses(source, filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Get the count of rows, falling back to the exact count when the catalog has no estimate.
+    # The estimate is of the whole table, so filtered rows are always counted exactly.
+    count_mode = pagination.count
+    total_records = None
+    if count_mode == CountMode.estimate:
+        total_records = estimate_row_count(source_connection, table) if not where else None
+        if total_records is None:
+            count_mode = CountMode.exact
+    if count_mode == CountMode.exact:
+        count_key = (connection.connection_id, table)
+        if where:
+            count_key += (json.dumps(filters, sort_keys=True, default=str),)
+        total_records = row_count_cache.get_or_load(count_key, lambda: count_rows(source_connection, source, where=where))
+    total_pages = math.ceil(total_records/pagination.per_page) if total_records is not None else None
+    limit = pagination.per_page
+
+    # Seek on order_by columns and the primary or unique key in cursor mode, tables without such a key fall back to OFFSET.
+    # Ordering by nullable columns is rejected, as rows with NULLs would be skipped by the seek.
+    # offset is the number of rows before the page, carried by the cursor, which numbers cursor pages.
+    seek_columns = None
+    descending = None
+    after = None
+    page = pagination.page
+    offset = (pagination.page - 1) * pagination.per_page
+    if pagination.use_cursor or pagination.cursor:
+        try:
+            seek_columns, descending = get_ordered_seek_columns(get_table_seek_columns(connection, source_connection, table, columns),
+                                                                order_by, columns)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if pagination.cursor:
+            try:
+                cursor = decode_cursor(pagination.cursor)
+                offset = int(cursor.get("offset", 0))
+            except (ValueError, TypeError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            if "key" not in cursor:
+                seek_columns = None
+            elif (seek_columns and cursor["key"] == seek_columns
+                  and cursor.get("descending", [False] * len(seek_columns)) == descending):
+                after = cursor["after"]
+            else:
+                raise HTTPException(status_code=400, detail="Cursor does not match the key or order of the table")
+        elif seek_columns:
+            offset = 0
+        page = offset // pagination.per_page + 1
+
+    if not seek_columns and count_mode == CountMode.exact and offset > total_records:
+        raise HTTPException(status_code=404, detail=f"Page {page} is out of range. Only {total_pages} pages")
+
+    # Build a dynamic select statement based on columns, key columns missing from the projection are selected for the cursor
+    query_names = selected_names + [name for name in seek_columns or [] if name not in selected_names]
+    try:
+        select_query = build_page_query(source, query_names, limit=limit, offset=offset, seek_columns=seek_columns, after=after,
+                                        descending=descending, where=where, order_by=order_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Execute the query and fetch all rows
+    result = source_connection.execute(select_query)
+    rows = result.fetchall()
+
+    # Convert rows to dictionaries
+    # table_values = [dict(zip(column_names, row)) for row in rows]
+    table_values = [list(row)[:len(selected_names)] for row in rows]
+
+    # Check if any rows were returned
+    if not table_values:
+        raise HTTPException(status_code=404, detail=f"No data found in the table '{table}'")
+
+    if count_mode == CountMode.none:
+        page_details = f"Page {page}, with {pagination.per_page} content/page"
+    elif count_mode == CountMode.estimate:
+        page_details = f"Page {page} of about {total_pages} pages, with {pagination.per_page} content/page out of about {total_records} contents"
+    else:
+        page_details = f"Page {page} of {total_pages} pages, with {pagination.per_page} content/page out of {total_records} contents"
+
+    return {
+        "column_names" : selected_names,
+        "table_values": table_values,
+        "page_details" : page_details,
+        "page": page,
+        "total_pages":total_pages,
+        "records_per_page": pagination.per_page,
+        "total_records": total_records,
+        "count_mode": count_mode,
+        "pagination": "keyset" if seek_columns else "offset",
+        "next_cursor": next_page_cursor(rows, limit, query_names, seek_columns=seek_columns, offset=offset, descending=descending),
+        }
+
+
+
+
+
+# Function to read one page of data of a source table, with the count of rows
+def read_table_page(connection, table: str, pagination: PaginationParams):
+    with engine_registry.connect(connection) as source_connection:
+        return read_page(connection, source_connection, table, pagination)
+
+
+# Function to read one page of data of a source table on the async engine,
+# sources without an installed async driver are read in the threadpool
+async def read_table_page_async(connection, table: str, pagination: PaginationParams):
+    if not async_engine_registry.available(connection.source):
+        return await run_in_threadpool(read_table_page, connection, table, pagination)
+    async with async_engine_registry.connect(connection) as source_connection:
+        return await source_connection.run_sync(lambda sync_connection: read_page(connection, sync_connection, table, pagination))
+
+
+
+
+
+# Function to return a page of table data in the requested layout, pages are read and cached row-major
+def page_in_layout(page, layout: DataLayout):
+    if layout != DataLayout.columns:
+        return page
+    column_page = {name: value for name, value in page.items() if name != "table_values"}
+    column_page["column_values"] = column_major(page["table_values"], len(page["column_names"]))
+    column_page["layout"] = layout
+    return column_page
+
+
+
+
+
 # API to get data in a Table in a Source
-@router.post("/connections/{connection_id}/tables/{table}/datas", tags=["connection"])
-def get_data_of_table(connection_id: int, table: str, pagination: PaginationParams, db: Session = Depends(get_db)):
+@router.post("/connections/{connection_id}/tables/{table}/datas", tags=["connection"], dependencies=[Depends(source_query_scope)])
+async def get_data_of_table(connection_id: int, table: str, pagination: PaginationParams, response: Response, db: Session = Depends(get_db)):
     """
     Get the data in a table in a source.
+    Only the given columns are selected, and filters and order_by are run by the source database so it can use its indexes.
+    Pages are served from the result cache within its TTL, the X-Cache header tells if a page was a HIT, MISS or BYPASS.
+    With layout=columns the values are returned as one list per column in column_values.
     """
     # Implement logic to retrieve unique identifiers for the specified table.
     try:
-        connection = db.query(Connections).filter(Connections.connection_id == connection_id).first()
-        if not connection:
-            return HTTPException(status_code=404, detail="Connection not found")
-        
-        source_db_url = ""
-        dbs = connection.source
-        if connection.password:
-            password = connection.password
-        else:
-            password = ""
-        connection_string = connection.user+':'+password+'@'+connection.host+':'+connection.port+'/'+connection.database
-    
-        if dbs not in ["mysql", "postgres"]:
+        connection = await run_in_threadpool(get_source_connection, db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
             return {"error": "Unsupported database type"}
-        if dbs in ["mysql", "postgres"]:
-            if dbs == 'mysql':
-                source_db_url = "mysql+mysqlconnector://"+connection_string
-            else:
-                source_db_url = "postgresql://"+connection_string
-            
-            # Configure and create the engine
-            engine = create_engine(source_db_url)
-
-            with engine.connect() as connection:
-                inspector = inspect(engine)
-                
-                # Fetch columns information
-                columns = inspector.get_columns(table)
-                column_names = [column["name"] for column in columns]
-
-                # Get the count of rows
-                row_count_query = f"SELECT COUNT(*) FROM {table}"
-                total_records = connection.execute(text(row_count_query)).scalar()
-
-                # Calculate the offset and limit for pagination
-                offset = (pagination.page - 1) * pagination.per_page
-                limit = pagination.per_page
-                total_pages = math.ceil(total_records/pagination.per_page)
-                if offset > total_records:
-                    return HTTPException(status_code=404, detail=f"Page {pagination.page} is out of range. Only {total_pages} pages")
-
-                # Build a dynamic select statement based on columns
-                select_query = f"SELECT {', '.join(column_names)} FROM {table} LIMIT {limit} OFFSET {offset}"
-
-                # Execute the query and fetch all rows
-                result = connection.execute(text(select_query))
-                rows = result.fetchall()
-
-                # Convert rows to dictionaries
-                # table_values = [dict(zip(column_names, row)) for row in rows]
-                table_values = [list(row) for row in rows]
-
-                # Check if any rows were returned
-                if not table_values:
-                    return HTTPException(status_code=404, detail=f"No data found in the table '{table}'")
-            
-            return {
-                "column_names" : column_names,
-                "table_values": table_values,
-                "page_details" : f"Page {pagination.page} of {total_pages} pages, with {pagination.per_page} content/page out of {total_records} contents",
-                "page": pagination.page,
-                "total_pages":total_pages,
-                "records_per_page": pagination.per_page,
-                "total_records": total_records,
-                }
-            
+
+        if not pagination.cache or not page_cache.enabled:
+            response.headers["X-Cache"] = "BYPASS"
+            return page_in_layout(await read_table_page_async(connection, table, pagination), pagination.layout)
+
+        cache_key = (connection.connection_id, table, json.dumps(pagination.dict(exclude={"cache", "layout"}), sort_keys=True, default=str))
+        cached = page_cache.get(cache_key)
+        if cached is not None:
+            stored_at, page = cached
+            response.headers["X-Cache"] = "HIT"
+            response.headers["Age"] = str(int(time.time() - stored_at))
+            return page_in_layout(page, pagination.layout)
+
+        # Out of range and empty pages raise, so only pages with data are cached
+        page = await read_table_page_async(connection, table, pagination)
+        page_cache.set(cache_key, (time.time(), page))
+        response.headers["X-Cache"] = "MISS"
+        return page_in_layout(page, pagination.layout)
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Error: {e}")
 
@@ -462,45 +976,219 @@ def get_data_of_table(connection_id: int, table: str, pagination: PaginationPara
 
 
 
+# API to Get a Random Sample of data in a Table in a Source
+@router.get("/connections/{connection_id}/tables/{table}/sample", tags=["connection"], dependencies=[Depends(source_query_scope)])
+def get_sample_of_table(connection_id: int, table: str,
+                        rows: int = Query(100, description="Number of rows to sample", ge=1, le=10000),
+                        seed: Optional[int] = Query(None, description="Seed to repeat a sample, a random seed is used and returned if not given"),
+                        method: SampleMethod = Query(SampleMethod.auto, description="auto, system or bernoulli (TABLESAMPLE, Postgres only), key_range (random ranges of an integer key) or random (ORDER BY random, scans the table)"),
+                        columns: Optional[List[str]] = Query(None, description="Columns to return, all columns if not given"),
+                        db: Session = Depends(get_db)):
+    """
+    Get a random sample of the data in a table in a source, in the same format as the table data.
+    Postgres tables are sampled with TABLESAMPLE, MySQL tables by reading rows after random points of the key,
+    so only a part of the table is read. The method used and the seed are returned with the sample.
+    """
+    try:
+        connection = get_source_connection(db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
+            return {"error": "Unsupported database type"}
+
+        with engine_registry.connect(connection) as source_connection:
+            table_columns = get_table_columns(connection, source_connection, table)
+            column_names = [column["name"] for column in table_columns]
+            if columns:
+                unknown = [name for name in columns if name not in column_names]
+                if unknown:
+                    raise HTTPException(status_code=400, detail=f"Unknown columns {unknown} in table '{table}'")
+                column_names = columns
+            source = source_table(table, table_columns)
+
+            # TABLESAMPLE percentage is worked out from the row count, counted only when the catalog has no estimate
+            total_records = estimate_row_count(source_connection, table)
+            if total_records is None and source_connection.dialect.name == "postgresql":
+                total_records = row_count_cache.get_or_load((connection.connection_id, table), lambda: count_rows(source_connection, source))
+            key = get_sample_key(get_table_seek_columns(connection, source_connection, table, table_columns), table_columns)
+
+            try:
+                sampled, sampling = sample_rows(source_connection, source, column_names, rows, method=method.value, seed=seed,
+                                                key=key, total_rows=total_records)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+        return {
+            "column_names": column_names,
+            "table_values": [list(row) for row in sampled],
+            "total_records": total_records,
+            "sampling": sampling,
+            }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Error: {e}")
+
+
+
+
+
+
+
+
+# API to Profile the Columns of a Table in a Source
+@router.get("/connections/{connection_id}/tables/{table}/profile", tags=["connection"], dependencies=[Depends(source_query_scope)])
+def get_profile_of_table(connection_id: int, table: str,
+                         columns: Optional[List[str]] = Query(None, description="Columns to profile, all columns if not given"),
+                         sample: Optional[bool] = Query(None, description="Profile a sample instead of the whole table, by default only for tables larger than PROFILE_FULL_SCAN_MAX_ROWS"),
+                         top_values: bool = Query(False, description="Also report the most frequent values of each column, computed from a sample"),
+                         refresh: bool = Query(False, description="Profile again even if a cached profile is available"),
+                         db: Session = Depends(get_db)):
+    """
+    Get null counts, distinct counts, min, max and optionally top values of the columns of a table in a source.
+    All statistics except top values are computed in one aggregate select, and top values from a sample
+    that is only read when top_values is set.
+    Profiles are cached with the reflected metadata and dropped together with it.
+    """
+    try:
+        connection = get_source_connection(db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
+            return {"error": "Unsupported database type"}
+
+        def load():
+            with engine_registry.connect(connection) as source_connection:
+                table_columns = get_table_columns(connection, source_connection, table)
+                profile_columns = table_columns
+                if columns:
+                    column_names = [column["name"] for column in table_columns]
+                    unknown = [name for name in columns if name not in column_names]
+                    if unknown:
+                        raise HTTPException(status_code=400, detail=f"Unknown columns {unknown} in table '{table}'")
+                    profile_columns = [column for column in table_columns if column["name"] in columns]
+                key = get_sample_key(get_table_seek_columns(connection, source_connection, table, table_columns), table_columns)
+                return profile_table(source_connection, source_table(table, table_columns), profile_columns, key=key,
+                                     total_rows=estimate_row_count(source_connection, table), sample=sample,
+                                     with_top_values=top_values)
+
+        profile_key = (connection.connection_id, "profile", table, tuple(columns or ()), sample, top_values)
+        return {"table": table, **reflection_cache.get_or_load(profile_key, load, refresh=refresh)}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Error: {e}")
+
+
+
+
+
+
+
+
+# API to Export data of a Table in a Source as a stream
+@router.get("/connections/{connection_id}/tables/{table}/export", tags=["connection"], dependencies=[Depends(source_query_scope)])
+def export_table_data(connection_id: int, table: str,
+                      format: ExportFormat = Query(ExportFormat.ndjson, description="ndjson, csv, arrow (Arrow IPC stream) or parquet (file written to the export directory)"),
+                      columns: Optional[List[str]] = Query(None, description="Columns to export, all columns if not given"),
+                      limit: Optional[int] = Query(None, description="Maximum number of rows", ge=1),
+                      batch_size: int = Query(1000, description="Rows fetched from the source per batch", ge=1, le=100000),
+                      path: Optional[str] = Query(None, description="File name of the Parquet export inside the export directory"),
+                      db: Session = Depends(get_db)):
+    """
+    Stream the data of a table in a source as NDJSON, CSV or Arrow IPC, or write it to a Parquet file.
+    Rows are read through a server side cursor one batch at a time, and the next batch is only
+    fetched after the previous one was sent to the client.
+    Arrow and Parquet columns are typed from the column types of the source table.
+    """
+    try:
+        connection = get_source_connection(db, connection_id)
+        if connection.source not in ["mysql", "postgres"]:
+            return {"error": "Unsupported database type"}
+        if format in [ExportFormat.arrow, ExportFormat.parquet]:
+            try:
+                import_pyarrow()
+            except RuntimeError as e:
+                raise HTTPException(status_code=501, detail=str(e))
+        if format == ExportFormat.parquet:
+            if not path or os.path.basename(path) != path:
+                raise HTTPException(status_code=400, detail="A file name is required as path for Parquet exports")
+            path = os.path.join(EXPORT_DIR, path)
+
+        # Source connection is kept open until the stream is finished, from an engine whose driver streams rows
+        stack = ExitStack()
+        try:
+            source_connection = stack.enter_context(export_engine_registry.connect(connection))
+            table_columns = get_table_columns(connection, source_connection, table)
+            column_names = [column["name"] for column in table_columns]
+            if columns:
+                unknown = [name for name in columns if name not in column_names]
+                if unknown:
+                    raise HTTPException(status_code=400, detail=f"Unknown columns {unknown} in table '{table}'")
+                column_names = columns
+            export_columns = [next(column for column in table_columns if column["name"] == name) for name in column_names]
+            query = build_export_query(source_table(table, table_columns), column_names, limit=limit)
+        except Exception:
+            stack.close()
+            raise
+
+        if format == ExportFormat.parquet:
+            with stack:
+                os.makedirs(EXPORT_DIR, exist_ok=True)
+                stats = write_parquet(export_columns, stream_batches(source_connection, query, batch_size=batch_size), path)
+            return {"path": path, "export_stats": stats}
+
+        def chunks():
+            with stack:
+                batches = stream_batches(source_connection, query, batch_size=batch_size)
+                if format == ExportFormat.csv:
+                    yield from csv_chunks(column_names, batches)
+                elif format == ExportFormat.arrow:
+                    yield from arrow_ipc_chunks(export_columns, batches, table_name=table)
+                else:
+                    yield from ndjson_chunks(column_names, batches)
+
+        media_types = {
+            ExportFormat.csv: "text/csv",
+            ExportFormat.arrow: "application/vnd.apache.arrow.stream",
+            ExportFormat.ndjson: "application/x-ndjson",
+        }
+        headers = {"Content-Disposition": f'attachment; filename="{table}.{format.value}"'}
+        return StreamingResponse(chunks(), media_type=media_types[format], headers=headers)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Error: {e}")
+
+
+
+
+
+
+
+
 # API to Trigger a Join from Two Source Table Connections
-@router.post("/joins", tags=["connection"])
+@router.post("/joins", status_code=202, tags=["connection"])
 def perform_join(joint_info: JoinDetails, db: Session = Depends(get_db)):
     """
     Perform a join operation between two tables in connection. 
     Required columns of final table to be given as {"source name":"destination name"} pair for both table. 
     Columns that has to be matched in join should be given as match_pair = {"table1 col":"table2 col"}
+    Only the new model is run, along with its upstream or downstream models when graph is given.
+    The join is run in the background, its status and result are given by /transformations/{transformation_id}.
     """
-    # Implement logic to perform the join operation and return the result.
     connection_id = joint_info.connection_id
-    join_make = joint_info.make
-    join_type = joint_info.type
-    new_table = joint_info.new_table
-    table1 = joint_info.table1
-    table1_col = joint_info.table1_col
-    table2 = joint_info.table2
-    table2_col = joint_info.table2_col
-    match_pair = joint_info.match_pair
+    select = model_selector(joint_info.new_table, upstream=joint_info.graph in (JoinGraph.upstream, JoinGraph.both),
+                            downstream=joint_info.graph in (JoinGraph.downstream, JoinGraph.both))
 
     connection = db.query(Connections).filter(Connections.connection_id == connection_id).first()
     if not connection:
         raise HTTPException(status_code=404, detail="Connection not found")
-    
-    # Update target value on profiles.yml file
-    update_target_profiles_yaml(connection.connection_id)
-
-    # Create .sql file with query
-    sql_query = create_sql_query(join_make=join_make, join_type=join_type, new_table=new_table, table1=table1, table1_col=table1_col, table2=table2, table2_col=table2_col, match_pair=match_pair)
-    
-    # Use subprocess to run dbt
-    project_location = "./dbt/postgres_dbt"
-    result = subprocess.run(["dbt", "run", "--project-dir", project_location], capture_output=True, text=True)
-
-    # Delete the .sql file after suscessful running of dbt project
-    delete_sql_file(new_table=new_table)
 
-    # dbt does not return tables, so need to get new table using SQLAlchemy and return
+    # The target of the connection is given to dbt per run, profiles.yml is not rewritten so that dbt keeps its partial parsing state.
+    # The join queue writes the .sql file to a workspace of the run, runs it in a dbt worker and records the result on the transformation.
+    job = join_jobs.submit(db, connection.connection_id, jsonable_encoder(joint_info), select)
 
-    return {"SQL Query": sql_query, "stdout": result.stdout, "stderr": result.stderr}
+    return {"Message": "Join queued", "status": "In Progress", "selected": select, **job}
     
 
 
@@ -0,0 +1,96 @@
+from fastapi import APIRouter, Depends, Query, HTTPException
+from sqlalchemy.orm import Session
+from typing import Optional
+
+
+from data.database import get_db
+from data.model import SchemaCatalogRefresh
+from apis.alpha import get_source_connection
+from functions.catalog_func import refresh_source_catalog, refresh_summary, catalog_diff
+from functions.response_func import NegotiatedRoute
+
+router = APIRouter(route_class=NegotiatedRoute)
+
+
+
+
+# API to Refresh the Schema Catalog of a Source Connection
+@router.post("/connections/{connection_id}/catalog/refresh", tags=["catalog"])
+def refresh_connection_catalog(connection_id: int,
+                               schema: Optional[str] = Query(None, description="Schema to refresh, default schema if not given"),
+                               db: Session = Depends(get_db)):
+    """
+    Store the metadata of a source connection in the catalog. Only tables whose DDL changed since the last refresh are reflected again.
+    """
+    connection = get_source_connection(db, connection_id)
+    if connection.source not in ["mysql", "postgres"]:
+        return {"error": "Unsupported database type"}
+    try:
+        catalog_refresh = refresh_source_catalog(db, connection, schema=schema)
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=404, detail=f"Error: {e}")
+    return refresh_summary(catalog_refresh)
+
+
+
+
+
+
+
+
+# API to List the Catalog Refreshes of a Source Connection
+@router.get("/connections/{connection_id}/catalog/refreshes", tags=["catalog"])
+def list_connection_catalog_refreshes(connection_id: int,
+                                      schema: Optional[str] = Query(None, description="Schema of the refreshes, default schema if not given"),
+                                      db: Session = Depends(get_db)):
+    """
+    List the catalog refreshes of a source connection with the tables each one added, removed or changed.
+    """
+    catalog_refreshes = (
+        db.query(SchemaCatalogRefresh)
+        .filter(SchemaCatalogRefresh.connection_id == connection_id, SchemaCatalogRefresh.schema_name == schema)
+        .order_by(SchemaCatalogRefresh.refresh_id)
+        .all()
+    )
+    return {"refreshes": [refresh_summary(catalog_refresh) for catalog_refresh in catalog_refreshes]}
+
+
+
+
+
+
+
+
+# API to Get the Schema Diff between two Catalog Refreshes
+@router.get("/connections/{connection_id}/catalog/diff", tags=["catalog"])
+def get_connection_catalog_diff(connection_id: int,
+                                from_refresh: Optional[int] = Query(None, description="Older refresh ID, the refresh before to_refresh if not given"),
+                                to_refresh: Optional[int] = Query(None, description="Newer refresh ID, the latest refresh if not given"),
+                                schema: Optional[str] = Query(None, description="Schema of the refreshes when to_refresh is not given"),
+                                db: Session = Depends(get_db)):
+    """
+    Get the tables added, removed and changed between two catalog refreshes, with column level changes of changed tables.
+    """
+    query = db.query(SchemaCatalogRefresh).filter(SchemaCatalogRefresh.connection_id == connection_id)
+    if to_refresh is None:
+        newer = query.filter(SchemaCatalogRefresh.schema_name == schema).order_by(SchemaCatalogRefresh.refresh_id.desc()).first()
+    else:
+        newer = query.filter(SchemaCatalogRefresh.refresh_id == to_refresh).first()
+    if not newer:
+        raise HTTPException(status_code=404, detail="Catalog refresh not found")
+
+    query = query.filter(SchemaCatalogRefresh.schema_name == newer.schema_name)
+    if from_refresh is None:
+        older = query.filter(SchemaCatalogRefresh.refresh_id < newer.refresh_id).order_by(SchemaCatalogRefresh.refresh_id.desc()).first()
+    else:
+        older = query.filter(SchemaCatalogRefresh.refresh_id == from_refresh).first()
+    if not older:
+        raise HTTPException(status_code=404, detail="No earlier catalog refresh of the same schema found")
+    if older.refresh_id > newer.refresh_id:
+        raise HTTPException(status_code=400, detail="from_refresh must be older than to_refresh")
+
+    return catalog_diff(db, older, newer)
@@ -0,0 +1,7 @@
+# Settings for the tests, read before the modules of the API are imported
+
+import os
+
+# The tests create their own databases, the metadata database is only needed to import the modules
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("CATALOG_REFRESH_INTERVAL_SECONDS", "0")
@@ -5,8 +5,9 @@ from sqlalchemy.sql import func
 
 from data.database import get_db
 from data.model import Pipeline, PipelineStatus
+from functions.response_func import NegotiatedRoute
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute)
 
 @router.get("/dashboard/active_pipelines", tags=["dashboard"])
 def active_pipelines(db : Session = Depends(get_db)):
@@ -21,8 +21,9 @@ from data.model import (
     IngestionJobPair,
     IngestionPipelinePair
     )
+from functions.response_func import NegotiatedRoute
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute)
 
 
 
@@ -6,9 +6,10 @@ from typing import List
 
 from data.database import get_db
 from data.model import Pipeline, PipelineStatus
+from functions.response_func import NegotiatedRoute
 
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute)
 
 
 # Pydantic models for data validation
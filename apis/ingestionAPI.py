@@ -4,8 +4,9 @@ from sqlalchemy.orm import Session, joinedload
 
 from data.database import get_db
 from data.model import JobExecutionStatus, IngestionMetadata, IngestionJobPair, IngestionPipelinePair, PipelineExecutionStatus, PipelineMetadata
+from functions.response_func import NegotiatedRoute
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute)
 
 
 
@@ -7,8 +7,9 @@ from datetime import datetime
 
 from data.database import get_db
 from data.model import JobMetadata
+from functions.response_func import NegotiatedRoute
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute)
 
 
 # Pydantic models for data validation
@@ -11,8 +11,9 @@ from data.model import (
     IngestionPipelinePair,
     IngestionMetadata
     )
+from functions.response_func import NegotiatedRoute
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute)
 
 
 
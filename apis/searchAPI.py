@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Query
+from enum import Enum
+from typing import Optional
+
+
+from functions.search_index_func import search_index, FUZZY_THRESHOLD
+from functions.response_func import NegotiatedRoute
+
+router = APIRouter(route_class=NegotiatedRoute)
+
+
+class SearchMode(str, Enum):
+    exact = "exact"
+    prefix = "prefix"
+    fuzzy = "fuzzy"
+
+class SearchKind(str, Enum):
+    column = "column"
+    table = "table"
+    all = "all"
+
+
+
+
+# API to Search Columns and Tables across all Source Connections
+@router.get("/search/columns", tags=["search"])
+def search_columns(q: str = Query(..., description="Name or part of a name to search for, eg: customer_id", min_length=1),
+                   mode: SearchMode = Query(SearchMode.prefix, description="exact, prefix or fuzzy matching"),
+                   kind: SearchKind = Query(SearchKind.column, description="Search column names, table names or both"),
+                   connection_id: Optional[int] = Query(None, description="Search only this connection"),
+                   type: Optional[str] = Query(None, description="Only columns whose type contains this text, eg: INT"),
+                   limit: int = Query(50, description="Maximum number of results", ge=1, le=1000),
+                   threshold: float = Query(FUZZY_THRESHOLD, description="Minimum trigram similarity of fuzzy matches, lower values match names with more typos", ge=0, le=1)):
+    """
+    Find tables and columns by name across every source connection whose metadata was reflected or stored in the catalog.
+    Names are also matched on their parts, so 'customer' finds 'customer_id'. Fuzzy matches are ranked by trigram similarity.
+    """
+    return search_index.search(q, mode=mode.value, kind=kind.value, connection_id=connection_id, type_filter=type, limit=limit,
+                               threshold=threshold)
+
+
+
+
+
+
+
+# API to Provide Statistics of the Search Index
+@router.get("/search/stats", tags=["search"])
+def get_search_index_stats():
+    """
+    Get the number of indexed tables, columns and terms.
+    """
+    return search_index.stats()
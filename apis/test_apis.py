@@ -0,0 +1,1474 @@
+# Tests of the helpers behind the APIs, grouped by the feature they belong to.
+# Queries run on in-memory SQLite databases instead of the source and metadata databases.
+
+import io
+import os
+import csv
+import json
+import math
+import time
+import pathlib
+import asyncio
+import decimal
+import datetime
+import threading
+from datetime import timedelta
+from concurrent.futures.process import BrokenProcessPool
+
+import yaml
+import pytest
+import pyarrow
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+import pyarrow.parquet
+from sqlalchemy import create_engine, inspect, select, text, types, Table, Column, MetaData, CheckConstraint
+from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.dialects import mysql, postgresql
+
+from functions.table_data_func import encode_cursor, decode_cursor, coerce_value, build_filter_clauses, build_seek_clause, source_table, sample_rows
+from functions.profile_func import profile_table
+from functions.cache_func import TTLCache, ResultCache
+from functions.response_func import negotiate_media_type, JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE
+from functions.dbt_runner_func import model_selector, dbt_args, dbt_workspace, DbtWorkerPool
+from functions.admission_func import SourceBulkhead, AdmissionRejected, source_bulkhead
+from functions.engine_pool_func import EnginePoolRegistry, AsyncEnginePoolRegistry
+from functions import query_control_func
+from functions.query_control_func import QueryControl, QueryScope, StatementTimeout, QueryCancelled, current_query_scope, is_timeout_error, is_cancel_error
+from functions.catalog_func import refresh_catalog, load_catalog, catalog_diff, refresh_summary
+from functions.search_index_func import ColumnSearchIndex, name_terms
+from functions.export_func import build_export_query, stream_batches, ndjson_chunks, csv_chunks, arrow_type, arrow_ipc_chunks, write_parquet
+from functions.metadata_manage_func import metadata_dict, metadata_dict_from_inspector, reflect_metadata, reflect_metadata_sharded
+from apis import alpha
+from data.database import get_db
+from functions import join_job_func
+from functions.join_job_func import JoinJobQueue, JoinHeartbeat, create_join_job, fail_interrupted_joins, heartbeat, instance_id, job_datetime
+from data.model import Base, Connections, SchemaCatalog, SchemaCatalogRefresh, ApiInstance
+from data.model import JobMetadata, JobExecutionStatus, TransformationMetadata, TransformationJobPair
+
+
+ROWS = [
+    {"id": 1, "name": "a", "score": 1.5, "created": datetime.date(2023, 1, 1)},
+    {"id": 2, "name": "a", "score": None, "created": datetime.date(2023, 1, 2)},
+    {"id": 3, "name": "b", "score": 3.0, "created": datetime.date(2023, 1, 3)},
+    {"id": 4, "name": "b", "score": 4.5, "created": datetime.date(2023, 1, 4)},
+    {"id": 5, "name": "c", "score": 5.0, "created": datetime.date(2023, 1, 5)},
+]
+
+
+@pytest.fixture
+def source():
+    engine = create_engine("sqlite://")
+    metadata = MetaData()
+    source_table = Table("items", metadata,
+                         Column("id", types.Integer, primary_key=True),
+                         Column("name", types.String(10)),
+                         Column("score", types.Float),
+                         Column("created", types.Date))
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(source_table.insert(), ROWS)
+    with engine.connect() as connection:
+        yield connection, source_table
+    engine.dispose()
+
+
+# Function to run a select of the ids of the rows matching the where clauses
+def matching_ids(connection, source_table, clauses, order_by=None):
+    query = select(source_table.c.id).where(*clauses).order_by(*(order_by or [source_table.c.id]))
+    return [row[0] for row in connection.execute(query)]
+
+
+
+def test_cursor_round_trip():
+    data = {"after": [3, "b"], "offset": 0}
+    cursor = encode_cursor(data)
+    assert "/" not in cursor and "+" not in cursor
+    assert decode_cursor(cursor) == data
+
+
+def test_cursor_encodes_dates_as_strings():
+    assert decode_cursor(encode_cursor({"after": [datetime.date(2023, 1, 5)]})) == {"after": ["2023-01-05"]}
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", encode_cursor([1, 2]), encode_cursor("text"), ""])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+
+
+@pytest.mark.parametrize("column_type, value, expected", [
+    (types.Integer(), "3", 3),
+    (types.Integer(), 2.0, 2),
+    (types.Integer(), None, None),
+    (types.Float(), "1.5", 1.5),
+    (types.String(), 7, "7"),
+    (types.Boolean(), "yes", True),
+    (types.Boolean(), "false", False),
+    (types.Date(), "2023-01-05", datetime.date(2023, 1, 5)),
+    (types.DateTime(), "2023-01-05T10:30:00", datetime.datetime(2023, 1, 5, 10, 30)),
+])
+def test_coerce_value(column_type, value, expected):
+    assert coerce_value(column_type, value) == expected
+
+
+@pytest.mark.parametrize("column_type, value", [
+    (types.Integer(), 1.5),
+    (types.Integer(), float("inf")),
+    (types.Integer(), "abc"),
+    (types.Date(), "05/01/2023"),
+    (types.Numeric(), "abc"),
+])
+def test_coerce_value_rejects_invalid_values(column_type, value):
+    with pytest.raises(ValueError, match="Invalid value"):
+        coerce_value(column_type, value)
+
+
+
+@pytest.mark.parametrize("filters, expected", [
+    ([], [1, 2, 3, 4, 5]),
+    ([{"column": "name", "op": "eq", "value": "a"}], [1, 2]),
+    ([{"column": "name", "op": "ne", "value": "a"}], [3, 4, 5]),
+    ([{"column": "id", "op": "gt", "value": "3"}], [4, 5]),
+    ([{"column": "id", "op": "le", "value": 2}], [1, 2]),
+    ([{"column": "score", "op": "is_null"}], [2]),
+    ([{"column": "score", "op": "not_null"}, {"column": "name", "op": "eq", "value": "b"}], [3, 4]),
+    ([{"column": "id", "op": "between", "value": [2, 4]}], [2, 3, 4]),
+    ([{"column": "name", "op": "in", "value": ["a", "c"]}], [1, 2, 5]),
+    ([{"column": "created", "op": "ge", "value": "2023-01-04"}], [4, 5]),
+])
+def test_build_filter_clauses(source, filters, expected):
+    connection, source_table = source
+    assert matching_ids(connection, source_table, build_filter_clauses(source_table, filters)) == expected
+
+
+@pytest.mark.parametrize("column_filter, message", [
+    ({"column": "id", "op": "between", "value": [1]}, "needs a list of two values"),
+    ({"column": "id", "op": "in", "value": []}, "needs a list of values"),
+    ({"column": "id", "op": "eq", "value": None}, "use is_null"),
+    ({"column": "id", "op": "like", "value": "a"}, "Unknown filter operator"),
+    ({"column": "id", "op": "eq", "value": 1.5}, "Invalid value"),
+])
+def test_build_filter_clauses_rejects_invalid_filters(source, column_filter, message):
+    _, source_table = source
+    with pytest.raises(ValueError, match=message):
+        build_filter_clauses(source_table, [column_filter])
+
+
+
+def test_build_seek_clause_single_key(source):
+    connection, source_table = source
+    keys = [source_table.c.id]
+    assert matching_ids(connection, source_table, [build_seek_clause(keys, ["2"], [False])]) == [3, 4, 5]
+    assert matching_ids(connection, source_table, [build_seek_clause(keys, [4], [True])],
+                        order_by=[source_table.c.id.desc()]) == [3, 2, 1]
+
+
+def test_build_seek_clause_composite_key(source):
+    connection, source_table = source
+    keys = [source_table.c.name, source_table.c.id]
+    order_by = [source_table.c.name, source_table.c.id]
+    assert matching_ids(connection, source_table, [build_seek_clause(keys, ["a", 2], [False, False])], order_by) == [3, 4, 5]
+    assert matching_ids(connection, source_table, [build_seek_clause(keys, ["b", 3], [False, False])], order_by) == [4, 5]
+
+
+def test_build_seek_clause_mixed_directions(source):
+    connection, source_table = source
+    keys = [source_table.c.name, source_table.c.id]
+    order_by = [source_table.c.name, source_table.c.id.desc()]
+    # name ascending, id descending: a 2, a 1, b 4, b 3, c 5
+    assert matching_ids(connection, source_table, [build_seek_clause(keys, ["a", 2], [False, True])], order_by) == [1, 4, 3, 5]
+    assert matching_ids(connection, source_table, [build_seek_clause(keys, ["b", 4], [False, True])], order_by) == [3, 5]
+
+
+# Function to read a page of the items table through read_page, with caches of its own
+@pytest.fixture
+def read_items(source, monkeypatch):
+    monkeypatch.setattr(alpha, "reflection_cache", TTLCache())
+    monkeypatch.setattr(alpha, "row_count_cache", TTLCache())
+    connection, _ = source
+    source_connection = Connections(connection_id=3)
+
+    def read_items(table="items", **pagination):
+        return alpha.read_page(source_connection, connection, table, alpha.PaginationParams(**pagination))
+    return read_items
+
+
+def test_read_page_numbers_cursor_pages(read_items):
+    pages = [read_items(use_cursor=True, per_page=2)]
+    while pages[-1]["next_cursor"]:
+        pages.append(read_items(per_page=2, cursor=pages[-1]["next_cursor"]))
+    assert [row[0] for page in pages for row in page["table_values"]] == [1, 2, 3, 4, 5]
+    assert [page["pagination"] for page in pages] == ["keyset"] * 3
+    assert [page["page"] for page in pages] == [1, 2, 3]
+    assert pages[1]["page_details"] == "Page 2 of 3 pages, with 2 content/page out of 5 contents"
+
+
+def test_read_page_numbers_offset_cursor_pages(source, read_items):
+    connection, _ = source
+    # Tables without a key are paged by OFFSET
+    connection.exec_driver_sql("CREATE TABLE notes AS SELECT id, name FROM items")
+    first = read_items("notes", use_cursor=True, per_page=2, order_by=[{"column": "name", "direction": "desc"}])
+    second = read_items("notes", per_page=2, cursor=first["next_cursor"], order_by=[{"column": "name", "direction": "desc"}])
+    assert [page["pagination"] for page in (first, second)] == ["offset"] * 2
+    assert [page["page"] for page in (first, second)] == [1, 2]
+    page = read_items("notes", per_page=2, cursor=encode_cursor({"offset": 4}))
+    assert (page["page"], page["next_cursor"]) == (3, None)
+
+
+def test_read_page_rejects_cursor_on_nullable_order(read_items):
+    with pytest.raises(HTTPException) as rejected:
+        read_items(use_cursor=True, order_by=[{"column": "score", "direction": "asc"}])
+    assert rejected.value.status_code == 400
+    assert "score" in rejected.value.detail
+    # Not null key columns can be ordered by
+    page = read_items(use_cursor=True, per_page=2, order_by=[{"column": "id", "direction": "desc"}])
+    assert [row[0] for row in page["table_values"]] == [5, 4]
+
+
+def test_read_page_raises_out_of_range(read_items):
+    with pytest.raises(HTTPException) as out_of_range:
+        read_items(page=4, per_page=2)
+    assert out_of_range.value.status_code == 404
+    with pytest.raises(HTTPException) as empty:
+        read_items(filters=[{"column": "name", "op": "eq", "value": "z"}])
+    assert empty.value.status_code == 404
+
+
+
+# Source table of the sampling tests with an integer key, read through the columns of the table data APIs
+@pytest.fixture
+def sample_source():
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE events (id INTEGER PRIMARY KEY, kind VARCHAR(10))")
+        connection.execute(text("INSERT INTO events VALUES (:id, :kind)"), [{"id": number, "kind": f"k{number % 3}"} for number in range(1, 1001)])
+    with engine.connect() as connection:
+        columns = inspect(connection).get_columns("events")
+        yield connection, source_table("events", columns), columns
+    engine.dispose()
+
+
+def test_sample_rows_reads_small_tables_whole(sample_source):
+    connection, source, _ = sample_source
+    rows, details = sample_rows(connection, source, ["id"], 2000, key="id", total_rows=1000)
+    assert (details["method"], len(rows)) == ("all", 1000)
+
+
+def test_sample_rows_key_range_is_repeatable(sample_source):
+    connection, source, _ = sample_source
+    first, details = sample_rows(connection, source, ["kind"], 50, key="id", seed=7, total_rows=1000)
+    second, _ = sample_rows(connection, source, ["kind"], 50, key="id", seed=7, total_rows=1000)
+    assert (details["method"], details["seed"]) == ("key_range", 7)
+    # Runs after close points overlap, so a few rows less than the target may come back
+    assert 40 <= len(first) <= 50
+    assert first == second
+    with pytest.raises(ValueError):
+        sample_rows(connection, source, ["kind"], 50, method="system")
+
+
+# Postgres connection recording the queries it runs, SYSTEM samples of 1% of the table count sampled_rows
+class FakePostgresConnection:
+
+    dialect = postgresql.dialect()
+
+    def __init__(self, sampled_rows, rows):
+        self.sampled_rows = sampled_rows
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, query):
+        sql = str(query.compile(dialect=self.dialect, compile_kwargs={"literal_binds": True}))
+        self.queries.append(sql)
+        result = type("Result", (), {})()
+        result.scalar = lambda: self.sampled_rows
+        result.fetchall = lambda: self.rows
+        return result
+
+
+@pytest.mark.parametrize("sampled_rows, percent", [(5000, 0.004), (0, 100.0)])
+def test_tablesample_without_estimate_samples_pages(sample_source, sampled_rows, percent):
+    _, source, _ = sample_source
+    connection = FakePostgresConnection(sampled_rows, [(number,) for number in range(30)])
+    rows, details = sample_rows(connection, source, ["id"], 10, seed=3)
+    # The size of the table is estimated from 1% of its pages, and the sample is drawn from the sampled rows
+    assert details["method"] == "system"
+    assert (details["estimated_rows"], details["percent"]) == (sampled_rows * 100, percent)
+    assert "count(*)" in connection.queries[0] and "TABLESAMPLE system(1.0) REPEATABLE (3)" in connection.queries[0]
+    assert f"TABLESAMPLE system({percent})" in connection.queries[1]
+    assert not any("random()" in query or "setseed" in query for query in connection.queries)
+    assert len(rows) == 10
+
+
+def test_profile_table_full_scan(source):
+    connection, items = source
+    columns = inspect(connection).get_columns("items")
+    profile = profile_table(connection, source_table("items", columns), columns)
+    assert (profile["row_count"], profile["sampled"], profile["sampling"]) == (5, False, None)
+    score = profile["columns"][2]
+    assert (score["null_count"], score["distinct_count"], score["min"], score["max"]) == (1, 4, 1.5, 5.0)
+    assert score["top_values"] is None
+
+
+def test_profile_table_sample(sample_source):
+    connection, source, columns = sample_source
+    profile = profile_table(connection, source, columns, key="id", total_rows=1000, sample=True, seed=1, with_top_values=True)
+    # The sample target is larger than the table, so it is read whole
+    assert profile["sampled"] and profile["sampling"]["method"] == "all"
+    kind = profile["columns"][1]
+    assert (profile["row_count"], kind["distinct_count"], kind["min"], kind["max"]) == (1000, 3, "k0", "k2")
+    assert kind["top_values"][0] == {"value": "k1", "count": 334}
+
+
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(ttl_seconds=60)
+    cache.set((1, "a"), "value")
+    cache.set((1, "b"), "expired", ttl_seconds=-1)
+    assert cache.get((1, "a")) == "value"
+    assert cache.get((1, "b")) is None
+    assert cache.invalidate_connection(1) == 2
+    assert cache.get((1, "a")) is None
+
+
+def test_ttl_cache_single_flight_threads():
+    cache = TTLCache()
+    calls = []
+    results = []
+    start = threading.Barrier(8)
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.2)
+        return "value"
+
+    def request():
+        start.wait()
+        results.append(cache.get_or_load((1, "key"), loader))
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ["value"] * 8
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["waits"] == 7
+
+
+def test_ttl_cache_single_flight_shares_errors():
+    cache = TTLCache()
+    loading = threading.Event()
+    errors = []
+
+    def loader():
+        loading.set()
+        time.sleep(0.2)
+        raise RuntimeError("load failed")
+
+    def request():
+        try:
+            cache.get_or_load((1, "key"), loader)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=request)
+    leader.start()
+    loading.wait()
+    waiter = threading.Thread(target=request)
+    waiter.start()
+    leader.join()
+    waiter.join()
+    assert errors == ["load failed", "load failed"]
+    # A failed load is not cached, the next request loads again
+    assert cache.get_or_load((1, "key"), lambda: "value") == "value"
+
+
+def test_ttl_cache_single_flight_async():
+    cache = TTLCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "value"
+
+    async def requests():
+        return await asyncio.gather(*[cache.get_or_load_async((1, "key"), loader) for _ in range(8)])
+
+    assert asyncio.run(requests()) == ["value"] * 8
+    assert len(calls) == 1
+
+
+def test_ttl_cache_refresh_reloads():
+    cache = TTLCache()
+    cache.set((1, "key"), "old")
+    assert cache.get_or_load((1, "key"), lambda: "new") == "old"
+    assert cache.get_or_load((1, "key"), lambda: "new", refresh=True) == "new"
+
+
+
+def test_result_cache_evicts_least_recently_used():
+    value = "x" * 100
+    size = len('"' + value + '"')
+    cache = ResultCache(max_entries=10, max_bytes=size * 3)
+    for key in ("a", "b", "c"):
+        assert cache.set((1, key), value)
+    assert cache.get((1, "a")) == value # a is now the most recently used
+    assert cache.set((1, "d"), value)
+    assert cache.get((1, "b")) is None
+    assert cache.get((1, "a")) == value
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == size * 3
+
+
+def test_result_cache_drops_expired_entries_first():
+    cache = ResultCache(max_entries=2)
+    cache.set((1, "expired"), "value", ttl_seconds=-1)
+    cache.set((1, "a"), "value")
+    cache.set((1, "b"), "value")
+    assert cache.get((1, "a")) == "value"
+    assert cache.get((1, "b")) == "value"
+    assert cache.stats()["evictions"] == 0
+    assert cache.stats()["entries"] == 2
+
+
+def test_result_cache_rejects_too_large_values():
+    cache = ResultCache(max_bytes=10)
+    assert cache.set((1, "small"), "ok")
+    assert not cache.set((1, "large"), "x" * 100)
+    assert cache.get((1, "large")) is None
+    assert cache.stats()["too_large"] == 1
+    cache.invalidate_connection(1)
+    assert cache.stats()["bytes"] == 0
+
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, JSON_MEDIA_TYPE),
+    ("", JSON_MEDIA_TYPE),
+    ("*/*", JSON_MEDIA_TYPE),
+    ("application/json", JSON_MEDIA_TYPE),
+    ("application/msgpack", MSGPACK_MEDIA_TYPE),
+    ("application/x-msgpack", MSGPACK_MEDIA_TYPE),
+    ("Application/Vnd.Msgpack", MSGPACK_MEDIA_TYPE),
+    ("application/json, application/msgpack", JSON_MEDIA_TYPE),
+    ("application/msgpack, application/json", MSGPACK_MEDIA_TYPE),
+    ("application/json;q=0.5, application/msgpack", MSGPACK_MEDIA_TYPE),
+    ("application/msgpack;q=0, application/json;q=0.1", JSON_MEDIA_TYPE),
+    ("application/msgpack;q=abc", JSON_MEDIA_TYPE),
+    ("text/html, application/msgpack; q=0.9", MSGPACK_MEDIA_TYPE),
+])
+def test_negotiate_media_type(accept, expected):
+    assert negotiate_media_type(accept) == expected
+
+
+
+@pytest.mark.parametrize("upstream, downstream, expected", [
+    (False, False, "orders"),
+    (True, False, "+orders"),
+    (False, True, "orders+"),
+    (True, True, "+orders+"),
+])
+def test_model_selector(upstream, downstream, expected):
+    assert model_selector("orders", upstream=upstream, downstream=downstream) == expected
+
+
+def test_dbt_workers_run_in_long_lived_processes():
+    workers = DbtWorkerPool(max_workers=1)
+    try:
+        pid = workers.run(os.getpid)
+        assert pid != os.getpid()
+        assert workers.run(os.getpid) == pid
+    finally:
+        workers.shutdown()
+
+
+def test_dbt_workers_restart_after_a_worker_died():
+    workers = DbtWorkerPool(max_workers=1)
+    try:
+        with pytest.raises(BrokenProcessPool):
+            workers.run(os._exit, 1)
+        assert workers.run(os.getpid) != os.getpid()
+    finally:
+        workers.shutdown()
+
+
+def test_dbt_args_give_each_target_its_own_target_path(monkeypatch, tmp_path):
+    monkeypatch.setenv("DBT_PROFILES_PATH", str(tmp_path / "profiles.yml"))
+    args = dbt_args("run", "/project", target="id_3")
+    assert args[:5] == ["run", "--project-dir", "/project", "--log-path", os.path.join("/project", "logs")]
+    assert args[args.index("--profiles-dir") + 1] == str(tmp_path)
+    # The target is passed per run instead of being written to profiles.yml, with partial parsing state of its own
+    assert args[args.index("--target") + 1] == "id_3"
+    assert args[args.index("--target-path") + 1] == os.path.join("target", "id_3")
+    monkeypatch.delenv("DBT_PROFILES_PATH")
+    assert "--target" not in dbt_args("parse", "/project") and "--profiles-dir" not in dbt_args("parse", "/project")
+
+
+# dbt project with a nested model, a macro, and the partial parsing state of one target
+@pytest.fixture
+def dbt_project(tmp_path, monkeypatch):
+    monkeypatch.setenv("DBT_WORKSPACE_DIR", str(tmp_path))
+    project_dir = tmp_path / "project"
+    (project_dir / "models" / "staging").mkdir(parents=True)
+    (project_dir / "macros").mkdir()
+    (project_dir / "target" / "id_1").mkdir(parents=True)
+    (project_dir / "logs").mkdir()
+    (project_dir / "dbt_project.yml").write_text("name: project\n")
+    (project_dir / "models" / "staging" / "orders.sql").write_text("select 1")
+    (project_dir / "macros" / "cents.sql").write_text("{% macro cents() %}{% endmacro %}")
+    (project_dir / "target" / "id_1" / "partial_parse.msgpack").write_bytes(b"state 1")
+    return project_dir
+
+
+def test_dbt_workspace_isolates_the_models_of_a_run(dbt_project):
+    with dbt_workspace(str(dbt_project), target="id_1") as workspace, dbt_workspace(str(dbt_project), target="id_1") as other:
+        workspace = pathlib.Path(workspace)
+        assert (workspace / "dbt_project.yml").read_text() == "name: project\n"
+        assert (workspace / "macros").is_symlink()
+        # Models are real directories with links to the model files, so the run can add models of its own
+        assert not (workspace / "models" / "staging").is_symlink()
+        assert (workspace / "models" / "staging" / "orders.sql").read_text() == "select 1"
+        (workspace / "models" / "join_1.sql").write_text("select 2")
+        assert not (dbt_project / "models" / "join_1.sql").exists()
+        assert not (pathlib.Path(other) / "models" / "join_1.sql").exists()
+        # Each workspace starts from the partial parsing state of the target, with logs of its own
+        assert (workspace / "target" / "id_1" / "partial_parse.msgpack").read_bytes() == b"state 1"
+        assert not (workspace / "target").is_symlink() and not (workspace / "logs").exists()
+    assert not workspace.exists()
+
+
+def test_dbt_workspace_saves_partial_parsing_state(dbt_project):
+    with dbt_workspace(str(dbt_project), target="id_2") as workspace:
+        state = pathlib.Path(workspace) / "target" / "id_2" / "partial_parse.msgpack"
+        assert not state.exists()
+        state.write_bytes(b"state 2")
+    assert (dbt_project / "target" / "id_2" / "partial_parse.msgpack").read_bytes() == b"state 2"
+    assert (dbt_project / "target" / "id_1" / "partial_parse.msgpack").read_bytes() == b"state 1"
+    assert sorted(path.name for path in (dbt_project / "target" / "id_2").iterdir()) == ["partial_parse.msgpack"]
+
+
+
+# Function to wait until a number of requests wait for a slot of a connection of the bulkhead
+def wait_for_queue(bulkhead, connection_id, depth, timeout=5):
+    deadline = time.monotonic() + timeout
+    while bulkhead.stats()["connections"][connection_id]["queue_depth"] < depth:
+        assert time.monotonic() < deadline, "requests did not queue"
+        time.sleep(0.005)
+
+
+def test_bulkhead_rejects_when_queue_is_full():
+    bulkhead = SourceBulkhead(max_in_flight=1, max_queue=0, queue_timeout=5)
+    with bulkhead.admit(1):
+        with pytest.raises(AdmissionRejected) as rejected:
+            with bulkhead.admit(1):
+                pass
+        assert rejected.value.status_code == 429
+        assert rejected.value.headers["Retry-After"] == "1"
+        # Other connections have slots of their own
+        with bulkhead.admit(2):
+            pass
+    stats = bulkhead.stats()["connections"][1]
+    assert stats["rejected_queue_full"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_bulkhead_rejects_after_queue_timeout():
+    bulkhead = SourceBulkhead(max_in_flight=1, max_queue=1, queue_timeout=0.1)
+    with bulkhead.admit(1):
+        started = time.monotonic()
+        with pytest.raises(AdmissionRejected) as rejected:
+            with bulkhead.admit(1):
+                pass
+        assert time.monotonic() - started >= 0.1
+        assert rejected.value.status_code == 503
+    stats = bulkhead.stats()["connections"][1]
+    assert stats["rejected_timeout"] == 1
+    assert stats["queue_depth"] == 0
+    with bulkhead.admit(1):
+        assert bulkhead.stats()["connections"][1]["in_flight"] == 1
+
+
+def test_bulkhead_admits_waiters_in_arrival_order():
+    bulkhead = SourceBulkhead(max_in_flight=1, max_queue=5, queue_timeout=5)
+    admitted = []
+
+    def request(index):
+        with bulkhead.admit(1):
+            admitted.append(index)
+
+    threads = []
+    with bulkhead.admit(1):
+        for index in range(4):
+            thread = threading.Thread(target=request, args=(index,))
+            thread.start()
+            threads.append(thread)
+            wait_for_queue(bulkhead, 1, index + 1)
+    for thread in threads:
+        thread.join()
+    assert admitted == [0, 1, 2, 3]
+    assert bulkhead.stats()["connections"][1]["admitted"] == 5
+
+
+def test_bulkhead_async_waiters_share_the_queue():
+    bulkhead = SourceBulkhead(max_in_flight=1, max_queue=2, queue_timeout=5)
+    admitted = []
+
+    async def request(index):
+        async with bulkhead.admit_async(1):
+            admitted.append(index)
+            await asyncio.sleep(0.01)
+
+    async def requests():
+        async with bulkhead.admit_async(1):
+            waiting = [asyncio.create_task(request(index)) for index in range(2)]
+            while bulkhead.stats()["connections"][1]["queue_depth"] < 2:
+                await asyncio.sleep(0.005)
+            with pytest.raises(AdmissionRejected) as rejected:
+                async with bulkhead.admit_async(1):
+                    pass
+            assert rejected.value.status_code == 429
+        await asyncio.gather(*waiting)
+
+    asyncio.run(requests())
+    assert admitted == [0, 1]
+    assert bulkhead.stats()["connections"][1]["in_flight"] == 0
+
+
+def test_bulkhead_higher_limit_admits_waiters():
+    bulkhead = SourceBulkhead(max_in_flight=1, max_queue=5, queue_timeout=5)
+    admitted = threading.Event()
+
+    def request():
+        with bulkhead.admit(1):
+            admitted.set()
+
+    with bulkhead.admit(1):
+        thread = threading.Thread(target=request)
+        thread.start()
+        wait_for_queue(bulkhead, 1, 1)
+        bulkhead.set_limits(1, max_in_flight=2)
+        assert admitted.wait(5)
+    thread.join()
+    assert bulkhead.get_limits(1)["max_in_flight"] == 2
+
+
+
+
+# Registry of engines on SQLite files, one file per connection named after its host
+class SQLiteEnginePoolRegistry(EnginePoolRegistry):
+
+    def __init__(self, directory, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+
+    def _engine_url(self, connection):
+        return f"sqlite:///{self.directory / connection.host}.db"
+
+
+def source_connection(connection_id, host="source"):
+    return Connections(connection_id=connection_id, source="postgres", host=host, port="5432", user="user", password="", database="source")
+
+
+def test_engine_registry_reuses_and_evicts_engines(tmp_path):
+    registry = SQLiteEnginePoolRegistry(tmp_path, max_engines=2, idle_seconds=0)
+    first = registry.get_engine(source_connection(1))
+    assert registry.get_engine(source_connection(1)) is first
+    registry.get_engine(source_connection(2))
+    # Connection 1 was used last, so connection 2 is the least recently used one
+    registry.get_engine(source_connection(1))
+    registry.get_engine(source_connection(3))
+    stats = registry.stats()
+    assert sorted(stats["engines"]) == [1, 3]
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (2, 3, 1)
+
+
+def test_engine_registry_replaces_engines_of_changed_connections(tmp_path):
+    registry = SQLiteEnginePoolRegistry(tmp_path, idle_seconds=0)
+    first = registry.get_engine(source_connection(1))
+    assert registry.get_engine(source_connection(1, host="moved")) is not first
+    registry.invalidate(1)
+    assert registry.stats()["invalidations"] == 2
+    assert registry.stats()["engines"] == {}
+
+
+def test_engine_registry_disposes_idle_engines(tmp_path, monkeypatch):
+    registry = SQLiteEnginePoolRegistry(tmp_path, idle_seconds=60)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    registry.get_engine(source_connection(1))
+    now += 61
+    registry.get_engine(source_connection(2))
+    stats = registry.stats()
+    assert sorted(stats["engines"]) == [2]
+    assert stats["idle_disposals"] == 1
+
+
+def test_engine_registry_connects_through_the_bulkhead(tmp_path):
+    registry = SQLiteEnginePoolRegistry(tmp_path, pool_size=1, idle_seconds=0)
+    source_bulkhead.set_limits(-1, max_in_flight=1, max_queue=0)
+    try:
+        with registry.connect(source_connection(-1)) as conn:
+            assert conn.exec_driver_sql("SELECT 1").scalar() == 1
+            with pytest.raises(AdmissionRejected):
+                with registry.connect(source_connection(-1)):
+                    pass
+        with registry.connect(source_connection(-1)):
+            pass
+    finally:
+        source_bulkhead.remove_connection(-1)
+    stats = registry.stats()
+    assert stats["checkouts"] == 2
+    assert stats["engines"][-1]["checked_out"] == 0
+    registry.dispose_all()
+
+
+
+
+# Driver error of a failed source query, with the error code of psycopg2 or PyMySQL
+class FakeDriverError(Exception):
+
+    def __init__(self, message, pgcode=None, errno=None):
+        super().__init__(*([errno, message] if errno is not None else [message]))
+        self.pgcode = pgcode
+
+
+@pytest.mark.parametrize("orig, timeout, cancel", [
+    (FakeDriverError("canceling statement due to statement timeout", pgcode="57014"), True, False),
+    (FakeDriverError("canceling statement due to user request", pgcode="57014"), False, True),
+    (FakeDriverError("Query execution was interrupted, maximum statement execution time exceeded", errno=3024), True, False),
+    (FakeDriverError("Query execution was interrupted", errno=1317), False, True),
+    (FakeDriverError("relation does not exist", pgcode="42P01"), False, False),
+])
+def test_query_error_classification(orig, timeout, cancel):
+    error = DBAPIError("SELECT 1", None, orig)
+    assert is_timeout_error(error) == timeout
+    assert is_cancel_error(error) == cancel
+
+
+@pytest.fixture
+def query_scope():
+    scope = QueryScope()
+    token = current_query_scope.set(scope)
+    yield scope
+    current_query_scope.reset(token)
+
+
+def test_query_timeout_of_request_connection_and_default(query_scope):
+    control = QueryControl(default_timeout_ms=1000)
+    control.set_timeout(1, 2000)
+    assert control._begin(1) == (query_scope, 2000)
+    assert control._begin(2) == (query_scope, 1000)
+    query_scope.timeout_ms = 500
+    assert control._begin(1) == (query_scope, 500)
+    assert control.stats()["connections"][1]["queries"] == 2
+
+
+def test_query_control_translates_timeouts_and_cancels(query_scope):
+    control = QueryControl(default_timeout_ms=1000)
+    engine = create_engine("sqlite://")
+    with engine.connect() as conn:
+        with pytest.raises(StatementTimeout) as timeout:
+            with control.control(1, conn):
+                raise DBAPIError("SELECT 1", None, FakeDriverError("canceling statement due to statement timeout", pgcode="57014"))
+        assert timeout.value.status_code == 504
+        # A cancelled query is only reported as QueryCancelled once the request was cancelled
+        user_cancel = FakeDriverError("canceling statement due to user request", pgcode="57014")
+        with pytest.raises(DBAPIError):
+            with control.control(1, conn):
+                raise DBAPIError("SELECT 1", None, user_cancel)
+        query_scope.cancel()
+        with pytest.raises(QueryCancelled):
+            with control.control(1, conn):
+                pass
+    stats = control.stats()["connections"][1]
+    assert (stats["queries"], stats["timeouts"]) == (2, 1)
+
+
+def test_query_scope_cancels_outside_its_lock(query_scope, monkeypatch):
+    cancelling = threading.Event()
+    release = threading.Event()
+
+    def slow_cancel_query(entry):
+        cancelling.set()
+        assert release.wait(5)
+        return True
+
+    monkeypatch.setattr(query_control_func, "cancel_query", slow_cancel_query)
+    engine = create_engine("sqlite://")
+    with engine.connect() as first, engine.connect() as second:
+        registration = query_scope.register(1, first)
+        thread = threading.Thread(target=query_scope.cancel)
+        thread.start()
+        assert cancelling.wait(5)
+        # Other queries of the request register and unregister while the cancel is running
+        started = time.monotonic()
+        other = query_scope.register(2, second)
+        query_scope.unregister(other)
+        assert time.monotonic() - started < 1
+        # The cancelled connection is only released once its cancel is done
+        unregistered = threading.Event()
+        unregister = threading.Thread(target=lambda: (query_scope.unregister(registration), unregistered.set()))
+        unregister.start()
+        assert not unregistered.wait(0.1)
+        release.set()
+        assert unregistered.wait(5)
+        thread.join()
+        unregister.join()
+
+
+
+
+# Async registry on a SQLite file through aiosqlite, the async driver of the tests
+class SQLiteAsyncEnginePoolRegistry(AsyncEnginePoolRegistry):
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+
+    def _engine_url(self, connection):
+        return self.url
+
+    # aiosqlite engines default to NullPool
+    def _create_engine(self, url):
+        self._loop = asyncio.get_running_loop()
+        return create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=self.pool_size, max_overflow=self.max_overflow, pool_timeout=self.pool_timeout)
+
+
+@pytest.fixture
+def async_registry(tmp_path):
+    pytest.importorskip("aiosqlite")
+    engine = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE items (id INTEGER PRIMARY KEY)")
+        conn.exec_driver_sql("INSERT INTO items VALUES (1), (2), (3)")
+    engine.dispose()
+    return SQLiteAsyncEnginePoolRegistry(f"sqlite+aiosqlite:///{tmp_path / 'source.db'}", idle_seconds=0)
+
+
+def test_async_registry_queries_through_the_bulkhead(async_registry):
+    connection = Connections(connection_id=-19, source="postgres", host="localhost", port="5432", user="user", password="", database="source")
+
+    async def query():
+        async with async_registry.connect(connection) as conn:
+            assert source_bulkhead.stats()["connections"][-19]["in_flight"] == 1
+            return (await conn.exec_driver_sql("SELECT count(*) FROM items")).scalar()
+
+    async def queries():
+        counts = await asyncio.gather(*[query() for _ in range(3)])
+        # The engine is created once and reused by the other requests
+        stats = async_registry.stats()
+        async_registry.dispose_all()
+        await asyncio.gather(*list(async_registry._dispose_tasks))
+        return counts, stats
+
+    source_bulkhead.set_limits(-19, max_in_flight=1, max_queue=5)
+    try:
+        counts, stats = asyncio.run(queries())
+    finally:
+        source_bulkhead.remove_connection(-19)
+    assert counts == [3, 3, 3]
+    assert (stats["misses"], stats["hits"], stats["checkouts"]) == (1, 2, 3)
+
+
+def test_async_registry_rejects_queries_of_a_cancelled_request(async_registry, query_scope):
+    connection = Connections(connection_id=-20, source="postgres", host="localhost", port="5432", user="user", password="", database="source")
+
+    async def query():
+        async with async_registry.connect(connection) as conn:
+            await conn.exec_driver_sql("SELECT 1")
+        query_scope.cancel()
+        try:
+            with pytest.raises(QueryCancelled):
+                async with async_registry.connect(connection) as conn:
+                    await conn.exec_driver_sql("SELECT 1")
+        finally:
+            async_registry.dispose_all()
+            await asyncio.gather(*list(async_registry._dispose_tasks))
+
+    asyncio.run(query())
+    # The slot of the rejected query was released
+    assert source_bulkhead.stats()["connections"][-20]["in_flight"] == 0
+
+
+
+
+# Metadata database with one source connection, in a file so that sessions of other threads see the same data
+@pytest.fixture
+def metadata_sessions(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'metadata.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with session_factory() as db:
+        db.add(Connections(connection_id=1, connection_name="source", source="postgres", host="localhost",
+                           user="user", port="5432", database="source"))
+        db.commit()
+    yield session_factory
+    engine.dispose()
+
+
+@pytest.fixture
+def source_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'source.db'}", connect_args={"check_same_thread": False})
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE customers (id INTEGER PRIMARY KEY, name VARCHAR(50) NOT NULL)"))
+        connection.execute(text("CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customers(id))"))
+    yield engine
+    engine.dispose()
+
+
+def test_refresh_catalog_stores_only_changes(metadata_sessions, source_engine):
+    with metadata_sessions() as db, source_engine.connect() as source_connection:
+        first = refresh_catalog(db, 1, source_connection)
+        assert sorted(first.changes["added"]) == ["customers", "orders"]
+        assert load_catalog(db, 1)["tables"] == ["customers", "orders"]
+
+        source_connection.execute(text("ALTER TABLE customers ADD COLUMN email VARCHAR(100)"))
+        source_connection.execute(text("DROP TABLE orders"))
+        source_connection.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        source_connection.commit()
+        second = refresh_catalog(db, 1, source_connection)
+        assert refresh_summary(second)["tables"] == 2
+        assert refresh_summary(second)["added"] == ["items"]
+        assert refresh_summary(second)["removed"] == ["orders"]
+        assert refresh_summary(second)["changed"] == ["customers"]
+        assert "email" in load_catalog(db, 1)["metadata"]["customers"]["columns"]
+
+        third = refresh_catalog(db, 1, source_connection)
+        assert third.changes == {"added": {}, "removed": {}, "changed": {}}
+        assert third.table_count == 2
+        assert load_catalog(db, 1)["tables"] == ["customers", "items"]
+        assert load_catalog(db, 1, schema="other") is None
+
+
+def test_catalog_diff(metadata_sessions, source_engine):
+    with metadata_sessions() as db, source_engine.connect() as source_connection:
+        first = refresh_catalog(db, 1, source_connection)
+        source_connection.execute(text("ALTER TABLE customers ADD COLUMN email VARCHAR(100)"))
+        source_connection.execute(text("DROP TABLE orders"))
+        source_connection.commit()
+        second = refresh_catalog(db, 1, source_connection)
+        source_connection.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        source_connection.commit()
+        third = refresh_catalog(db, 1, source_connection)
+
+        diff = catalog_diff(db, first, third)
+        assert list(diff["added"]) == ["items"]
+        assert list(diff["removed"]) == ["orders"]
+        assert list(diff["changed"]) == ["customers"]
+        assert list(diff["changed"]["customers"]["added_columns"]) == ["email"]
+        assert diff["changed"]["customers"]["removed_columns"] == {}
+
+        diff = catalog_diff(db, second, third)
+        assert list(diff["added"]) == ["items"]
+        assert diff["removed"] == {} and diff["changed"] == {}
+
+        # A table removed and added again with the same metadata did not change between the refreshes
+        source_connection.execute(text("DROP TABLE items"))
+        source_connection.commit()
+        fourth = refresh_catalog(db, 1, source_connection)
+        source_connection.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        source_connection.commit()
+        fifth = refresh_catalog(db, 1, source_connection)
+        assert list(fourth.changes["removed"]) == ["items"]
+        diff = catalog_diff(db, third, fifth)
+        assert diff["added"] == {} and diff["removed"] == {} and diff["changed"] == {}
+
+
+def test_concurrent_refreshes_store_each_table_once(metadata_sessions, source_engine):
+    with source_engine.begin() as connection:
+        for number in range(20):
+            connection.execute(text(f"CREATE TABLE extra_{number} (id INTEGER PRIMARY KEY, value VARCHAR(10))"))
+    errors = []
+    start = threading.Barrier(4)
+
+    def refresh():
+        try:
+            with metadata_sessions() as db, source_engine.connect() as source_connection:
+                start.wait()
+                refresh_catalog(db, 1, source_connection)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=refresh) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with metadata_sessions() as db:
+        assert db.query(SchemaCatalog).count() == 22
+        refreshes = db.query(SchemaCatalogRefresh).order_by(SchemaCatalogRefresh.refresh_id).all()
+        assert [len(catalog_refresh.changes["added"]) for catalog_refresh in refreshes] == [22, 0, 0, 0]
+
+
+def test_catalog_rows_are_unique_per_table(metadata_sessions):
+    with metadata_sessions() as db:
+        for _ in range(2):
+            db.add(SchemaCatalog(connection_id=1, schema_name="main", table_name="customers", fingerprint="x", table_metadata={}))
+        with pytest.raises(IntegrityError):
+            db.commit()
+
+
+
+
+@pytest.fixture
+def index():
+    search_index = ColumnSearchIndex()
+    search_index.update_tables(1, {
+        "customers": {"columns": {"customer_id": {"type": "INTEGER"}, "name": {"type": "VARCHAR(50)"}, "score": {"type": "FLOAT"}}},
+        "orders": {"columns": {"order_id": {"type": "INTEGER"}, "customer_id": {"type": "INTEGER"}}},
+    })
+    search_index.update_tables(2, {
+        "customer_scores": {"columns": {"customer_ref": {"type": "BIGINT"}, "score": {"type": "NUMERIC"}}},
+    }, schema="analytics")
+    return search_index
+
+
+# Function to get (connection_id, table, column) of the results of a search
+def found(result):
+    return [(item["connection_id"], item["table"], item["column"]) for item in result["results"]]
+
+
+def test_name_terms():
+    assert name_terms("Customer_ID") == {"customer_id", "customer", "id"}
+
+
+def test_search_exact(index):
+    assert sorted(found(index.search("customer_id", mode="exact"))) == [(1, "customers", "customer_id"), (1, "orders", "customer_id")]
+    assert found(index.search("customer", mode="exact", kind="table")) == [(2, "customer_scores", None)]
+    assert found(index.search("custom", mode="exact", kind="all")) == []
+
+
+def test_search_prefix_ranks_shorter_terms_first(index):
+    result = index.search("cust", kind="all")
+    assert result["results"][0]["matched_term"] == "customer"
+    assert {(item["table"], item["column"]) for item in result["results"]} == {
+        ("customers", "customer_id"), ("orders", "customer_id"), ("customer_scores", "customer_ref"),
+        ("customers", None), ("customer_scores", None),
+    }
+    assert found(index.search("custx")) == []
+
+
+@pytest.mark.parametrize("query", ["scroe", "socre", "custmer_id", "customr"])
+def test_search_fuzzy_matches_typos(index, query):
+    result = index.search(query, mode="fuzzy", connection_id=1)
+    assert result["results"]
+    assert result["results"][0]["column"] in ("score", "customer_id")
+
+
+def test_search_fuzzy_threshold(index):
+    assert found(index.search("scroe", mode="fuzzy", threshold=0.5)) == []
+    scores = [item["score"] for item in index.search("custmer", mode="fuzzy", kind="all")["results"]]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_search_filters(index):
+    assert found(index.search("score", connection_id=2)) == [(2, "customer_scores", "score")]
+    assert found(index.search("score", type_filter="float")) == [(1, "customers", "score")]
+    assert sorted(found(index.search("customer", kind="table"))) == [(1, "customers", None), (2, "customer_scores", None)]
+    assert [item["schema"] for item in index.search("customer_ref")["results"]] == ["analytics"]
+
+
+def test_search_filters_before_limit():
+    search_index = ColumnSearchIndex()
+    search_index.update_tables(1, {"wide": {"columns": {f"cust_{number}": {"type": "INTEGER"} for number in range(500)}}})
+    search_index.update_tables(2, {"narrow": {"columns": {"cust_zz": {"type": "INTEGER"}}}})
+    assert found(search_index.search("cust_", connection_id=2, limit=5)) == [(2, "narrow", "cust_zz")]
+    assert found(search_index.search("cust_zx", mode="fuzzy", connection_id=2, limit=1)) == [(2, "narrow", "cust_zz")]
+    assert len(search_index.search("cust", limit=5)["results"]) == 5
+
+
+def test_search_index_updates(index):
+    index.update_tables(1, {"orders": {"columns": {"order_ref": {"type": "INTEGER"}}}})
+    assert found(index.search("order_id")) == []
+    assert found(index.search("order_ref")) == [(1, "orders", "order_ref")]
+    index.remove_tables(1, ["orders"])
+    assert found(index.search("order", kind="all")) == []
+    index.update_tables(2, {"other": {"columns": {"value": {"type": "TEXT"}}}}, schema="analytics", replace_schema=True)
+    assert found(index.search("customer_ref")) == []
+    index.remove_connection(2)
+    assert index.stats()["tables"] == 1
+    assert found(index.search("value")) == []
+
+
+
+
+SCHEMA_DDL = [
+    "CREATE TABLE customers (id INTEGER PRIMARY KEY, code VARCHAR(10) NOT NULL, name VARCHAR(50), "
+    "score NUMERIC(10, 2) DEFAULT 0, CONSTRAINT uq_customers_code UNIQUE (code), CONSTRAINT ck_score CHECK (score >= 0))",
+    "CREATE TABLE orders (id INTEGER, line INTEGER, customer_id INTEGER NOT NULL REFERENCES customers(id), "
+    "note TEXT DEFAULT 'none', PRIMARY KEY (id, line))",
+    "CREATE INDEX ix_orders_customer ON orders (customer_id, line)",
+    "CREATE TABLE logs (message TEXT)",
+] + [f"CREATE TABLE shard_{number} (id INTEGER PRIMARY KEY, parent_id INTEGER REFERENCES customers(id))" for number in range(7)]
+
+
+@pytest.fixture
+def schema_engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        for statement in SCHEMA_DDL:
+            connection.execute(text(statement))
+    yield engine
+    engine.dispose()
+
+
+# Function to build the dictionary of metadata_dict from reflected Table objects, with the changes made by
+# metadata_dict_from_inspector: readable constraint types and the server default of each column as default
+def reflected_metadata_dict(bind, only=None):
+    metadata = MetaData()
+    metadata.reflect(bind=bind, only=only)
+    expected = metadata_dict(metadata.tables.values())
+    for table in metadata.tables.values():
+        table_info = expected[table.name]
+        for column in table.columns:
+            server_default = column.server_default.arg.text if column.server_default is not None else None
+            table_info["columns"][column.name]["default"] = server_default
+        for constraint_info, constraint in zip(table_info["constraints"], table.constraints):
+            if isinstance(constraint, CheckConstraint):
+                constraint_info["type"] = f"CheckConstraint({constraint.sqltext})"
+            else:
+                constraint_info["type"] = f"{type(constraint).__name__}({', '.join(column.name for column in constraint.columns)})"
+    return normalized_metadata_dict(expected)
+
+
+# Function to sort the lists of a metadata dictionary whose order comes from sets of Table objects
+def normalized_metadata_dict(metadata):
+    for table_info in metadata.values():
+        table_info["constraints"] = sorted(table_info["constraints"], key=lambda constraint: (constraint["type"], str(constraint["name"])))
+        table_info["indexes"] = sorted(table_info["indexes"], key=lambda index: index["name"])
+    return metadata
+
+
+def test_metadata_dict_from_inspector_matches_reflection(schema_engine):
+    expected = reflected_metadata_dict(schema_engine)
+    actual = normalized_metadata_dict(metadata_dict_from_inspector(inspect(schema_engine)))
+    assert actual == expected
+    assert actual["orders"]["primary_keys"] == ["id", "line"]
+    assert actual["orders"]["foreign_keys"] == [{"column": "customer_id", "foreign_table": "customers", "foreign_column": "id"}]
+    assert actual["orders"]["indexes"] == [{"name": "ix_orders_customer", "columns": ["customer_id", "line"]}]
+    assert actual["orders"]["columns"]["note"] == {"type": "TEXT", "nullable": True, "default": "'none'"}
+    assert {"name": "uq_customers_code", "type": "UniqueConstraint(code)"} in actual["customers"]["constraints"]
+    assert actual["logs"]["constraints"] == [{"name": None, "type": "PrimaryKeyConstraint()"}]
+
+
+def test_metadata_dict_from_inspector_filter_names(schema_engine):
+    expected = reflected_metadata_dict(schema_engine, only=["orders", "logs"])
+    # Reflection also loads the tables referenced by foreign keys, the filtered inspector does not
+    expected.pop("customers")
+    actual = normalized_metadata_dict(metadata_dict_from_inspector(inspect(schema_engine), filter_names=["orders", "logs"]))
+    assert actual == expected
+
+
+def test_reflect_metadata_selects_tables(schema_engine):
+    with schema_engine.connect() as connection:
+        assert reflect_metadata(connection, prefixes=["shard_"])["tables"] == [f"shard_{number}" for number in range(7)]
+        assert reflect_metadata(connection, tables=["logs", "missing"])["tables"] == ["logs"]
+        assert reflect_metadata(connection, tables=["missing"]) == {"tables": [], "metadata": {}}
+
+
+@pytest.mark.parametrize("shard_size", [1, 3, 100])
+def test_reflect_metadata_sharded_matches_single_pass(tmp_path, shard_size):
+    engine = create_engine(f"sqlite:///{tmp_path / 'schema.db'}", connect_args={"check_same_thread": False})
+    with engine.begin() as connection:
+        for statement in SCHEMA_DDL:
+            connection.execute(text(statement))
+    with engine.connect() as connection:
+        single = reflect_metadata(connection)
+    connections = []
+
+    def connect():
+        connections.append(1)
+        return engine.connect()
+
+    sharded = reflect_metadata_sharded(connect, max_workers=3, shard_size=shard_size)
+    assert sharded == single
+    # One connection lists the tables, then one per shard
+    assert len(connections) == 1 + math.ceil(len(single["tables"]) / shard_size)
+    assert reflect_metadata_sharded(connect, prefixes=["shard_"], shard_size=2)["tables"] == [f"shard_{number}" for number in range(7)]
+    engine.dispose()
+
+
+
+
+def test_stream_batches(source):
+    connection, source_table = source
+    batches = list(stream_batches(connection, build_export_query(source_table, ["id", "name"]), batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [tuple(row) for batch in batches for row in batch] == [(row["id"], row["name"]) for row in ROWS]
+    assert [len(batch) for batch in stream_batches(connection, build_export_query(source_table, ["id"], limit=3), batch_size=2)] == [2, 1]
+
+
+def test_ndjson_chunks():
+    batches = [[(1, "a", datetime.date(2023, 1, 1))], [], [(2, None, None), (3, "c\n", datetime.date(2023, 1, 3))]]
+    chunks = list(ndjson_chunks(["id", "name", "created"], batches))
+    assert len(chunks) == 3
+    lines = "".join(chunks).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": 1, "name": "a", "created": "2023-01-01"},
+        {"id": 2, "name": None, "created": None},
+        {"id": 3, "name": "c\n", "created": "2023-01-03"},
+    ]
+
+
+def test_csv_chunks():
+    batches = [[(1, "a,b")], [(2, 'say "hi"'), (3, None)]]
+    chunks = list(csv_chunks(["id", "name"], batches))
+    # Header first, then one chunk per batch
+    assert chunks[0] == "id,name\r\n"
+    assert len(chunks) == 3
+    assert list(csv.reader(io.StringIO("".join(chunks)))) == [["id", "name"], ["1", "a,b"], ["2", 'say "hi"'], ["3", ""]]
+    assert list(csv_chunks(["id"], [])) == ["id\r\n"]
+
+
+
+EXPORT_COLUMNS = [
+    {"name": "id", "type": types.Integer(), "nullable": False},
+    {"name": "amount", "type": types.Numeric(10, 2)},
+    {"name": "big", "type": types.Numeric(60, 0)},
+    {"name": "created", "type": types.DateTime()},
+    {"name": "opens", "type": mysql.TIME()},
+    {"name": "closes", "type": postgresql.TIME()},
+    {"name": "attributes", "type": types.JSON()},
+    {"name": "payload", "type": types.LargeBinary()},
+    {"name": "active", "type": types.Boolean()},
+]
+
+EXPORT_ROWS = [
+    (1, decimal.Decimal("10.50"), 10 ** 50, datetime.datetime(2023, 1, 5, 10, 30), datetime.timedelta(hours=9),
+     datetime.time(17, 0), {"tier": "gold"}, memoryview(b"abc"), True),
+    (2, None, None, None, datetime.timedelta(hours=-1, minutes=30), None, None, None, None),
+    (3, decimal.Decimal("0.01"), 1, datetime.datetime(2023, 1, 6), datetime.timedelta(hours=838, minutes=59),
+     datetime.time(0, 0), [1, 2], b"", False),
+]
+
+
+@pytest.mark.parametrize("column_type, expected", [
+    (types.Integer(), pyarrow.int64()),
+    (types.Numeric(10, 2), pyarrow.decimal128(10, 2)),
+    (types.Numeric(60, 0), pyarrow.string()),
+    (types.DateTime(timezone=True), pyarrow.timestamp("us", tz="UTC")),
+    (types.Date(), pyarrow.date32()),
+    (postgresql.TIME(), pyarrow.time64("us")),
+    (mysql.TIME(), pyarrow.duration("us")),
+    (types.Interval(), pyarrow.duration("us")),
+    (types.JSON(), pyarrow.string()),
+    (types.String(20), pyarrow.string()),
+])
+def test_arrow_type(column_type, expected):
+    assert arrow_type(pyarrow, column_type)[0] == expected
+
+
+# Function to read the rows back from an Arrow table, with the values the converters store
+def arrow_rows(table):
+    return [tuple(row.values()) for row in table.to_pylist()]
+
+
+EXPECTED_ARROW_ROWS = [
+    (1, decimal.Decimal("10.50"), str(10 ** 50), datetime.datetime(2023, 1, 5, 10, 30), datetime.timedelta(hours=9),
+     datetime.time(17, 0), '{"tier": "gold"}', b"abc", True),
+    (2, None, None, None, datetime.timedelta(hours=-1, minutes=30), None, None, None, None),
+    (3, decimal.Decimal("0.01"), "1", datetime.datetime(2023, 1, 6), datetime.timedelta(hours=838, minutes=59),
+     datetime.time(0, 0), "[1, 2]", b"", False),
+]
+
+
+def test_arrow_ipc_chunks():
+    chunks = list(arrow_ipc_chunks(EXPORT_COLUMNS, [EXPORT_ROWS[:2], [], EXPORT_ROWS[2:]]))
+    table = pyarrow.ipc.open_stream(b"".join(chunks)).read_all()
+    assert table.schema.field("id").nullable is False
+    assert arrow_rows(table) == EXPECTED_ARROW_ROWS
+
+
+def test_write_parquet(tmp_path):
+    path = tmp_path / "export.parquet"
+    stats = write_parquet(EXPORT_COLUMNS, [EXPORT_ROWS[:1], EXPORT_ROWS[1:]], str(path))
+    assert stats["rows"] == 3
+    assert stats["bytes"] == path.stat().st_size
+    assert arrow_rows(pyarrow.parquet.read_table(path)) == EXPECTED_ARROW_ROWS
+
+
+
+
+JOIN_DETAIL = {"make": "table", "type": "inner", "new_table": "customer_orders", "table1": "customers", "table1_col": ["id"],
+               "table2": "orders", "table2_col": ["customer_id"], "match_pair": {"id": "customer_id"}}
+
+
+def test_create_join_job(metadata_sessions):
+    with metadata_sessions() as db:
+        job = create_join_job(db, JOIN_DETAIL)
+        transformation = db.get(TransformationMetadata, job["transformation_id"])
+        assert transformation.status == "In Progress"
+        assert transformation.transformation_detail["instance_id"] == instance_id()
+        assert db.get(JobExecutionStatus, job["job_execution_id"]).job_id == job["job_id"]
+        assert db.query(TransformationJobPair).count() == 1
+
+
+def test_create_join_job_leaves_no_rows_on_failure(metadata_sessions, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError("insert failed")
+
+    monkeypatch.setattr(join_job_func, "TransformationJobPair", fail)
+    with metadata_sessions() as db:
+        with pytest.raises(RuntimeError):
+            create_join_job(db, JOIN_DETAIL)
+    with metadata_sessions() as db:
+        assert db.query(JobMetadata).count() == 0
+        assert db.query(JobExecutionStatus).count() == 0
+        assert db.query(TransformationMetadata).count() == 0
+
+
+def test_join_job_queue_rejects_when_full(metadata_sessions, monkeypatch):
+    release = threading.Event()
+    started = []
+
+    def run_join_job(session_factory, job, connection_id, join_detail, select):
+        started.append(job["transformation_id"])
+        release.wait(5)
+
+    monkeypatch.setattr(join_job_func, "run_join_job", run_join_job)
+    queue = JoinJobQueue(metadata_sessions, max_workers=1, max_queue=2)
+    with metadata_sessions() as db:
+        jobs = [queue.submit(db, 1, JOIN_DETAIL, "customer_orders") for _ in range(3)]
+        with pytest.raises(HTTPException) as rejected:
+            queue.submit(db, 1, JOIN_DETAIL, "customer_orders")
+        assert rejected.value.status_code == 429
+        assert rejected.value.headers["Retry-After"] == "5"
+        # The rejected join created no rows
+        assert db.query(TransformationMetadata).count() == 3
+    assert queue.stats()["pending"] == 3
+    assert queue.stats()["rejected"] == 1
+    release.set()
+    deadline = time.monotonic() + 5
+    while queue.stats()["pending"]:
+        assert time.monotonic() < deadline, "joins did not finish"
+        time.sleep(0.01)
+    queue.shutdown()
+    # Joins run in the order they were submitted
+    assert started == [job["transformation_id"] for job in jobs]
+    assert queue.stats()["submitted"] == 3
+
+
+def test_fail_interrupted_joins_keeps_joins_of_live_instances(metadata_sessions):
+    with metadata_sessions() as db:
+        heartbeat(db)
+        own = create_join_job(db, JOIN_DETAIL)
+        live = create_join_job(db, JOIN_DETAIL)
+        stopped = create_join_job(db, JOIN_DETAIL)
+        unknown = create_join_job(db, JOIN_DETAIL)
+        db.add(ApiInstance(instance_id="other:1:live", started_datetime=job_datetime(), heartbeat_datetime=job_datetime()))
+        db.add(ApiInstance(instance_id="other:2:stopped", started_datetime=job_datetime() - timedelta(hours=1),
+                           heartbeat_datetime=job_datetime() - timedelta(minutes=10)))
+        for job, owner in [(live, "other:1:live"), (stopped, "other:2:stopped"), (unknown, "gone:3:removed")]:
+            transformation = db.get(TransformationMetadata, job["transformation_id"])
+            transformation.transformation_detail = {**transformation.transformation_detail, "instance_id": owner}
+        db.commit()
+
+        assert fail_interrupted_joins(db, stale_seconds=90) == 2
+        statuses = {job["transformation_id"]: db.get(TransformationMetadata, job["transformation_id"]).status
+                    for job in (own, live, stopped, unknown)}
+        assert statuses == {own["transformation_id"]: "In Progress", live["transformation_id"]: "In Progress",
+                            stopped["transformation_id"]: "Failed", unknown["transformation_id"]: "Failed"}
+        assert db.get(JobExecutionStatus, stopped["job_execution_id"]).status == "Failed"
+        # Stale instances are removed
+        assert sorted(row.instance_id for row in db.query(ApiInstance)) == sorted(["other:1:live", instance_id()])
+        assert fail_interrupted_joins(db, stale_seconds=90) == 0
+
+
+def test_join_heartbeat_registers_and_removes_instance(metadata_sessions):
+    join_heartbeat = JoinHeartbeat(metadata_sessions, interval_seconds=60)
+    join_heartbeat.start()
+    deadline = time.monotonic() + 5
+    with metadata_sessions() as db:
+        while db.get(ApiInstance, instance_id()) is None:
+            assert time.monotonic() < deadline, "no heartbeat"
+            time.sleep(0.01)
+            db.expire_all()
+    join_heartbeat.stop()
+    with metadata_sessions() as db:
+        assert db.get(ApiInstance, instance_id()) is None
+
+
+
+
+# Client of the connection APIs on the test metadata database, with a profiles.yml of its own
+@pytest.fixture
+def connection_client(metadata_sessions, monkeypatch, tmp_path):
+    profiles_path = tmp_path / "profiles.yml"
+    profiles_path.write_text(yaml.safe_dump({"postgres_dbt": {"outputs": {}, "target": "dev"}}))
+    monkeypatch.setenv("DBT_PROFILES_PATH", str(profiles_path))
+
+    def get_test_db():
+        with metadata_sessions() as db:
+            yield db
+
+    app = FastAPI()
+    app.include_router(alpha.router)
+    app.dependency_overrides[get_db] = get_test_db
+    with TestClient(app) as client:
+        yield client, profiles_path
+
+
+def new_connection(name, host="localhost"):
+    return {"connection_name": name, "source": "postgres", "host": host, "port": "5432", "user": "user", "password": "secret", "database": "source"}
+
+
+def fake_check(delay=0.0, running=None):
+    def check_source_connection(source, user, password, host, port, database, connect_timeout=10):
+        if running is not None:
+            running.append(1)
+            assert len(running) <= 2, "more checks than max_concurrency"
+        try:
+            time.sleep(delay)
+            if host == "unreachable":
+                raise RuntimeError("could not connect to server")
+            return 12.5
+        finally:
+            if running is not None:
+                running.pop()
+    return check_source_connection
+
+
+def test_bulk_connections_adds_valid_connections(connection_client, metadata_sessions, monkeypatch):
+    client, profiles_path = connection_client
+    running = []
+    monkeypatch.setattr(alpha, "check_source_connection", fake_check(0.05, running))
+    connections = [new_connection(f"source_{number}") for number in range(5)] + [new_connection("broken", host="unreachable")]
+    response = client.post("/connections/bulk", json={"connections": connections, "max_concurrency": 2})
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["validated"], body["valid"], body["added"]) == (6, 5, 5)
+    assert body["results"][5]["error"] == "could not connect to server"
+    assert "connection_id" not in body["results"][5]
+    ids = [result["connection_id"] for result in body["results"][:5]]
+    with metadata_sessions() as db:
+        assert sorted(connection.connection_id for connection in db.query(Connections) if connection.connection_name.startswith("source_")) == sorted(ids)
+    outputs = yaml.safe_load(profiles_path.read_text())["postgres_dbt"]["outputs"]
+    assert sorted(outputs) == sorted(f"id_{connection_id}" for connection_id in ids)
+
+
+def test_bulk_connections_validate_only(connection_client, metadata_sessions, monkeypatch):
+    client, _ = connection_client
+    monkeypatch.setattr(alpha, "check_source_connection", fake_check())
+    response = client.post("/connections/bulk", json={"connections": [new_connection("source_a")], "add": False})
+    assert response.json()["added"] == 0
+    with metadata_sessions() as db:
+        assert db.query(Connections).count() == 1
+
+
+def test_bulk_connections_adds_nothing_without_profiles(connection_client, metadata_sessions, monkeypatch):
+    client, profiles_path = connection_client
+    monkeypatch.setattr(alpha, "check_source_connection", fake_check())
+    profiles_path.write_text(yaml.safe_dump({"other_profile": {"outputs": {}}}))
+    response = client.post("/connections/bulk", json={"connections": [new_connection("source_a"), new_connection("source_b")]})
+    assert response.status_code == 500
+    assert "profiles.yml was not updated" in response.json()["detail"]
+    with metadata_sessions() as db:
+        # Only the connection of the fixture is left
+        assert db.query(Connections).count() == 1
@@ -0,0 +1,102 @@
+# Benchmark of dbt parse time over repeated joins, comparing the target written to profiles.yml
+# before every join (full parse each time) against the target given per invocation with its own
+# target path (partial parse of the join model only).
+#
+# Run from the project root:
+#   python -m benchmarks.bench_dbt_parse --joins 10 --models 200
+#   python -m benchmarks.bench_dbt_parse --joins 10 --models 200 --connections 1
+#
+# A copy of the dbt project is made in a temporary directory for each scenario, with synthetic
+# models added so the parse has some work to do. profiles.yml holds one postgres target per
+# connection, dbt parse does not connect to them.
+
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import yaml
+
+from functions.dbt_runner_func import dbt_args, DBT_PROJECT_DIR
+
+
+# Function to copy the dbt project and add synthetic models, each one referencing the previous one
+def create_project(directory, models):
+    project_dir = os.path.join(directory, "project")
+    shutil.copytree(DBT_PROJECT_DIR, project_dir, ignore=shutil.ignore_patterns("target", "logs", "dbt_packages"))
+    os.makedirs(os.path.join(project_dir, "models", "bench"))
+    for number in range(models):
+        query = "select 1 as id, 'name' as name" if not number else f"select id, name from {{{{ ref('bench_{number - 1}') }}}}"
+        with open(os.path.join(project_dir, "models", "bench", f"bench_{number}.sql"), "w") as model_file:
+            model_file.write(query)
+    return project_dir
+
+
+
+# Function to write profiles.yml with one target per connection, the way profiles.yml of the API looks
+def write_profiles(path, connections, target):
+    outputs = {
+        f"id_{number}": {"type": "postgres", "threads": 1, "host": "localhost", "port": 5432, "user": "bench",
+                         "pass": "bench", "dbname": f"bench_{number}", "schema": "public"}
+        for number in range(1, connections + 1)
+    }
+    with open(path, "w") as file:
+        yaml.dump({"postgres_dbt": {"outputs": outputs, "target": target}}, file, default_flow_style=False)
+
+
+
+# Function to run the joins of one scenario and time the parse of each of them
+def run_joins(runner_class, directory, models, joins, connections, rewrite_profiles):
+    project_dir = create_project(directory, models)
+    profiles_path = os.path.join(directory, "profiles.yml")
+    write_profiles(profiles_path, connections, "id_1")
+    os.environ["DBT_PROFILES_PATH"] = profiles_path
+
+    seconds = []
+    for join in range(joins):
+        target = f"id_{join % connections + 1}"
+        if rewrite_profiles:
+            write_profiles(profiles_path, connections, target)
+        model_path = os.path.join(project_dir, "models", f"join_{join}.sql")
+        with open(model_path, "w") as model_file:
+            model_file.write(f"select a.id, b.name from {{{{ ref('bench_0') }}}} a join {{{{ ref('bench_{models - 1}') }}}} b on a.id = b.id")
+        args = dbt_args("parse", project_dir) if rewrite_profiles else dbt_args("parse", project_dir, target=target)
+        start = time.perf_counter()
+        result = runner_class().invoke(args + ["--quiet"])
+        seconds.append(time.perf_counter() - start)
+        os.remove(model_path)
+        if not result.success:
+            raise RuntimeError(f"dbt parse failed: {result.exception}")
+    return seconds
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare dbt parse time over repeated joins")
+    parser.add_argument("--joins", type=int, default=10, help="Number of joins run in each scenario")
+    parser.add_argument("--models", type=int, default=200, help="Number of synthetic models in the project")
+    parser.add_argument("--connections", type=int, default=2, help="Number of connections the joins alternate between")
+    args = parser.parse_args()
+
+    from dbt.cli.main import dbtRunner
+
+    print(f"{args.joins} joins on a project with {args.models} models, alternating between {args.connections} connections")
+    print(f"{'scenario':<32}{'first s':>10}{'median s':>10}{'total s':>10}")
+    totals = {}
+    for name, rewrite_profiles in (("target written to profiles.yml", True), ("--target and own target path", False)):
+        directory = tempfile.mkdtemp()
+        try:
+            seconds = run_joins(dbtRunner, directory, args.models, args.joins, args.connections, rewrite_profiles)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        totals[name] = sum(seconds)
+        print(f"{name:<32}{seconds[0]:>10.3f}{statistics.median(seconds[1:] or seconds):>10.3f}{sum(seconds):>10.3f}")
+    before, after = totals.values()
+    print(f"Speedup over all joins: {before / after:.2f}x")
+
+
+
+if __name__ == "__main__":
+    main()
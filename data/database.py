@@ -1,11 +1,17 @@
+import os
+
+from dotenv import load_dotenv
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine, MetaData
 from sqlalchemy.orm import sessionmaker
 
+# Load environment variables from .env file
+load_dotenv()
+
 Base = declarative_base()
 
-# Create an MySQL database engine
-connection_string = "mysql+mysqlconnector://user:@localhost:3306/datapmi_project"
+# Create an MySQL database engine, DATABASE_URL overrides the connection string (eg: sqlite:// for the tests)
+connection_string = os.getenv('DATABASE_URL', "mysql+mysqlconnector://user:@localhost:3306/datapmi_project")
 engine = create_engine(connection_string, echo=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
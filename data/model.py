@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text, DECIMAL, Enum, func, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text, DECIMAL, Enum, func, JSON, UniqueConstraint
 from sqlalchemy.orm import relationship, mapper, clear_mappers
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -24,6 +24,18 @@ class Connections(Base):
 
 
 
+# Table to store per source connection limits, defaults from the environment are used when a value is null
+class ConnectionSettings(Base):
+    __tablename__ = 'connectionSettings'
+
+    connection_id = Column(Integer, ForeignKey('connections.connection_id'), primary_key=True)
+    max_in_flight = Column(Integer) # Maximum number of concurrent queries on the source
+    max_queue = Column(Integer) # Maximum number of requests waiting for a free slot
+    queue_timeout_seconds = Column(DECIMAL(10, 3)) # Time a request waits for a free slot before it is rejected
+    statement_timeout_ms = Column(Integer) # Statement timeout of queries on the source, 0 for none
+
+
+
 
 
 
@@ -172,3 +184,49 @@ class IngestionPipelinePair(Base):
 
     ingestion_id = Column(Integer, ForeignKey('ingestionMetadata.ingestion_id'), primary_key=True)
     pipeline_execution_id = Column(Integer, ForeignKey('pipelineExecutionStatus.pipeline_execution_id'), primary_key=True)
+
+
+
+
+
+
+
+
+
+# Table to store reflected metadata of each table in a source connection
+class SchemaCatalog(Base):
+    __tablename__ = 'schemaCatalog'
+
+    catalog_id = Column(Integer, primary_key=True, autoincrement=True)
+    connection_id = Column(Integer, ForeignKey('connections.connection_id'), nullable=False)
+    schema_name = Column(String(255)) # Null for the default schema of the connection
+    table_name = Column(String(255), nullable=False)
+    fingerprint = Column(String(64), nullable=False) # Checksum of the table DDL, to find changed tables
+    table_metadata = Column(JSON, nullable=False) # Same as the table entry of metadata_dict
+    refreshed_datetime = Column(DateTime, server_default=func.now(), nullable=False)
+
+    __table_args__ = (UniqueConstraint('connection_id', 'schema_name', 'table_name', name='uq_schema_catalog_table'),)
+
+
+
+# Table to store each refresh of the schema catalog with the changes it found
+class SchemaCatalogRefresh(Base):
+    __tablename__ = 'schemaCatalogRefresh'
+
+    refresh_id = Column(Integer, primary_key=True, autoincrement=True)
+    connection_id = Column(Integer, ForeignKey('connections.connection_id'), nullable=False)
+    schema_name = Column(String(255))
+    refresh_datetime = Column(DateTime, server_default=func.now(), nullable=False)
+    table_count = Column(Integer, nullable=False) # Tables in the schema after the refresh, their fingerprints are on schemaCatalog
+    changes = Column(JSON, nullable=False) # {"added": {table: metadata}, "removed": {table: metadata}, "changed": {table: {"before": metadata, "after": metadata}}}
+
+
+
+# Table to store the running processes of the API, each one updates its heartbeat while it runs.
+# Joins record the instance running them, so that only joins of stopped instances are failed.
+class ApiInstance(Base):
+    __tablename__ = 'apiInstance'
+
+    instance_id = Column(String(255), primary_key=True) # host:pid:random suffix
+    started_datetime = Column(DateTime, nullable=False)
+    heartbeat_datetime = Column(DateTime, nullable=False)
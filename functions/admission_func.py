@@ -0,0 +1,277 @@
+# Functions for limiting concurrent queries on each source connection
+
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy import event
+
+from data.model import Connections, ConnectionSettings
+from functions.query_control_func import query_control
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+# Raised when a request gets no query slot on a source, 429 when the wait queue is full and 503 when the wait timed out
+class AdmissionRejected(HTTPException):
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": str(math.ceil(retry_after))})
+
+
+
+
+# Admission state of one source connection
+class _SourceState:
+
+    def __init__(self):
+        self.in_flight = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+
+
+
+# Request waiting in a worker thread for a query slot
+class _ThreadWaiter:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.abandoned = False
+
+    # Hand a freed slot to the waiter, called with the lock of the bulkhead held
+    def grant(self):
+        if self.abandoned:
+            return False
+        self.granted = True
+        self.event.set()
+        return True
+
+
+
+# Request waiting on the event loop for a query slot
+class _AsyncWaiter:
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+        self.abandoned = False
+
+    def grant(self):
+        if self.abandoned:
+            return False
+        self.granted = True
+        self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(True))
+        return True
+
+
+
+
+# Bulkhead of each source connection: at most max_in_flight queries run on a source at once,
+# and at most max_queue more requests wait for a slot, in arrival order, for up to queue_timeout
+# seconds. Requests beyond that are rejected at once instead of piling up on the database.
+# A freed slot is handed to the first waiter, which may wait in a worker thread (admit) or on
+# the event loop (admit_async). Limits can be set per connection, defaults are used for limits that are not set.
+class SourceBulkhead:
+
+    def __init__(self, max_in_flight=5, max_queue=20, queue_timeout=10):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._sources = {} # connection_id -> _SourceState
+        self._limits = {} # connection_id -> {"max_in_flight", "max_queue", "queue_timeout"} set for the connection
+
+
+    # Limits of a connection, caller must hold the lock
+    def _get_limits(self, connection_id):
+        limits = {"max_in_flight": self.max_in_flight, "max_queue": self.max_queue, "queue_timeout": self.queue_timeout}
+        limits.update({name: value for name, value in self._limits.get(connection_id, {}).items() if value is not None})
+        return limits
+
+
+    def get_limits(self, connection_id):
+        with self._lock:
+            return self._get_limits(connection_id)
+
+
+    # Set limits of a connection, None keeps the default
+    def set_limits(self, connection_id, max_in_flight=None, max_queue=None, queue_timeout=None):
+        with self._lock:
+            self._limits[connection_id] = {"max_in_flight": max_in_flight, "max_queue": max_queue, "queue_timeout": queue_timeout}
+            state = self._sources.get(connection_id)
+            if state is not None:
+                # A higher limit may let waiting requests in
+                while state.waiters and state.in_flight < self._get_limits(connection_id)["max_in_flight"]:
+                    if state.waiters.popleft().grant():
+                        state.in_flight += 1
+
+
+    def remove_connection(self, connection_id):
+        with self._lock:
+            self._limits.pop(connection_id, None)
+            state = self._sources.get(connection_id)
+            if state is not None and not state.in_flight and not state.waiters:
+                del self._sources[connection_id]
+
+
+    # Take a free slot or queue the waiter, returns the waiter when it has to wait. Caller must hold the lock.
+    def _enter(self, connection_id, make_waiter):
+        state = self._sources.get(connection_id)
+        if state is None:
+            state = self._sources[connection_id] = _SourceState()
+        limits = self._get_limits(connection_id)
+
+        # Requests already waiting go first
+        if not state.waiters and state.in_flight < limits["max_in_flight"]:
+            state.in_flight += 1
+            return state, limits, None
+        if len(state.waiters) >= limits["max_queue"]:
+            state.rejected_queue_full += 1
+            raise AdmissionRejected(429, f"Too many requests waiting for connection {connection_id}, "
+                                         f"{state.in_flight} queries running and {len(state.waiters)} waiting", 1)
+        waiter = make_waiter()
+        state.waiters.append(waiter)
+        state.queued += 1
+        return state, limits, waiter
+
+
+    # Settle a waiter after its wait ended, the slot counts as taken if it was granted. Caller must hold the lock.
+    def _settle(self, connection_id, state, limits, waiter):
+        if waiter.granted:
+            return
+        waiter.abandoned = True
+        state.waiters.remove(waiter)
+        state.rejected_timeout += 1
+        raise AdmissionRejected(503, f"No free query slot on connection {connection_id} "
+                                     f"within {limits['queue_timeout']} seconds", limits["queue_timeout"])
+
+
+    def _record_wait(self, state, started):
+        wait_ms = (time.perf_counter() - started) * 1000
+        state.admitted += 1
+        state.wait_total_ms += wait_ms
+        state.wait_max_ms = max(state.wait_max_ms, wait_ms)
+
+
+    # Give the slot to the first waiter, or free it
+    def _release(self, state):
+        with self._lock:
+            while state.waiters:
+                if state.waiters.popleft().grant():
+                    return
+            state.in_flight -= 1
+
+
+    # Hold a query slot of a connection while the block runs, waiting in the calling thread
+    @contextmanager
+    def admit(self, connection_id):
+        started = time.perf_counter()
+        with self._lock:
+            state, limits, waiter = self._enter(connection_id, _ThreadWaiter)
+        if waiter is not None:
+            waiter.event.wait(limits["queue_timeout"])
+            with self._lock:
+                self._settle(connection_id, state, limits, waiter)
+        with self._lock:
+            self._record_wait(state, started)
+        try:
+            yield
+        finally:
+            self._release(state)
+
+
+    # Hold a query slot of a connection while the block runs, waiting on the event loop
+    @asynccontextmanager
+    async def admit_async(self, connection_id):
+        started = time.perf_counter()
+        with self._lock:
+            state, limits, waiter = self._enter(connection_id, _AsyncWaiter)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), limits["queue_timeout"])
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                with self._lock:
+                    granted = waiter.granted
+                    waiter.abandoned = not granted
+                    if not granted:
+                        state.waiters.remove(waiter)
+                if granted:
+                    self._release(state)
+                raise
+            with self._lock:
+                self._settle(connection_id, state, limits, waiter)
+        with self._lock:
+            self._record_wait(state, started)
+        try:
+            yield
+        finally:
+            self._release(state)
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                "defaults": {"max_in_flight": self.max_in_flight, "max_queue": self.max_queue, "queue_timeout": self.queue_timeout},
+                "connections": {
+                    connection_id: {
+                        **self._get_limits(connection_id),
+                        "in_flight": state.in_flight,
+                        "queue_depth": len(state.waiters),
+                        "admitted": state.admitted,
+                        "queued": state.queued,
+                        "rejected_queue_full": state.rejected_queue_full,
+                        "rejected_timeout": state.rejected_timeout,
+                        "wait_avg_ms": round(state.wait_total_ms / state.admitted, 3) if state.admitted else 0.0,
+                        "wait_max_ms": round(state.wait_max_ms, 3),
+                    }
+                    for connection_id, state in self._sources.items()
+                },
+            }
+
+
+
+
+source_bulkhead = SourceBulkhead(
+    max_in_flight=int(os.getenv('SOURCE_MAX_IN_FLIGHT', os.getenv('SOURCE_POOL_SIZE', 5))),
+    max_queue=int(os.getenv('SOURCE_MAX_QUEUE', 20)),
+    queue_timeout=float(os.getenv('SOURCE_QUEUE_TIMEOUT_SECONDS', 10)),
+)
+
+
+# Function to set the bulkhead limits and statement timeout of a connection from its ConnectionSettings row
+def apply_connection_settings(settings):
+    source_bulkhead.set_limits(
+        settings.connection_id,
+        max_in_flight=settings.max_in_flight,
+        max_queue=settings.max_queue,
+        queue_timeout=float(settings.queue_timeout_seconds) if settings.queue_timeout_seconds is not None else None,
+    )
+    query_control.set_timeout(settings.connection_id, settings.statement_timeout_ms)
+
+
+# Function to load the limits of every connection with settings
+def load_connection_limits(db):
+    for settings in db.query(ConnectionSettings).all():
+        apply_connection_settings(settings)
+
+
+# Drop limits and state of a connection when the connection row is deleted
+@event.listens_for(Connections, "after_delete")
+def remove_connection_limits(mapper, db_connection, target):
+    source_bulkhead.remove_connection(target.connection_id)
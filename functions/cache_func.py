@@ -0,0 +1,300 @@
+# Functions for caching results of source connection queries
+
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.exc import MissingGreenlet
+from sqlalchemy.util import await_only
+
+from data.model import Connections
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+
+
+# Function to check if the calling thread is running an event loop
+def on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+
+# Result of a load that is being computed by another request. Requests in worker threads wait on done,
+# requests on an event loop wait on a future of their loop, resolved when the load finishes.
+class _InFlight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = [] # (loop, future) of requests waiting on an event loop
+
+
+    def add_waiter(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters.append((loop, future))
+        return future
+
+
+    # Wake every waiting request, called once the load is no longer in flight
+    def finish(self, waiters):
+        self.done.set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+
+
+# Cache with expiry time for each entry. Keys are tuples starting with the
+# connection_id so that all entries of one connection can be invalidated.
+# Concurrent misses for the same key wait for a single load (single-flight).
+class TTLCache:
+
+    def __init__(self, ttl_seconds=300, max_entries=256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "waits": 0, "invalidations": 0}
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._delete(next(iter(self._entries)))
+
+
+    # Remove one entry, called with the lock held
+    def _delete(self, key):
+        del self._entries[key]
+
+
+    # Find a cached value, or the load in flight for the key. Starts a load when there is none, returns
+    # (hit, value, in_flight, future, leader). Waiters on an event loop register their future here, under the lock,
+    # so the load can not finish between finding it and waiting on it.
+    def _lookup(self, key, refresh, wait_on_loop):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not refresh and entry is not None and entry[0] >= time.monotonic():
+                self._stats["hits"] += 1
+                self._entries.move_to_end(key)
+                return True, entry[1], None, None, False
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                in_flight = _InFlight()
+                self._in_flight[key] = in_flight
+                self._stats["misses"] += 1
+                return False, None, in_flight, None, True
+            self._stats["waits"] += 1
+            return False, None, in_flight, in_flight.add_waiter() if wait_on_loop else None, False
+
+
+    # Record the outcome of a load and wake the requests waiting on it
+    def _finish(self, key, in_flight, ttl_seconds, value=None, error=None):
+        if error is None:
+            in_flight.value = value
+            self.set(key, value, ttl_seconds=ttl_seconds)
+        else:
+            # A cancelled load is an error for the requests waiting on it, not a cancellation of them
+            in_flight.error = error if isinstance(error, Exception) else RuntimeError("Load of the cached value was cancelled")
+        with self._lock:
+            self._in_flight.pop(key, None)
+            waiters = list(in_flight.waiters)
+        in_flight.finish(waiters)
+
+
+    # Get a cached value or compute it with loader(), refresh=True skips the cached value.
+    # Concurrent misses wait for the load of the first one. On the event loop thread, from
+    # AsyncConnection.run_sync, the wait is on a future of the loop awaited through the greenlet of
+    # run_sync, so the loop keeps running the load the request is waiting on.
+    def get_or_load(self, key, loader, refresh=False, ttl_seconds=None):
+        hit, value, in_flight, future, leader = self._lookup(key, refresh, wait_on_loop=on_event_loop())
+        if hit:
+            return value
+
+        if not leader:
+            if future is None:
+                in_flight.done.wait()
+            else:
+                try:
+                    await_only(future)
+                except MissingGreenlet:
+                    # Code on the event loop outside of run_sync can not wait without blocking the loop, it loads the value itself
+                    value = loader()
+                    self.set(key, value, ttl_seconds=ttl_seconds)
+                    return value
+            return in_flight.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            self._finish(key, in_flight, ttl_seconds, error=e)
+            raise
+        self._finish(key, in_flight, ttl_seconds, value=value)
+        return value
+
+
+    # Get a cached value or compute it with the coroutine function loader, waiting on the event loop.
+    # Shares the loads in flight with get_or_load.
+    async def get_or_load_async(self, key, loader, refresh=False, ttl_seconds=None):
+        hit, value, in_flight, future, leader = self._lookup(key, refresh, wait_on_loop=True)
+        if hit:
+            return value
+
+        if not leader:
+            await future
+            return in_flight.result()
+
+        try:
+            value = await loader()
+        except BaseException as e:
+            self._finish(key, in_flight, ttl_seconds, error=e)
+            raise
+        self._finish(key, in_flight, ttl_seconds, value=value)
+        return value
+
+
+    # Remove every entry of a connection
+    def invalidate_connection(self, connection_id):
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == connection_id]
+            for key in keys:
+                self._delete(key)
+            self._stats["invalidations"] += 1
+        return len(keys)
+
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._delete(key)
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["ttl_seconds"] = self.ttl_seconds
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+
+
+# Cache of API results, bounded by their total size in bytes as well as by the number of entries.
+# The size of a result is the length of its JSON encoding. Expired entries are dropped first
+# when the cache is full, then the least recently used ones. max_bytes=0 disables the cache.
+class ResultCache(TTLCache):
+
+    def __init__(self, ttl_seconds=30, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self.max_bytes = max_bytes
+        self._sizes = {}
+        self._bytes = 0
+        self._stats.update({"evictions": 0, "too_large": 0})
+
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        size = len(json.dumps(value, default=str))
+        with self._lock:
+            if key in self._entries:
+                self._delete(key)
+            if size > self.max_bytes:
+                self._stats["too_large"] += 1
+                return False
+            self._entries[key] = (time.monotonic() + ttl_seconds, value)
+            self._sizes[key] = size
+            self._bytes += size
+            if len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                now = time.monotonic()
+                for expired in [entry_key for entry_key, entry in self._entries.items() if entry[0] < now]:
+                    self._delete(expired)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._delete(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+        return True
+
+
+    def _delete(self, key):
+        del self._entries[key]
+        self._bytes -= self._sizes.pop(key)
+
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats["bytes"] = self._bytes
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+
+
+# Cache for reflected schema metadata, keyed by (connection_id, schema)
+reflection_cache = TTLCache(
+    ttl_seconds=int(os.getenv('SOURCE_REFLECTION_TTL_SECONDS', 300)),
+    max_entries=int(os.getenv('SOURCE_REFLECTION_MAX_ENTRIES', 256)),
+)
+
+
+# Cache for exact row counts of source tables, keyed by (connection_id, table)
+row_count_cache = TTLCache(
+    ttl_seconds=int(os.getenv('SOURCE_ROW_COUNT_TTL_SECONDS', 30)),
+    max_entries=int(os.getenv('SOURCE_ROW_COUNT_MAX_ENTRIES', 1024)),
+)
+
+
+# Cache for pages of table data, keyed by (connection_id, table, request parameters)
+page_cache = ResultCache(
+    ttl_seconds=int(os.getenv('PAGE_CACHE_TTL_SECONDS', 30)),
+    max_entries=int(os.getenv('PAGE_CACHE_MAX_ENTRIES', 1024)),
+    max_bytes=int(os.getenv('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+)
+
+
+# Drop cached metadata, counts and pages whenever a connection row is updated or deleted
+@event.listens_for(Connections, "after_update")
+@event.listens_for(Connections, "after_delete")
+def invalidate_connection_cache(mapper, db_connection, target):
+    reflection_cache.invalidate_connection(target.connection_id)
+    row_count_cache.invalidate_connection(target.connection_id)
+    page_cache.invalidate_connection(target.connection_id)
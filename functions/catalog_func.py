@@ -0,0 +1,329 @@
+# Functions for the persisted schema catalog of source connections
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from dotenv import load_dotenv
+from sqlalchemy import text, func
+
+from data.database import SessionLocal
+from data.model import Connections, SchemaCatalog, SchemaCatalogRefresh
+from functions.engine_pool_func import engine_registry
+from functions.cache_func import reflection_cache, page_cache
+from functions.metadata_manage_func import reflect_metadata
+from functions.search_index_func import search_index
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+# Checksum of columns, constraints, indexes and comment of every table in one query
+POSTGRES_FINGERPRINT_QUERY = """
+SELECT cl.relname, md5(
+    coalesce((SELECT string_agg(a.attname || ':' || format_type(a.atttypid, a.atttypmod) || ':' || a.attnotnull::text
+                                || ':' || coalesce(pg_get_expr(d.adbin, d.adrelid), ''), ',' ORDER BY a.attnum)
+              FROM pg_attribute a LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+              WHERE a.attrelid = cl.oid AND a.attnum > 0 AND NOT a.attisdropped), '')
+    || '|' || coalesce((SELECT string_agg(co.conname || ':' || pg_get_constraintdef(co.oid), ',' ORDER BY co.conname)
+                        FROM pg_constraint co WHERE co.conrelid = cl.oid), '')
+    || '|' || coalesce((SELECT string_agg(pg_get_indexdef(i.indexrelid), ',' ORDER BY i.indexrelid)
+                        FROM pg_index i WHERE i.indrelid = cl.oid), '')
+    || '|' || coalesce(obj_description(cl.oid, 'pg_class'), '')
+)
+FROM pg_class cl JOIN pg_namespace n ON n.oid = cl.relnamespace
+WHERE n.nspname = COALESCE(:schema, current_schema()) AND cl.relkind IN ('r', 'p')
+"""
+
+MYSQL_FINGERPRINT_QUERY = """
+SELECT t.TABLE_NAME, MD5(CONCAT_WS('|',
+    (SELECT GROUP_CONCAT(CONCAT_WS(':', c.COLUMN_NAME, c.COLUMN_TYPE, c.IS_NULLABLE, IFNULL(c.COLUMN_DEFAULT, ''))
+                         ORDER BY c.ORDINAL_POSITION SEPARATOR ',')
+     FROM information_schema.COLUMNS c WHERE c.TABLE_SCHEMA = t.TABLE_SCHEMA AND c.TABLE_NAME = t.TABLE_NAME),
+    (SELECT GROUP_CONCAT(CONCAT_WS(':', s.INDEX_NAME, s.SEQ_IN_INDEX, s.COLUMN_NAME, s.NON_UNIQUE)
+                         ORDER BY s.INDEX_NAME, s.SEQ_IN_INDEX SEPARATOR ',')
+     FROM information_schema.STATISTICS s WHERE s.TABLE_SCHEMA = t.TABLE_SCHEMA AND s.TABLE_NAME = t.TABLE_NAME),
+    (SELECT GROUP_CONCAT(CONCAT_WS(':', k.CONSTRAINT_NAME, k.COLUMN_NAME, IFNULL(k.REFERENCED_TABLE_NAME, ''), IFNULL(k.REFERENCED_COLUMN_NAME, ''))
+                         ORDER BY k.CONSTRAINT_NAME, k.ORDINAL_POSITION SEPARATOR ',')
+     FROM information_schema.KEY_COLUMN_USAGE k WHERE k.TABLE_SCHEMA = t.TABLE_SCHEMA AND k.TABLE_NAME = t.TABLE_NAME),
+    t.TABLE_COMMENT
+))
+FROM information_schema.TABLES t
+WHERE t.TABLE_SCHEMA = COALESCE(:schema, DATABASE()) AND t.TABLE_TYPE = 'BASE TABLE'
+"""
+
+
+# Function to read a DDL checksum of every table in a schema from the source catalog.
+# Returns None for databases without a checksum query, their tables are fingerprinted after reflection.
+def table_fingerprints(connection, schema=None):
+    if connection.dialect.name == "postgresql":
+        query = POSTGRES_FINGERPRINT_QUERY
+    elif connection.dialect.name == "mysql":
+        # GROUP_CONCAT is cut at 1024 characters by default
+        connection.execute(text("SET SESSION group_concat_max_len = 1048576"))
+        query = MYSQL_FINGERPRINT_QUERY
+    else:
+        return None
+    rows = connection.execute(text(query), {"schema": schema}).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+
+# Function to fingerprint the reflected metadata of a table
+def metadata_fingerprint(table_metadata):
+    return hashlib.sha256(json.dumps(table_metadata, sort_keys=True, default=str).encode()).hexdigest()
+
+
+
+# Function to check whether a schema of a connection was ever stored in the catalog
+def catalog_exists(db, connection_id, schema=None):
+    return db.query(SchemaCatalogRefresh.refresh_id).filter(
+        SchemaCatalogRefresh.connection_id == connection_id,
+        SchemaCatalogRefresh.schema_name == schema,
+    ).first() is not None
+
+
+
+# Function to load table list and metadata dictionary of a schema from the catalog.
+# Returns None when the schema was never refreshed.
+def load_catalog(db, connection_id, schema=None):
+    if not catalog_exists(db, connection_id, schema):
+        return None
+    rows = db.query(SchemaCatalog).filter(
+        SchemaCatalog.connection_id == connection_id,
+        SchemaCatalog.schema_name == schema,
+    ).order_by(SchemaCatalog.table_name).all()
+    metadata = {row.table_name: row.table_metadata for row in rows}
+    return {"tables": list(metadata), "metadata": metadata}
+
+
+
+# Locks of the schemas being refreshed in this process, keyed by (connection_id, schema)
+_refresh_locks = {}
+_refresh_locks_lock = threading.Lock()
+
+
+# Function to get the lock serializing refreshes of one schema of a connection in this process
+def catalog_refresh_lock(connection_id, schema=None):
+    with _refresh_locks_lock:
+        return _refresh_locks.setdefault((connection_id, schema), threading.Lock())
+
+
+
+# Function to refresh the catalog of a schema, re-reflecting only tables whose fingerprint changed.
+# Refreshes of the same schema run one at a time: the refresher thread, API requests and other
+# processes of the API would otherwise store the same tables twice. Within a process they wait on a lock,
+# across processes on the row lock of the connection, held until the refresh is committed.
+def refresh_catalog(db, connection_id, source_connection, schema=None):
+    with catalog_refresh_lock(connection_id, schema):
+        try:
+            db.query(Connections).filter(Connections.connection_id == connection_id).with_for_update().first()
+            return _refresh_catalog(db, connection_id, source_connection, schema=schema)
+        except Exception:
+            db.rollback()
+            raise
+
+
+def _refresh_catalog(db, connection_id, source_connection, schema=None):
+    stored = {
+        row.table_name: row
+        for row in db.query(SchemaCatalog).filter(SchemaCatalog.connection_id == connection_id,
+                                                   SchemaCatalog.schema_name == schema).all()
+    }
+
+    fingerprints = table_fingerprints(source_connection, schema=schema)
+    if fingerprints is None:
+        reflected = reflect_metadata(source_connection, schema=schema)["metadata"]
+        fingerprints = {name: metadata_fingerprint(table_metadata) for name, table_metadata in reflected.items()}
+        changed_names = [name for name in fingerprints if name not in stored or stored[name].fingerprint != fingerprints[name]]
+    else:
+        changed_names = [name for name in fingerprints if name not in stored or stored[name].fingerprint != fingerprints[name]]
+        reflected = reflect_metadata(source_connection, schema=schema, tables=changed_names)["metadata"] if changed_names else {}
+
+    changes = {"added": {}, "removed": {}, "changed": {}}
+    for name in changed_names:
+        if name not in reflected:
+            # Dropped after the fingerprints were read
+            fingerprints.pop(name)
+            continue
+        row = stored.get(name)
+        if row is None:
+            db.add(SchemaCatalog(connection_id=connection_id, schema_name=schema, table_name=name,
+                                 fingerprint=fingerprints[name], table_metadata=reflected[name]))
+            changes["added"][name] = reflected[name]
+        else:
+            changes["changed"][name] = {"before": row.table_metadata, "after": reflected[name]}
+            row.fingerprint = fingerprints[name]
+            row.table_metadata = reflected[name]
+            row.refreshed_datetime = func.now()
+
+    for name, row in stored.items():
+        if name not in fingerprints:
+            changes["removed"][name] = row.table_metadata
+            db.delete(row)
+
+    # Fingerprints are kept on the catalog rows, the refresh only stores what changed
+    catalog_refresh = SchemaCatalogRefresh(connection_id=connection_id, schema_name=schema,
+                                           table_count=len(fingerprints), changes=changes)
+    db.add(catalog_refresh)
+    db.commit()
+    db.refresh(catalog_refresh)
+    return catalog_refresh
+
+
+
+# Function to refresh the catalog of a source connection, drop its cached metadata and update the search index
+def refresh_source_catalog(db, connection, schema=None):
+    with engine_registry.connect(connection) as source_connection:
+        catalog_refresh = refresh_catalog(db, connection.connection_id, source_connection, schema=schema)
+    reflection_cache.invalidate_connection(connection.connection_id)
+    if catalog_refresh.changes["added"] or catalog_refresh.changes["removed"] or catalog_refresh.changes["changed"]:
+        page_cache.invalidate_connection(connection.connection_id)
+
+    changes = catalog_refresh.changes
+    updated = dict(changes["added"])
+    updated.update({name: table_change["after"] for name, table_change in changes["changed"].items()})
+    search_index.update_tables(connection.connection_id, updated, schema=schema)
+    search_index.remove_tables(connection.connection_id, list(changes["removed"]), schema=schema)
+    return catalog_refresh
+
+
+
+# Function to summarize a refresh with table names only
+def refresh_summary(catalog_refresh):
+    return {
+        "refresh_id": catalog_refresh.refresh_id,
+        "connection_id": catalog_refresh.connection_id,
+        "schema": catalog_refresh.schema_name,
+        "refresh_datetime": catalog_refresh.refresh_datetime,
+        "tables": catalog_refresh.table_count,
+        "added": sorted(catalog_refresh.changes["added"]),
+        "removed": sorted(catalog_refresh.changes["removed"]),
+        "changed": sorted(catalog_refresh.changes["changed"]),
+    }
+
+
+
+# Function to compare two versions of the metadata of a table
+def table_metadata_diff(before, after):
+    before_columns = before.get("columns", {})
+    after_columns = after.get("columns", {})
+    diff = {
+        "added_columns": {name: after_columns[name] for name in after_columns if name not in before_columns},
+        "removed_columns": {name: before_columns[name] for name in before_columns if name not in after_columns},
+        "changed_columns": {
+            name: {"before": before_columns[name], "after": after_columns[name]}
+            for name in after_columns if name in before_columns and before_columns[name] != after_columns[name]
+        },
+    }
+    for key in ["primary_keys", "constraints", "indexes", "foreign_keys", "table_comment"]:
+        if before.get(key) != after.get(key):
+            diff[key] = {"before": before.get(key), "after": after.get(key)}
+    return diff
+
+
+
+# Function to build the schema diff between two refreshes of the same connection and schema.
+# Metadata of a table at each refresh is recovered from the changes stored by the refreshes in between,
+# tables without changes in between are the same at both refreshes.
+def catalog_diff(db, from_refresh, to_refresh):
+    between = db.query(SchemaCatalogRefresh).filter(
+        SchemaCatalogRefresh.connection_id == to_refresh.connection_id,
+        SchemaCatalogRefresh.schema_name == to_refresh.schema_name,
+        SchemaCatalogRefresh.refresh_id > from_refresh.refresh_id,
+        SchemaCatalogRefresh.refresh_id <= to_refresh.refresh_id,
+    ).order_by(SchemaCatalogRefresh.refresh_id).all()
+
+    before = {} # Metadata at from_refresh, from the first refresh after it touching the table, None if it did not exist
+    after = {} # Metadata at to_refresh, from the last refresh touching the table, None if it was removed
+    for catalog_refresh in between:
+        changes = catalog_refresh.changes
+        for name, table_change in changes["changed"].items():
+            before.setdefault(name, table_change["before"])
+            after[name] = table_change["after"]
+        for name, table_metadata in changes["removed"].items():
+            before.setdefault(name, table_metadata)
+            after[name] = None
+        for name, table_metadata in changes["added"].items():
+            before.setdefault(name, None)
+            after[name] = table_metadata
+
+    return {
+        "connection_id": to_refresh.connection_id,
+        "schema": to_refresh.schema_name,
+        "from_refresh": from_refresh.refresh_id,
+        "to_refresh": to_refresh.refresh_id,
+        "added": {name: after[name] for name in sorted(after) if before[name] is None and after[name] is not None},
+        "removed": {name: before[name] for name in sorted(before) if before[name] is not None and after[name] is None},
+        "changed": {
+            name: table_metadata_diff(before[name], after[name])
+            for name in sorted(after)
+            if before[name] is not None and after[name] is not None and before[name] != after[name]
+        },
+    }
+
+
+
+
+# Background thread refreshing the catalog of every connection once when started and then every interval_seconds.
+# Schemas already in the catalog are refreshed, or the default schema of a new connection.
+class CatalogRefresher:
+
+    def __init__(self, session_factory, interval_seconds=3600):
+        self.session_factory = session_factory
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        if not self.interval_seconds or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="catalog-refresher", daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_all()
+            except Exception:
+                logger.exception("Catalog refresh failed")
+            self._stop.wait(self.interval_seconds)
+
+
+    def refresh_all(self):
+        db = self.session_factory()
+        try:
+            for connection in db.query(Connections).all():
+                if connection.source not in ["mysql", "postgres"]:
+                    continue
+                schemas = [row[0] for row in db.query(SchemaCatalogRefresh.schema_name)
+                           .filter(SchemaCatalogRefresh.connection_id == connection.connection_id).distinct()]
+                for schema in schemas or [None]:
+                    if self._stop.is_set():
+                        return
+                    try:
+                        refresh_source_catalog(db, connection, schema=schema)
+                    except Exception:
+                        db.rollback()
+                        logger.exception("Catalog refresh of connection %s schema %s failed", connection.connection_id, schema)
+        finally:
+            db.close()
+
+
+
+
+catalog_refresher = CatalogRefresher(SessionLocal, interval_seconds=int(os.getenv('CATALOG_REFRESH_INTERVAL_SECONDS', 3600)))
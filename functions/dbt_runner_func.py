@@ -0,0 +1,227 @@
+# Functions for running dbt through its programmatic dbtRunner in a long-lived worker process
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+# Location of the dbt project run for joins
+DBT_PROJECT_DIR = "./dbt/postgres_dbt"
+
+# Directories of a dbt project holding generated files, not sources
+PROJECT_GENERATED_DIRS = {"target", "logs", "dbt_packages"}
+
+# Directory of the models of a dbt project, as set in model-paths of dbt_project.yml
+MODEL_PATH = "models"
+
+# File where dbt saves its partial parsing state in the target path
+PARTIAL_PARSE_FILE = "partial_parse.msgpack"
+
+
+# Function to get the arguments pointing dbt to the profiles.yml set in DBT_PROFILES_PATH
+def profiles_args():
+    file_path = os.getenv('DBT_PROFILES_PATH')
+    return ["--profiles-dir", os.path.dirname(os.path.abspath(file_path))] if file_path else []
+
+
+
+# Function to get the target path of a target, relative to the project directory
+def target_path(target=None):
+    return os.path.join("target", target) if target else "target"
+
+
+
+# Function to build the arguments of a dbt command run against a target of profiles.yml.
+# The target is given per invocation instead of being written to profiles.yml, as dbt parses the
+# whole project again whenever profiles.yml changes. Partial parsing state (partial_parse.msgpack)
+# is also only valid for the target it was parsed with, so each target gets its own target path.
+# Logs are written in the project directory, so each workspace has its own.
+def dbt_args(command, project_dir, target=None):
+    args = [command, "--project-dir", project_dir, "--log-path", os.path.join(project_dir, "logs")] + profiles_args()
+    if target:
+        args += ["--target", target, "--target-path", target_path(target)]
+    return args
+
+
+
+# Function to create the workspace of one dbt run: a directory linking to the files of the project, with
+# its own models directory, target path and log path. Models written to the workspace are only seen by
+# its run, so runs in different workspaces do not interfere. dbt finds files with os.walk from each resource
+# path, which follows a linked resource path itself but not linked directories below it. Other resource
+# paths are therefore linked whole, nested directories included, while the models directory is created with
+# real directories holding links to the model files, so the models of the run can be added to it.
+# The workspace starts from the partial parsing state of the target saved in the project, so only the
+# models of the run are parsed.
+def create_workspace(project_dir, target=None):
+    workspace_dir = tempfile.mkdtemp(prefix="dbt_run_", dir=os.getenv('DBT_WORKSPACE_DIR'))
+    for name in os.listdir(project_dir):
+        if name not in PROJECT_GENERATED_DIRS - {"dbt_packages"} and name != MODEL_PATH:
+            os.symlink(os.path.join(project_dir, name), os.path.join(workspace_dir, name))
+    for root, dirs, names in os.walk(os.path.join(project_dir, MODEL_PATH)):
+        directory = os.path.join(workspace_dir, os.path.relpath(root, project_dir))
+        os.makedirs(directory, exist_ok=True)
+        for name in names:
+            os.symlink(os.path.join(root, name), os.path.join(directory, name))
+    os.makedirs(os.path.join(workspace_dir, MODEL_PATH), exist_ok=True)
+
+    state_path = os.path.join(project_dir, target_path(target), PARTIAL_PARSE_FILE)
+    os.makedirs(os.path.join(workspace_dir, target_path(target)))
+    if os.path.exists(state_path):
+        shutil.copyfile(state_path, os.path.join(workspace_dir, target_path(target), PARTIAL_PARSE_FILE))
+    return workspace_dir
+
+
+
+# Function to save the partial parsing state of a workspace to the project, for the next workspaces of the
+# target, and remove the workspace. The state is replaced at once so concurrent runs never read a partial file.
+def remove_workspace(workspace_dir, project_dir, target=None):
+    try:
+        state_path = os.path.join(workspace_dir, target_path(target), PARTIAL_PARSE_FILE)
+        if os.path.exists(state_path):
+            directory = os.path.join(project_dir, target_path(target))
+            os.makedirs(directory, exist_ok=True)
+            file, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            os.close(file)
+            shutil.copyfile(state_path, temporary_path)
+            os.replace(temporary_path, os.path.join(directory, PARTIAL_PARSE_FILE))
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+
+# Workspace of one dbt run against a target, removed when the block ends. Yields the workspace directory,
+# models of the run are written to its models directory.
+@contextmanager
+def dbt_workspace(project_dir, target=None):
+    project_dir = os.path.abspath(project_dir)
+    workspace_dir = create_workspace(project_dir, target=target)
+    try:
+        yield workspace_dir
+    finally:
+        remove_workspace(workspace_dir, project_dir, target=target)
+
+
+
+# Function to convert a dbt RunResult into a dict with its status and timings
+def run_result_dict(result):
+    return {
+        "unique_id": result.node.unique_id,
+        "status": str(result.status),
+        "execution_time": result.execution_time,
+        "message": result.message,
+        "failures": result.failures,
+        "adapter_response": result.adapter_response,
+        "thread_id": result.thread_id,
+        "timing": {
+            timing.name: {
+                "started_at": timing.started_at.isoformat() if timing.started_at else None,
+                "completed_at": timing.completed_at.isoformat() if timing.completed_at else None,
+            }
+            for timing in result.timing
+        },
+    }
+
+
+
+# Function to parse a project, returns the manifest and the seconds spent parsing
+def parse_project(runner_class, project_dir, target=None):
+    start = time.perf_counter()
+    result = runner_class().invoke(dbt_args("parse", project_dir, target=target))
+    parse_seconds = time.perf_counter() - start
+    if not result.success:
+        raise RuntimeError(f"dbt parse failed: {result.exception}")
+    return result.result, parse_seconds
+
+
+
+# Function to build the dbt selector of a model, with its upstream (parents) and/or downstream (children) models
+def model_selector(model, upstream=False, downstream=False):
+    return ("+" if upstream else "") + model + ("+" if downstream else "")
+
+
+
+# Function to run dbt models of a project with dbtRunner. The project is parsed once and the manifest given to
+# the run, so the run does not parse it again. Between runs, parsing is kept short by dbt partial parsing, which
+# only parses files changed since the partial_parse.msgpack saved for the target, eg: the model of a join.
+# Only the models matched by the select argument are run when it is given, eg: "+new_table".
+# Runs in the worker process, the result only holds plain values so it can be sent back to the API.
+def run_project(project_dir, target=None, select=None):
+    from dbt.cli.main import dbtRunner
+
+    started = time.perf_counter()
+    try:
+        manifest, parse_seconds = parse_project(dbtRunner, project_dir, target=target)
+    except RuntimeError as e:
+        return {"success": False, "error": str(e), "selected": select, "nodes_executed": 0, "results": [],
+                "parse_seconds": None, "run_seconds": None, "elapsed_seconds": round(time.perf_counter() - started, 3)}
+
+    args = dbt_args("run", project_dir, target=target)
+    if select:
+        args += ["--select", select]
+    result = dbtRunner(manifest=manifest).invoke(args)
+    run_results = result.result.results if result.result is not None else []
+    return {
+        "success": result.success,
+        "error": str(result.exception) if result.exception is not None else None,
+        "selected": select,
+        "nodes_executed": len(run_results),
+        "results": [run_result_dict(run_result) for run_result in run_results],
+        "parse_seconds": round(parse_seconds, 3),
+        "run_seconds": round(result.result.elapsed_time, 3) if result.result is not None else None,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+
+
+# Pool of long-lived worker processes running dbt. dbt keeps global state while it runs and a
+# dbtRunner must not be invoked concurrently, so each worker process runs one invocation at a time.
+# Workers start on first use, and are started again if one of them died.
+class DbtWorkerPool:
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+
+    # Run a function in a worker process and wait for its result
+    def run(self, function, *args, **kwargs):
+        executor = self._get_executor()
+        try:
+            return executor.submit(function, *args, **kwargs).result()
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise
+
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+
+
+dbt_workers = DbtWorkerPool(max_workers=int(os.getenv('DBT_MAX_WORKERS', 2)))
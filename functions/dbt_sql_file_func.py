@@ -3,19 +3,30 @@
 import os
 
 
-# Function to create and write to .sql file
-def create_sql_file(new_table, sql_query):
+# Models directory of the dbt project, runs of joins write their model to the models directory of their workspace instead
+MODELS_DIR = "./dbt/postgres_dbt/models"
+
+
+# Function to create and write to .sql file.
+# The file is left untouched when it already holds the query, and is otherwise replaced at once
+# from a temporary file, so dbt never parses a partly written model and unchanged models keep their checksum.
+def create_sql_file(new_table, sql_query, directory=MODELS_DIR):
     try:
         # Create appropriate .sql file
         # Specify the directory and filename for the .sql file
-        directory = "./dbt/postgres_dbt/models"
         filename = new_table + ".sql"
         sql_file_path = f"{directory}/{filename}"
 
-        # Open the .sql file for writing
-        with open(sql_file_path, "w") as sql_file:
+        if os.path.exists(sql_file_path):
+            with open(sql_file_path) as sql_file:
+                if sql_file.read() == sql_query:
+                    return {"success": True}
+
+        # Open a temporary file for writing, dbt only reads files ending with .sql
+        with open(sql_file_path + ".tmp", "w") as sql_file:
             # Write SQL queries to the file, one query per line
             sql_file.write(sql_query)
+        os.replace(sql_file_path + ".tmp", sql_file_path)
     except Exception as e:
         # Handle exceptions, (log the error or raise a custom exception)
         return {"success": False, "error": str(e)}
@@ -68,7 +79,7 @@ def match_join_query(sql_query, join_type, table1:str, table1_col, table2:str, t
 
 
 # Function to create sql query dynamically
-def create_sql_query(join_make, join_type, new_table, table1, table1_col, table2, table2_col, match_pair):
+def create_sql_query(join_make, join_type, new_table, table1, table1_col, table2, table2_col, match_pair, directory=MODELS_DIR):
     # Build the SQL query dynamically
     sql_query = ""
     if join_make == "table":
@@ -84,14 +95,14 @@ def create_sql_query(join_make, join_type, new_table, table1, table1_col, table2
     else:
         return {"success": False, "error": "Unsupported join type"}
 
-    create_sql_file(new_table=new_table, sql_query=sql_query)
+    create_sql_file(new_table=new_table, sql_query=sql_query, directory=directory)
 
     return sql_query
 
 
-# Function to delete sql file
-def delete_sql_file(new_table):
-    directory = "./dbt/postgres_dbt/models"
+# Function to delete sql file, a file that was never written is ignored
+def delete_sql_file(new_table, directory=MODELS_DIR):
     filename = new_table + ".sql"
     sql_file_path = f"{directory}/{filename}"
-    os.remove(sql_file_path)
+    if os.path.exists(sql_file_path):
+        os.remove(sql_file_path)
@@ -48,22 +48,34 @@ def write_profiles_yml(data):
 
 # Function to add connection details to profiles.yml file
 def add_new_profiles_yml(connection):
-    data = read_profiels_yml()
+    return add_connections_profiles_yml([connection])
+
+
 
-    test_output = { # Need to give unique keys, or better to provide connection id
-        "id_"+str(connection.connection_id): {
-            'type': connection.source,
-            'threads': 1,
-            'host': connection.host,
-            'port': int(connection.port),
-            'user': connection.user,
-            'pass': connection.password,
-            'dbname': connection.database,
-            'schema': 'public',
+# Function to add details of several connections to profiles.yml file, reading and writing it once.
+# Returns {"success": False, "error": ...} when the file can not be read or has no postgres_dbt outputs.
+def add_connections_profiles_yml(connections):
+    data = read_profiels_yml()
+    if not isinstance(data, dict) or data.get("success") is False:
+        return {"success": False, "error": data.get("error") if isinstance(data, dict) else "profiles.yml is empty"}
+    if not isinstance(data.get('postgres_dbt'), dict) or not isinstance(data['postgres_dbt'].get('outputs'), dict):
+        return {"success": False, "error": "profiles.yml has no postgres_dbt outputs"}
+
+    for connection in connections:
+        test_output = { # Need to give unique keys, or better to provide connection id
+            "id_"+str(connection.connection_id): {
+                'type': connection.source,
+                'threads': 1,
+                'host': connection.host,
+                'port': int(connection.port),
+                'user': connection.user,
+                'pass': connection.password,
+                'dbname': connection.database,
+                'schema': 'public',
+            }
         }
-    }
-    
-    data['postgres_dbt']['outputs'].update(test_output)
+
+        data['postgres_dbt']['outputs'].update(test_output)
 
     result = write_profiles_yml(data=data)
     return result
@@ -0,0 +1,368 @@
+# Functions for keeping pooled engines of source connections
+
+import os
+import math
+import time
+import asyncio
+import threading
+import importlib.util
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from data.model import Connections
+from functions.admission_func import source_bulkhead
+from functions.query_control_func import query_control
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+# Supported source databases along with their SQLAlchemy driver prefix
+SOURCE_DRIVERS = {
+    "mysql": "mysql+mysqlconnector://",
+    "postgres": "postgresql://",
+}
+
+
+# Async drivers of the supported source databases, used by the async access path
+ASYNC_SOURCE_DRIVERS = {
+    "mysql": "mysql+aiomysql://",
+    "postgres": "postgresql+asyncpg://",
+}
+
+
+# Drivers of the supported source databases used to stream exports. mysql-connector is always buffered
+# in SQLAlchemy, so MySQL exports go through PyMySQL, whose server side cursor (SSCursor) reads rows as they are fetched.
+STREAMING_SOURCE_DRIVERS = {
+    "mysql": "mysql+pymysql://",
+    "postgres": "postgresql://",
+}
+
+
+# Function to build SQLAlchemy url of a source connection
+def source_db_url(source, user, password, host, port, database, drivers=SOURCE_DRIVERS):
+    source = getattr(source, "value", source)
+    if source not in drivers:
+        raise ValueError("Unsupported database type")
+    if not password:
+        password = ""
+    connection_string = user + ':' + password + '@' + host + ':' + port + '/' + database
+    return drivers[source] + connection_string
+
+
+# Connect timeout argument of each source driver, in whole seconds
+CONNECT_TIMEOUT_ARGS = {
+    "mysql": "connection_timeout",
+    "postgres": "connect_timeout",
+}
+
+
+# Function to open and close one unpooled connection to a source, returns the connect latency in ms
+def check_source_connection(source, user, password, host, port, database, connect_timeout=10):
+    source = getattr(source, "value", source)
+    url = source_db_url(source=source, user=user, password=password, host=host, port=port, database=database)
+    engine = create_engine(url, poolclass=NullPool, connect_args={CONNECT_TIMEOUT_ARGS[source]: max(1, math.ceil(connect_timeout))})
+    start = time.perf_counter()
+    try:
+        with engine.connect():
+            pass
+    finally:
+        engine.dispose()
+    return (time.perf_counter() - start) * 1000
+
+
+# Function to build SQLAlchemy url from a Connections row
+def connection_db_url(connection):
+    return source_db_url(source=connection.source, user=connection.user, password=connection.password,
+                         host=connection.host, port=connection.port, database=connection.database)
+
+
+# Function to build SQLAlchemy url with the streaming driver from a Connections row
+def streaming_connection_db_url(connection):
+    return source_db_url(source=connection.source, user=connection.user, password=connection.password,
+                         host=connection.host, port=connection.port, database=connection.database,
+                         drivers=STREAMING_SOURCE_DRIVERS)
+
+
+# Function to build SQLAlchemy url with the async driver from a Connections row
+def async_connection_db_url(connection):
+    return source_db_url(source=connection.source, user=connection.user, password=connection.password,
+                         host=connection.host, port=connection.port, database=connection.database,
+                         drivers=ASYNC_SOURCE_DRIVERS)
+
+
+
+
+# Registry of pooled engines keyed by Connections.connection_id.
+# Least recently used engines are disposed once max_engines is reached, and
+# engines that were not used for idle_seconds are disposed on the next access.
+class EnginePoolRegistry:
+
+    def __init__(self, max_engines=32, pool_size=5, max_overflow=0, pool_timeout=30, idle_seconds=600, pool_recycle=1800):
+        self.max_engines = max_engines
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.idle_seconds = idle_seconds
+        self.pool_recycle = pool_recycle
+        self._engines = OrderedDict() # connection_id -> {"url", "engine", "last_used"}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "idle_disposals": 0,
+            "invalidations": 0,
+            "checkouts": 0,
+            "checkout_wait_total_ms": 0.0,
+            "checkout_wait_max_ms": 0.0,
+        }
+
+
+    def _create_engine(self, url):
+        return create_engine(
+            url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.pool_timeout,
+            pool_recycle=self.pool_recycle,
+            pool_pre_ping=True,
+        )
+
+
+    def _engine_url(self, connection):
+        return connection_db_url(connection)
+
+
+    def _dispose(self, engine):
+        engine.dispose()
+
+
+    # Dispose engines not used for idle_seconds, caller must hold the lock
+    def _dispose_idle(self, now):
+        if not self.idle_seconds:
+            return []
+        idle = [key for key, entry in self._engines.items() if now - entry["last_used"] > self.idle_seconds]
+        disposed = [self._engines.pop(key)["engine"] for key in idle]
+        self._stats["idle_disposals"] += len(disposed)
+        return disposed
+
+
+    # Get the pooled engine of a connection, creating it on first use
+    def get_engine(self, connection):
+        url = self._engine_url(connection)
+        key = connection.connection_id
+        now = time.monotonic()
+        with self._lock:
+            disposed = self._dispose_idle(now)
+            entry = self._engines.get(key)
+            if entry is not None and entry["url"] != url:
+                # Connection row changed since the engine was created
+                disposed.append(self._engines.pop(key)["engine"])
+                self._stats["invalidations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                entry = {"url": url, "engine": self._create_engine(url), "last_used": now}
+                self._engines[key] = entry
+                while len(self._engines) > self.max_engines:
+                    _, evicted = self._engines.popitem(last=False)
+                    disposed.append(evicted["engine"])
+                    self._stats["evictions"] += 1
+            else:
+                self._stats["hits"] += 1
+                entry["last_used"] = now
+                self._engines.move_to_end(key)
+            engine = entry["engine"]
+        for old_engine in disposed:
+            self._dispose(old_engine)
+        return engine
+
+
+    def _record_checkout(self, start):
+        wait_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["checkout_wait_total_ms"] += wait_ms
+            self._stats["checkout_wait_max_ms"] = max(self._stats["checkout_wait_max_ms"], wait_ms)
+
+
+    # Open a connection from the pooled engine, recording the checkout wait.
+    # The connection is only checked out once the bulkhead of the source admits the request,
+    # and its queries run with the statement timeout of the request or connection.
+    @contextmanager
+    def connect(self, connection):
+        with source_bulkhead.admit(connection.connection_id):
+            engine = self.get_engine(connection)
+            start = time.perf_counter()
+            conn = engine.connect()
+            self._record_checkout(start)
+            try:
+                with query_control.control(connection.connection_id, conn):
+                    yield conn
+            finally:
+                conn.close()
+
+
+    # Dispose the engine of a connection, it is recreated on next use
+    def invalidate(self, connection_id):
+        with self._lock:
+            entry = self._engines.pop(connection_id, None)
+            if entry is not None:
+                self._stats["invalidations"] += 1
+        if entry is not None:
+            self._dispose(entry["engine"])
+
+
+    def dispose_all(self):
+        with self._lock:
+            entries = list(self._engines.values())
+            self._engines.clear()
+        for entry in entries:
+            self._dispose(entry["engine"])
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            now = time.monotonic()
+            stats["engines"] = {
+                key: {
+                    "pool_status": entry["engine"].pool.status(),
+                    "checked_out": entry["engine"].pool.checkedout(),
+                    "idle_seconds": round(now - entry["last_used"], 3),
+                }
+                for key, entry in self._engines.items()
+            }
+        stats["checkout_wait_avg_ms"] = stats["checkout_wait_total_ms"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        stats["max_engines"] = self.max_engines
+        stats["pool_size"] = self.pool_size
+        return stats
+
+
+
+
+# Registry of pooled engines for exports, with drivers that stream results of stream_results queries
+class StreamingEnginePoolRegistry(EnginePoolRegistry):
+
+    def _engine_url(self, connection):
+        return streaming_connection_db_url(connection)
+
+
+
+
+# Registry of pooled async engines, for APIs that wait on the source on the event loop instead of in a worker thread.
+# Queries still go through the bulkhead and statement timeout of the connection, and synchronous helpers
+# taking a Connection are reused with AsyncConnection.run_sync.
+class AsyncEnginePoolRegistry(EnginePoolRegistry):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._loop = None # Event loop the engines are used on
+        self._dispose_tasks = set() # Disposals running on the loop, kept until they finish
+
+
+    def _create_engine(self, url):
+        self._loop = asyncio.get_running_loop()
+        return create_async_engine(
+            url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.pool_timeout,
+            pool_recycle=self.pool_recycle,
+            pool_pre_ping=True,
+        )
+
+
+    def _engine_url(self, connection):
+        return async_connection_db_url(connection)
+
+
+    # Pooled connections of an async engine are closed on the event loop the engines are used on, also when
+    # the engine is invalidated from a worker thread. Once that loop has stopped its connections are gone with it.
+    def _dispose(self, engine):
+        loop = self._loop
+        if loop is None or loop.is_closed() or not loop.is_running():
+            engine.sync_engine.dispose(close=False)
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            task = loop.create_task(engine.dispose())
+            self._dispose_tasks.add(task)
+            task.add_done_callback(self._dispose_tasks.discard)
+        else:
+            asyncio.run_coroutine_threadsafe(engine.dispose(), loop)
+
+
+    # Check if the async driver of a source is installed, sources without it use the sync path
+    def available(self, source):
+        driver = ASYNC_SOURCE_DRIVERS.get(getattr(source, "value", source))
+        if driver is None:
+            return False
+        module = driver.split("+")[1].split(":")[0]
+        return importlib.util.find_spec(module) is not None
+
+
+    # Open an async connection from the pooled engine once the bulkhead of the source admits the request
+    @asynccontextmanager
+    async def connect(self, connection):
+        async with source_bulkhead.admit_async(connection.connection_id):
+            engine = self.get_engine(connection)
+            start = time.perf_counter()
+            conn = await engine.connect()
+            self._record_checkout(start)
+            try:
+                # MySQL queries are cancelled with KILL QUERY sent over the sync driver
+                async with query_control.control_async(connection.connection_id, conn, url=connection_db_url(connection)):
+                    yield conn
+            finally:
+                await conn.close()
+
+
+
+
+engine_registry = EnginePoolRegistry(
+    max_engines=int(os.getenv('SOURCE_POOL_MAX_ENGINES', 32)),
+    pool_size=int(os.getenv('SOURCE_POOL_SIZE', 5)),
+    max_overflow=int(os.getenv('SOURCE_POOL_MAX_OVERFLOW', 0)),
+    pool_timeout=int(os.getenv('SOURCE_POOL_TIMEOUT', 30)),
+    idle_seconds=int(os.getenv('SOURCE_POOL_IDLE_SECONDS', 600)),
+    pool_recycle=int(os.getenv('SOURCE_POOL_RECYCLE', 1800)),
+)
+
+
+export_engine_registry = StreamingEnginePoolRegistry(
+    max_engines=int(os.getenv('SOURCE_POOL_MAX_ENGINES', 32)),
+    pool_size=int(os.getenv('SOURCE_EXPORT_POOL_SIZE', 2)),
+    max_overflow=int(os.getenv('SOURCE_POOL_MAX_OVERFLOW', 0)),
+    pool_timeout=int(os.getenv('SOURCE_POOL_TIMEOUT', 30)),
+    idle_seconds=int(os.getenv('SOURCE_POOL_IDLE_SECONDS', 600)),
+    pool_recycle=int(os.getenv('SOURCE_POOL_RECYCLE', 1800)),
+)
+
+
+async_engine_registry = AsyncEnginePoolRegistry(
+    max_engines=int(os.getenv('SOURCE_POOL_MAX_ENGINES', 32)),
+    pool_size=int(os.getenv('SOURCE_ASYNC_POOL_SIZE', os.getenv('SOURCE_POOL_SIZE', 5))),
+    max_overflow=int(os.getenv('SOURCE_POOL_MAX_OVERFLOW', 0)),
+    pool_timeout=int(os.getenv('SOURCE_POOL_TIMEOUT', 30)),
+    idle_seconds=int(os.getenv('SOURCE_POOL_IDLE_SECONDS', 600)),
+    pool_recycle=int(os.getenv('SOURCE_POOL_RECYCLE', 1800)),
+)
+
+
+# Dispose pooled engines whenever a connection row is updated or deleted
+@event.listens_for(Connections, "after_update")
+@event.listens_for(Connections, "after_delete")
+def invalidate_connection_engine(mapper, db_connection, target):
+    engine_registry.invalidate(target.connection_id)
+    export_engine_registry.invalidate(target.connection_id)
+    async_engine_registry.invalidate(target.connection_id)
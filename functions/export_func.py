@@ -0,0 +1,185 @@
+# Functions for exporting data of source tables
+
+import io
+import csv
+import json
+import time
+import logging
+
+from sqlalchemy import select, types
+from sqlalchemy.dialects import mysql
+
+logger = logging.getLogger(__name__)
+
+
+# Function to build select of the export, with optional row limit
+def build_export_query(source, column_names, limit=None):
+    query = select(*[source.c[name] for name in column_names])
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+
+# Function to fetch rows of a query in batches through a server side cursor.
+# Only one batch is held in memory at a time. The connection must come from an engine
+# whose driver has server side cursors, like those of export_engine_registry: mysql-connector
+# is always buffered in SQLAlchemy and would read the whole result before the first batch.
+def stream_batches(connection, query, batch_size=1000):
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+    try:
+        for batch in result.partitions():
+            yield batch
+    finally:
+        result.close()
+
+
+
+# Function to format batches of rows as newline delimited JSON
+def ndjson_chunks(column_names, batches):
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(column_names, row)), default=str) + "\n" for row in batch)
+
+
+
+# Function to format batches of rows as CSV, starting with a header line
+def csv_chunks(column_names, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column_names)
+    yield buffer.getvalue()
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+
+
+
+# Function to import pyarrow, which is only needed for Arrow and Parquet exports
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("pyarrow is not installed, Arrow and Parquet exports are not available")
+    return pyarrow
+
+
+
+# Function to map a column type from the inspector to an Arrow type.
+# Returns the Arrow type and a converter for values Arrow can not take directly.
+def arrow_type(pa, column_type):
+    if isinstance(column_type, types.Boolean):
+        return pa.bool_(), None
+    if isinstance(column_type, types.Integer):
+        return pa.int64(), None
+    if isinstance(column_type, types.Float):
+        return pa.float64(), None
+    if isinstance(column_type, types.Numeric):
+        if column_type.precision and column_type.precision <= 38:
+            return pa.decimal128(column_type.precision, column_type.scale or 0), None
+        return pa.string(), lambda value: None if value is None else str(value)
+    if isinstance(column_type, types.DateTime):
+        return pa.timestamp("us", tz="UTC" if column_type.timezone else None), None
+    if isinstance(column_type, types.Date):
+        return pa.date32(), None
+    if isinstance(column_type, mysql.TIME):
+        # MySQL drivers return TIME values as timedelta, which can be negative or longer than a day
+        return pa.duration("us"), None
+    if isinstance(column_type, types.Time):
+        return pa.time64("us"), None
+    if isinstance(column_type, types.Interval):
+        return pa.duration("us"), None
+    if isinstance(column_type, types._Binary):
+        return pa.binary(), lambda value: None if value is None else bytes(value)
+    if isinstance(column_type, types.JSON):
+        return pa.string(), lambda value: None if value is None else json.dumps(value, default=str)
+    if isinstance(column_type, types.String):
+        return pa.string(), None
+    return pa.string(), lambda value: None if value is None else str(value)
+
+
+
+# Function to build Arrow schema and value converters from inspector columns
+def arrow_schema(pa, columns):
+    fields = []
+    converters = []
+    for column in columns:
+        field_type, converter = arrow_type(pa, column["type"])
+        fields.append(pa.field(column["name"], field_type, nullable=column.get("nullable", True)))
+        converters.append(converter)
+    return pa.schema(fields), converters
+
+
+
+# Function to convert batches of rows into Arrow record batches
+def arrow_record_batches(pa, schema, converters, batches):
+    for batch in batches:
+        arrays = []
+        for index, values in enumerate(zip(*batch) if batch else [[] for _ in schema]):
+            converter = converters[index]
+            if converter is not None:
+                values = [converter(value) for value in values]
+            arrays.append(pa.array(values, type=schema.field(index).type))
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+
+# Function to build throughput statistics of a finished export
+def export_stats(rows, size, started):
+    seconds = time.perf_counter() - started
+    return {
+        "rows": rows,
+        "bytes": size,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        "bytes_per_second": round(size / seconds, 1) if seconds else None,
+    }
+
+
+
+# Function to format batches of rows as an Arrow IPC stream.
+# Throughput is logged once the stream is finished.
+def arrow_ipc_chunks(columns, batches, table_name=""):
+    pa = import_pyarrow()
+    schema, converters = arrow_schema(pa, columns)
+    buffer = io.BytesIO()
+    rows = 0
+    size = 0
+    started = time.perf_counter()
+
+    def drain():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    with pa.ipc.new_stream(buffer, schema) as writer:
+        for record_batch in arrow_record_batches(pa, schema, converters, batches):
+            writer.write_batch(record_batch)
+            rows += record_batch.num_rows
+            data = drain()
+            size += len(data)
+            yield data
+    data = drain()
+    size += len(data)
+    yield data
+    logger.info("Arrow export of %s finished: %s", table_name, export_stats(rows, size, started))
+
+
+
+# Function to write batches of rows to a Parquet file and return throughput statistics
+def write_parquet(columns, batches, path):
+    pa = import_pyarrow()
+    schema, converters = arrow_schema(pa, columns)
+    rows = 0
+    started = time.perf_counter()
+    with pa.parquet.ParquetWriter(path, schema) as writer:
+        for record_batch in arrow_record_batches(pa, schema, converters, batches):
+            writer.write_batch(record_batch)
+            rows += record_batch.num_rows
+    with open(path, "rb") as parquet_file:
+        size = parquet_file.seek(0, io.SEEK_END)
+    return export_stats(rows, size, started)
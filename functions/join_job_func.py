@@ -0,0 +1,293 @@
+# Functions for running joins in the background and tracking them as transformation jobs
+
+import os
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from data.database import SessionLocal
+from data.model import JobMetadata, JobExecutionStatus, TransformationMetadata, TransformationJobPair, ApiInstance
+from functions.dbt_sql_file_func import create_sql_query
+from functions.dbt_runner_func import dbt_workers, run_project, dbt_workspace, DBT_PROJECT_DIR, MODEL_PATH
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Seconds between heartbeats of this process, instances without a heartbeat for three intervals are gone
+JOIN_HEARTBEAT_SECONDS = int(os.getenv('JOIN_HEARTBEAT_SECONDS', 30))
+
+_instance = {"pid": None, "instance_id": None}
+
+
+
+
+# Function to get the current time the way end datetimes of jobs are stored
+def job_datetime():
+    return datetime.utcnow() + timedelta(hours=5, minutes=30)
+
+
+
+# Function to get the id of this process of the API, a forked worker gets an id of its own
+def instance_id():
+    if _instance["pid"] != os.getpid():
+        _instance["pid"] = os.getpid()
+        _instance["instance_id"] = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    return _instance["instance_id"]
+
+
+
+# Function to create the job, job execution and transformation rows of a join, the transformation is In Progress until the run ends.
+# The rows are flushed to get their ids and committed together, so a failure leaves none of them behind.
+# The transformation records the instance running the join.
+def create_join_job(db, join_detail, created_by="API"):
+    try:
+        db_job = JobMetadata(job_name="Join " + join_detail["new_table"], job_type="Transformation", created_by=created_by,
+                             job_detail={"Transformation": join_detail})
+        db.add(db_job)
+        db.flush()
+
+        db_status = JobExecutionStatus(job_id=db_job.job_id, status="Running")
+        db.add(db_status)
+        db_transformation = TransformationMetadata(called_by="Job", status="In Progress",
+                                                   transformation_detail={"join": join_detail, "instance_id": instance_id()})
+        db.add(db_transformation)
+        db.flush()
+
+        db.add(TransformationJobPair(transformation_id=db_transformation.transformation_id, job_execution_id=db_status.job_execution_id))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return {"job_id": db_job.job_id, "job_execution_id": db_status.job_execution_id, "transformation_id": db_transformation.transformation_id}
+
+
+
+# Function to set the final status of a join on its transformation and job execution rows
+def finish_join_job(db, job, detail, error_message=None):
+    status = "Failed" if error_message else "Completed"
+    db.query(TransformationMetadata).filter(TransformationMetadata.transformation_id == job["transformation_id"]).update({
+        "status": status,
+        "transformation_end_datetime": job_datetime(),
+        "error_message": error_message,
+        "transformation_detail": detail,
+    })
+    db.query(JobExecutionStatus).filter(JobExecutionStatus.job_execution_id == job["job_execution_id"]).update({
+        "status": status,
+        "end_datetime": job_datetime(),
+        "error_message": "Transformation fails with message: < " + error_message + " >" if error_message else None,
+    })
+    db.commit()
+
+
+
+# Function to run a join: write the model, run it with dbt and record the result on the job rows.
+# Runs in a thread of the join queue, with its own session of the metadata database. The model is written
+# to a workspace of its own, removed after the run, so joins run in parallel without seeing each other's models.
+def run_join_job(session_factory, job, connection_id, join_detail, select):
+    detail = {"join": join_detail}
+    error_message = None
+    target = "id_" + str(connection_id)
+    try:
+        with dbt_workspace(DBT_PROJECT_DIR, target=target) as workspace_dir:
+            sql_query = create_sql_query(join_make=join_detail["make"], join_type=join_detail["type"], new_table=join_detail["new_table"],
+                                         table1=join_detail["table1"], table1_col=join_detail["table1_col"], table2=join_detail["table2"],
+                                         table2_col=join_detail["table2_col"], match_pair=join_detail["match_pair"],
+                                         directory=os.path.join(workspace_dir, MODEL_PATH))
+            if isinstance(sql_query, dict):
+                error_message = sql_query["error"]
+            else:
+                detail["SQL Query"] = sql_query
+                result = dbt_workers.run(run_project, workspace_dir, target=target, select=select)
+                detail["result"] = result
+                if not result["success"]:
+                    failures = [run_result["message"] for run_result in result["results"] if run_result["status"] in ("error", "fail")]
+                    error_message = result["error"] or "; ".join(filter(None, failures)) or "dbt run failed"
+    except Exception as e:
+        logger.exception("Join of transformation %s failed", job["transformation_id"])
+        error_message = str(e)
+
+    db = session_factory()
+    try:
+        finish_join_job(db, job, detail, error_message=error_message)
+    except Exception:
+        logger.exception("Status of transformation %s could not be saved", job["transformation_id"])
+    finally:
+        db.close()
+
+
+
+# Function to record that this instance is running, joins of instances without a recent heartbeat are failed
+def heartbeat(db):
+    now = job_datetime()
+    instance = db.get(ApiInstance, instance_id())
+    if instance is None:
+        db.add(ApiInstance(instance_id=instance_id(), started_datetime=now, heartbeat_datetime=now))
+    else:
+        instance.heartbeat_datetime = now
+    db.commit()
+
+
+
+# Function to fail joins left In Progress by instances of the API that stopped, their runs were lost with them.
+# Joins of instances with a heartbeat in the last stale_seconds are still running and kept.
+def fail_interrupted_joins(db, stale_seconds=JOIN_HEARTBEAT_SECONDS * 3):
+    cutoff = job_datetime() - timedelta(seconds=stale_seconds)
+    live = {row.instance_id for row in db.query(ApiInstance.instance_id).filter(ApiInstance.heartbeat_datetime >= cutoff)}
+    live.add(instance_id())
+    failed = 0
+    for transformation in db.query(TransformationMetadata).filter(TransformationMetadata.status == "In Progress",
+                                                                  TransformationMetadata.called_by == "Job").all():
+        if not isinstance(transformation.transformation_detail, dict) or "join" not in transformation.transformation_detail:
+            continue
+        if transformation.transformation_detail.get("instance_id") in live:
+            continue
+        job_pair = db.query(TransformationJobPair).filter(TransformationJobPair.transformation_id == transformation.transformation_id).first()
+        if job_pair is None:
+            continue
+        finish_join_job(db, {"transformation_id": transformation.transformation_id, "job_execution_id": job_pair.job_execution_id},
+                        transformation.transformation_detail, error_message="Join interrupted by a stop of the API")
+        failed += 1
+    db.query(ApiInstance).filter(ApiInstance.heartbeat_datetime < cutoff).delete()
+    db.commit()
+    return failed
+
+
+
+# Background thread sending the heartbeat of this instance every interval_seconds, and failing the joins of
+# instances that stopped. The first heartbeat is sent when started, before joins of other instances are checked.
+class JoinHeartbeat:
+
+    def __init__(self, session_factory, interval_seconds=30):
+        self.session_factory = session_factory
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="join-heartbeat", daemon=True)
+        self._thread.start()
+
+
+    # Stop the heartbeat and remove this instance, joins it left queued are failed by the other instances
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        db = self.session_factory()
+        try:
+            db.query(ApiInstance).filter(ApiInstance.instance_id == instance_id()).delete()
+            db.commit()
+        except Exception:
+            logger.exception("Instance %s could not be removed", instance_id())
+        finally:
+            db.close()
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = self.session_factory()
+            try:
+                heartbeat(db)
+                fail_interrupted_joins(db, stale_seconds=self.interval_seconds * 3)
+            except Exception:
+                db.rollback()
+                logger.exception("Heartbeat of instance %s failed", instance_id())
+            finally:
+                db.close()
+            self._stop.wait(self.interval_seconds)
+
+
+
+
+# Queue of joins run in the background by a bounded pool of threads. At most max_workers joins run at
+# once and at most max_queue more wait, joins beyond that are rejected with 429 before any job row is created.
+# Each thread waits on the dbt worker processes, which run the dbt invocations themselves, so joins run in
+# parallel up to the number of dbt workers.
+class JoinJobQueue:
+
+    def __init__(self, session_factory, max_workers=1, max_queue=50):
+        self.session_factory = session_factory
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0 # Joins queued or running
+        self.submitted = 0
+        self.rejected = 0
+
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="join-job")
+        return self._executor
+
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+
+    # Create the job rows of a join and queue its run, returns the ids of the rows at once
+    def submit(self, db, connection_id, join_detail, select):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(status_code=429, detail=f"Too many joins waiting, {self._pending} queued or running",
+                                    headers={"Retry-After": "5"})
+            self._pending += 1
+            executor = self._get_executor()
+        try:
+            job = create_join_job(db, join_detail)
+            future = executor.submit(run_join_job, self.session_factory, job, connection_id, join_detail, select)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(self._done)
+        with self._lock:
+            self.submitted += 1
+        return job
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "pending": self._pending,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+            }
+
+
+    # Wait for running joins to finish, queued joins are dropped and failed by the other instances once this one stopped
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+
+
+join_jobs = JoinJobQueue(
+    SessionLocal,
+    max_workers=int(os.getenv('JOIN_MAX_WORKERS', dbt_workers.max_workers)),
+    max_queue=int(os.getenv('JOIN_MAX_QUEUE', 50)),
+)
+
+
+join_heartbeat = JoinHeartbeat(SessionLocal, interval_seconds=JOIN_HEARTBEAT_SECONDS)
@@ -1,6 +1,8 @@
 # Functions for creating required dict from metadata
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from fastapi import HTTPException
-from sqlalchemy import UniqueConstraint, Column
+from sqlalchemy import UniqueConstraint, Column, MetaData, inspect
 
 
 # Function to create dictionary object from metadata
@@ -75,6 +77,167 @@ def table_list(data):
 
 
 
+# Function to create the same dictionary as metadata_dict straight from an inspector.
+# Uses the get_multi_* methods, which read each kind of object for the whole schema in
+# one catalog query on dialects supporting it (eg: Postgres) instead of one per table.
+def metadata_dict_from_inspector(inspector, schema=None, filter_names=None):
+    columns = inspector.get_multi_columns(schema=schema, filter_names=filter_names)
+    primary_keys = inspector.get_multi_pk_constraint(schema=schema, filter_names=filter_names)
+    foreign_keys = inspector.get_multi_foreign_keys(schema=schema, filter_names=filter_names)
+    indexes = inspector.get_multi_indexes(schema=schema, filter_names=filter_names)
+    unique_constraints = inspector.get_multi_unique_constraints(schema=schema, filter_names=filter_names)
+    check_constraints = _get_multi_optional(inspector.get_multi_check_constraints, schema, filter_names)
+    table_comments = _get_multi_optional(inspector.get_multi_table_comment, schema, filter_names)
+
+    Table = {}
+    for key, table_columns in columns.items():
+        table_name = key[1]
+        table_info = {}  # Create a dictionary for table-specific metadata
+
+        # Add table name
+        table_info['name'] = table_name
+
+        # Get primary keys for the table
+        primary_key = primary_keys.get(key) or {}
+        table_info['primary_keys'] = list(primary_key.get('constrained_columns') or [])
+
+        # Index and unique constraint reported twice (eg: MySQL unique index) are kept only once, like reflection does
+        table_indexes = [index for index in indexes.get(key, []) if not index.get('duplicates_constraint')]
+        index_names = {index['name'] for index in table_indexes}
+        table_uniques = [unique for unique in unique_constraints.get(key, [])
+                         if unique.get('duplicates_index') not in index_names or not unique.get('duplicates_index')]
+
+        # Get constraints for the table
+        constraints = [{
+            'name': primary_key.get('name'),
+            'type': _constraint_type('PrimaryKeyConstraint', table_info['primary_keys']),
+        }]
+        for fk in foreign_keys.get(key, []):
+            constraints.append({
+                'name': fk.get('name'),
+                'type': _constraint_type('ForeignKeyConstraint', fk['constrained_columns']),
+            })
+        for unique in table_uniques:
+            constraints.append({
+                'name': unique.get('name'),
+                'type': _constraint_type('UniqueConstraint', unique['column_names']),
+            })
+        for check in check_constraints.get(key, []):
+            constraints.append({
+                'name': check.get('name'),
+                'type': f"CheckConstraint({check['sqltext']})",
+            })
+        table_info['constraints'] = constraints
+
+        # Get indexes for the table, expression parts of an index have no column name
+        table_info['indexes'] = [
+            {
+                'name': index['name'],
+                'columns': [name for name in index['column_names'] if name is not None]
+            }
+            for index in table_indexes
+        ]
+
+        table_info['columns'] = {}  # Create a dictionary for column information
+        for column in table_columns:
+            table_info['columns'][column['name']] = {
+                'type': str(column['type']),
+                'nullable': column['nullable'],
+                'default': column.get('default'),
+            }
+
+        # Get foreign keys for the table, in the order of the columns like metadata_dict
+        position = {column['name']: index for index, column in enumerate(table_columns)}
+        table_foreign_keys = []
+        for fk in foreign_keys.get(key, []):
+            for column_name, foreign_column in zip(fk['constrained_columns'], fk['referred_columns']):
+                table_foreign_keys.append({
+                    'column': column_name,
+                    'foreign_table': fk['referred_table'],
+                    'foreign_column': foreign_column
+                })
+        table_foreign_keys.sort(key=lambda fk: position.get(fk['column'], len(position)))
+        table_info['foreign_keys'] = table_foreign_keys
+
+        # Table Comment
+        comment = (table_comments.get(key) or {}).get('text')
+        if comment is not None:
+            table_info['table_comment'] = comment
+
+        # Add table metadata to the 'Table' dictionary
+        Table[table_name] = table_info
+    return Table
+
+
+def _constraint_type(kind, column_names):
+    return f"{kind}({', '.join(column_names)})"
+
+
+# Check constraints and comments are not implemented by every dialect
+def _get_multi_optional(method, schema, filter_names):
+    try:
+        return method(schema=schema, filter_names=filter_names)
+    except NotImplementedError:
+        return {}
+
+
+
+# Function to reflect a source database and build table list and metadata dictionary.
+# When tables or name prefixes are given only the matching tables are reflected.
+def reflect_metadata(bind, schema=None, tables=None, prefixes=None):
+    inspector = inspect(bind)
+    filter_names = None
+    if tables or prefixes:
+        existing = inspector.get_table_names(schema=schema)
+        filter_names = select_table_names(existing, tables=tables, prefixes=prefixes)
+        if not filter_names:
+            return {"tables": [], "metadata": {}}
+    metadata = metadata_dict_from_inspector(inspector, schema=schema, filter_names=filter_names)
+    return {"tables": list(metadata), "metadata": metadata}
+
+
+
+# Function to reflect tables in shards of shard_size tables on up to max_workers threads.
+# connect() must return a context manager giving a new connection, so that each shard
+# runs on its own pooled connection. The shards are merged into one metadata dictionary.
+def reflect_metadata_sharded(connect, schema=None, tables=None, prefixes=None, max_workers=4, shard_size=200):
+    with connect() as connection:
+        names = inspect(connection).get_table_names(schema=schema)
+    if tables or prefixes:
+        names = select_table_names(names, tables=tables, prefixes=prefixes)
+    shards = [names[start:start + shard_size] for start in range(0, len(names), shard_size)]
+
+    def reflect_shard(shard):
+        with connect() as connection:
+            return metadata_dict_from_inspector(inspect(connection), schema=schema, filter_names=shard)
+
+    # Shards run in the context of the caller, eg: with the query scope of the request
+    contexts = [copy_context() for _ in shards]
+    merged = {}
+    if shards:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(shards)))) as executor:
+            for shard_metadata in executor.map(lambda context, shard: context.run(reflect_shard, shard), contexts, shards):
+                merged.update(shard_metadata)
+    metadata = {name: merged[name] for name in names if name in merged}
+    return {"tables": list(metadata), "metadata": metadata}
+
+
+
+# Function to select table names by exact name or by name prefix
+def select_table_names(names, tables=None, prefixes=None):
+    tables = set(tables or [])
+    prefixes = tuple(prefixes or [])
+    return [name for name in names if name in tables or (prefixes and name.startswith(prefixes))]
+
+
+
+# Function to select tables from an already reflected table list and metadata dictionary
+def select_reflected(reflected, tables=None, prefixes=None):
+    names = select_table_names(reflected["tables"], tables=tables, prefixes=prefixes)
+    return {"tables": names, "metadata": {name: reflected["metadata"][name] for name in names}}
+
+
+
 # Function to get primary keys of a table
 def get_primary_keys(metadata, table_name):
     if table_name not in metadata.tables:
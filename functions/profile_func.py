@@ -0,0 +1,130 @@
+# Functions for profiling columns of source tables
+
+import os
+import json
+import time
+from collections import Counter
+
+from dotenv import load_dotenv
+from sqlalchemy import select, func, types
+
+from functions.table_data_func import sample_rows
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Tables with more estimated rows are profiled on a sample instead of a full scan
+PROFILE_FULL_SCAN_MAX_ROWS = int(os.getenv('PROFILE_FULL_SCAN_MAX_ROWS', 1000000))
+
+# Number of sampled rows used for top values, and for all statistics of sampled tables
+PROFILE_SAMPLE_ROWS = int(os.getenv('PROFILE_SAMPLE_ROWS', 10000))
+
+# Number of most frequent values reported per column
+PROFILE_TOP_VALUES = 5
+
+
+# Function to check if min and max can be computed for a column type
+def is_comparable(column_type):
+    if isinstance(column_type, (types.Boolean, types.JSON, types._Binary, types.ARRAY)):
+        return False
+    return isinstance(column_type, (types.Integer, types.Numeric, types.Date, types.DateTime, types.Time, types.String))
+
+
+# Function to check if values of a column type can be counted as distinct values
+def is_countable(column_type):
+    return not isinstance(column_type, (types.JSON, types._Binary, types.ARRAY))
+
+
+
+# Function to build one aggregate select with the statistics of every column, computed in a single scan
+def build_profile_query(source, columns):
+    selects = [func.count().label("row_count")]
+    for index, column in enumerate(columns):
+        column_expression = source.c[column["name"]]
+        selects.append(func.count(column_expression).label(f"c{index}_non_null"))
+        if is_countable(column["type"]):
+            selects.append(func.count(column_expression.distinct()).label(f"c{index}_distinct"))
+        if is_comparable(column["type"]):
+            selects.append(func.min(column_expression).label(f"c{index}_min"))
+            selects.append(func.max(column_expression).label(f"c{index}_max"))
+    return select(*selects).select_from(source)
+
+
+
+# Function to read the statistics of one column from the row of the aggregate select
+def column_stats_from_aggregate(aggregate, index, column, row_count):
+    non_null = aggregate[f"c{index}_non_null"]
+    return {
+        "name": column["name"],
+        "type": str(column["type"]),
+        "null_count": row_count - non_null,
+        "null_fraction": round((row_count - non_null) / row_count, 6) if row_count else None,
+        "distinct_count": aggregate.get(f"c{index}_distinct"),
+        "min": aggregate.get(f"c{index}_min"),
+        "max": aggregate.get(f"c{index}_max"),
+    }
+
+
+
+# Function to compute the statistics of one column from sampled values
+def column_stats_from_values(values, column):
+    non_null = [value for value in values if value is not None]
+    comparable = is_comparable(column["type"]) and non_null
+    return {
+        "name": column["name"],
+        "type": str(column["type"]),
+        "null_count": len(values) - len(non_null),
+        "null_fraction": round((len(values) - len(non_null)) / len(values), 6) if values else None,
+        "distinct_count": len(set(non_null)) if is_countable(column["type"]) else None,
+        "min": min(non_null) if comparable else None,
+        "max": max(non_null) if comparable else None,
+    }
+
+
+
+# Function to find the most frequent values of a column, JSON values are counted by their text
+def top_values(values, column_type, limit=PROFILE_TOP_VALUES):
+    if isinstance(column_type, (types._Binary, types.ARRAY)):
+        return None
+    if isinstance(column_type, types.JSON):
+        values = [json.dumps(value, sort_keys=True, default=str) for value in values if value is not None]
+    counts = Counter(value for value in values if value is not None)
+    return [{"value": value, "count": count} for value, count in counts.most_common(limit)]
+
+
+
+# Function to profile the columns of a source table.
+# Tables up to PROFILE_FULL_SCAN_MAX_ROWS estimated rows get null counts, distinct counts,
+# min and max from one aggregate select over the whole table, larger tables or sample=True
+# get them from a sample. Top values come from a sample of PROFILE_SAMPLE_ROWS rows and are only
+# computed when asked for with with_top_values, so full scans read no sample at all by default.
+def profile_table(connection, source, columns, key=None, total_rows=None, sample=None, seed=0, with_top_values=False):
+    started = time.perf_counter()
+    if sample is None:
+        sample = total_rows is not None and total_rows > PROFILE_FULL_SCAN_MAX_ROWS
+    sampling = None
+    values = [() for _ in columns]
+    if sample or with_top_values:
+        column_names = [column["name"] for column in columns]
+        sampled, sampling = sample_rows(connection, source, column_names, PROFILE_SAMPLE_ROWS, seed=seed, key=key, total_rows=total_rows)
+        values = list(zip(*sampled)) if sampled else values
+
+    if sample:
+        row_count = len(sampled)
+        column_profiles = [column_stats_from_values(list(values[index]), column) for index, column in enumerate(columns)]
+    else:
+        aggregate = connection.execute(build_profile_query(source, columns)).mappings().one()
+        row_count = aggregate["row_count"]
+        column_profiles = [column_stats_from_aggregate(aggregate, index, column, row_count) for index, column in enumerate(columns)]
+
+    for index, column_profile in enumerate(column_profiles):
+        column_profile["top_values"] = top_values(list(values[index]), columns[index]["type"]) if with_top_values else None
+
+    return {
+        "row_count": row_count,
+        "estimated_total_rows": total_rows,
+        "sampled": sample,
+        "sampling": sampling,
+        "columns": column_profiles,
+        "took_ms": round((time.perf_counter() - started) * 1000, 3),
+    }
@@ -0,0 +1,344 @@
+# Functions for statement timeouts and cancellation of source queries
+
+import os
+import asyncio
+import threading
+from contextvars import ContextVar
+from contextlib import contextmanager, asynccontextmanager
+from collections import defaultdict
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import NullPool
+
+from data.model import Connections
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+# Raised when a source query ran longer than its statement timeout
+class StatementTimeout(HTTPException):
+
+    def __init__(self, timeout_ms):
+        super().__init__(status_code=504, detail=f"Query on the source was cancelled after the statement timeout of {timeout_ms} ms")
+
+
+# Raised when a source query was cancelled because the client disconnected
+class QueryCancelled(HTTPException):
+
+    def __init__(self):
+        super().__init__(status_code=499, detail="Query on the source was cancelled as the client disconnected")
+
+
+
+
+# Function to set the statement timeout of the current transaction (Postgres) or session (MySQL).
+# MySQL max_execution_time only applies to SELECT statements.
+def apply_statement_timeout(conn, timeout_ms):
+    if not timeout_ms:
+        return False
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+    elif conn.dialect.name == "mysql":
+        conn.exec_driver_sql(f"SET SESSION max_execution_time = {int(timeout_ms)}")
+    else:
+        return False
+    return True
+
+
+# Function to restore the statement timeout before the connection goes back to the pool.
+# SET LOCAL on Postgres ends with the transaction, the MySQL session value has to be reset.
+def reset_statement_timeout(conn):
+    if conn.dialect.name == "mysql" and not conn.invalidated:
+        conn.exec_driver_sql("SET SESSION max_execution_time = DEFAULT")
+
+
+# Function to get the MySQL error number of a driver error, mysql-connector sets errno and PyMySQL passes it as first argument
+def mysql_errno(orig):
+    errno = getattr(orig, "errno", None)
+    if errno is None and getattr(orig, "args", None) and isinstance(orig.args[0], int):
+        errno = orig.args[0]
+    return errno
+
+
+# Function to check if a database error is a statement timeout
+def is_timeout_error(error):
+    orig = getattr(error, "orig", None)
+    if getattr(orig, "pgcode", None) == "57014":
+        return "statement timeout" in str(orig)
+    return mysql_errno(orig) == 3024
+
+
+# Function to check if a database error is a query cancelled on request
+def is_cancel_error(error):
+    orig = getattr(error, "orig", None)
+    if getattr(orig, "pgcode", None) == "57014":
+        return "statement timeout" not in str(orig)
+    return mysql_errno(orig) == 1317
+
+
+
+# Function to cancel the query running on a source connection.
+# Postgres gets a cancel request through psycopg2, or from asyncpg when the task awaiting the query is cancelled,
+# MySQL a KILL QUERY from a separate connection.
+def cancel_query(entry):
+    if entry["dialect"] == "postgresql" and entry["task"] is not None:
+        entry["loop"].call_soon_threadsafe(entry["task"].cancel)
+    elif entry["dialect"] == "postgresql":
+        entry["dbapi_connection"].cancel()
+    elif entry["dialect"] == "mysql" and entry["thread_id"] is not None:
+        engine = create_engine(entry["url"], poolclass=NullPool)
+        try:
+            with engine.connect() as killer:
+                killer.exec_driver_sql(f"KILL QUERY {int(entry['thread_id'])}")
+        finally:
+            engine.dispose()
+    else:
+        return False
+    return True
+
+
+
+
+# Source queries of one API request, with the timeout requested by the client.
+# Connections are registered while they are checked out so that they can be cancelled.
+class QueryScope:
+
+    def __init__(self, timeout_ms=None):
+        self.timeout_ms = timeout_ms
+        self.cancelled = False
+        self._connections = {} # id of registration -> {"connection_id", "dialect", "dbapi_connection", "thread_id", "url", "task", "loop", "cancel_done"}
+        self._lock = threading.Lock()
+
+
+    # Connections of the async path are registered with the task running their queries,
+    # and with the url of the sync driver used to send KILL QUERY
+    def register(self, connection_id, conn, url=None, task=None):
+        dbapi_connection = conn.connection.dbapi_connection
+        thread_id = None
+        if conn.dialect.name == "mysql":
+            thread_id = getattr(dbapi_connection, "connection_id", None)
+            if thread_id is None:
+                thread_id = conn.exec_driver_sql("SELECT CONNECTION_ID()").scalar()
+        entry = {"connection_id": connection_id, "dialect": conn.dialect.name, "dbapi_connection": dbapi_connection,
+                 "thread_id": thread_id, "url": url or conn.engine.url, "task": task,
+                 "loop": task.get_loop() if task is not None else None}
+        with self._lock:
+            self._connections[id(entry)] = entry
+        return id(entry)
+
+
+    # Remove a registered connection, returns the event set when a cancel of it in progress is done
+    def _pop(self, registration):
+        with self._lock:
+            entry = self._connections.pop(registration, None)
+        return entry.get("cancel_done") if entry is not None else None
+
+
+    # Waits for a cancel of the connection in progress, so the connection is not cancelled once it is back in the pool
+    def unregister(self, registration):
+        cancel_done = self._pop(registration)
+        if cancel_done is not None:
+            cancel_done.wait()
+
+
+    # Same as unregister on the event loop, the wait for a cancel in progress runs in a worker thread
+    async def unregister_async(self, registration):
+        cancel_done = self._pop(registration)
+        if cancel_done is not None and not cancel_done.is_set():
+            await run_in_threadpool(cancel_done.wait)
+
+
+    # Cancel every running query of the request, returns the connection_ids of the cancelled queries.
+    # The connections are taken under the lock and cancelled after it is released, a slow KILL QUERY
+    # only holds back the release of its own connection, not the other queries of the request.
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            entries = list(self._connections.values())
+            for entry in entries:
+                entry["cancel_done"] = threading.Event()
+            cancels = [(entry, entry["cancel_done"]) for entry in entries]
+        cancelled = []
+        for entry, cancel_done in cancels:
+            try:
+                if cancel_query(entry):
+                    cancelled.append(entry["connection_id"])
+            except Exception:
+                pass
+            finally:
+                cancel_done.set()
+        return cancelled
+
+
+# Query scope of the current request, set by the source_query_scope dependency
+current_query_scope = ContextVar("current_query_scope", default=None)
+
+
+
+
+# Statement timeouts of source connections and metrics of timeouts and cancellations.
+# The timeout of a query is the one requested by the client, else the one of the connection, else the default.
+class QueryControl:
+
+    def __init__(self, default_timeout_ms=0):
+        self.default_timeout_ms = default_timeout_ms
+        self._timeouts = {} # connection_id -> statement timeout in ms
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"queries": 0, "timeouts": 0, "cancel_requests": 0, "cancelled": 0})
+
+
+    def set_timeout(self, connection_id, timeout_ms):
+        with self._lock:
+            if timeout_ms is None:
+                self._timeouts.pop(connection_id, None)
+            else:
+                self._timeouts[connection_id] = timeout_ms
+
+
+    def get_timeout(self, connection_id):
+        with self._lock:
+            return self._timeouts.get(connection_id, self.default_timeout_ms)
+
+
+    def remove_connection(self, connection_id):
+        with self._lock:
+            self._timeouts.pop(connection_id, None)
+            self._stats.pop(connection_id, None)
+
+
+    def _count(self, connection_id, name, amount=1):
+        with self._lock:
+            self._stats[connection_id][name] += amount
+
+
+    def record_cancel_requests(self, connection_ids):
+        for connection_id in connection_ids:
+            self._count(connection_id, "cancel_requests")
+
+
+    # Query scope and statement timeout of a query on a connection, raises if the request was cancelled already
+    def _begin(self, connection_id):
+        scope = current_query_scope.get()
+        if scope is not None and scope.cancelled:
+            raise QueryCancelled()
+        timeout_ms = scope.timeout_ms if scope is not None and scope.timeout_ms is not None else self.get_timeout(connection_id)
+        self._count(connection_id, "queries")
+        return scope, timeout_ms
+
+
+    # Function to turn a database error into StatementTimeout or QueryCancelled, None for other errors
+    def _translate(self, connection_id, scope, timeout_ms, error):
+        if is_timeout_error(error):
+            self._count(connection_id, "timeouts")
+            return StatementTimeout(timeout_ms)
+        if is_cancel_error(error) and scope is not None and scope.cancelled:
+            self._count(connection_id, "cancelled")
+            return QueryCancelled()
+        return None
+
+
+    # Run the block with the statement timeout set on the checked out connection,
+    # turning timeouts and cancellations of its queries into HTTP errors
+    @contextmanager
+    def control(self, connection_id, conn):
+        scope, timeout_ms = self._begin(connection_id)
+        apply_statement_timeout(conn, timeout_ms)
+        registration = scope.register(connection_id, conn) if scope is not None else None
+        try:
+            yield
+        except DBAPIError as e:
+            translated = self._translate(connection_id, scope, timeout_ms, e)
+            if translated is not None:
+                raise translated from e
+            raise
+        finally:
+            if registration is not None:
+                scope.unregister(registration)
+            try:
+                reset_statement_timeout(conn)
+            except DBAPIError:
+                pass
+
+
+    # Same as control for an AsyncConnection. Queries on Postgres are cancelled by cancelling the task awaiting them,
+    # which is then reported as QueryCancelled instead of a cancelled task.
+    @asynccontextmanager
+    async def control_async(self, connection_id, conn, url=None):
+        scope, timeout_ms = self._begin(connection_id)
+        await conn.run_sync(apply_statement_timeout, timeout_ms)
+        task = asyncio.current_task()
+        registration = await conn.run_sync(lambda sync_conn: scope.register(connection_id, sync_conn, url=url, task=task)) if scope is not None else None
+        try:
+            yield
+        except DBAPIError as e:
+            translated = self._translate(connection_id, scope, timeout_ms, e)
+            if translated is not None:
+                raise translated from e
+            raise
+        except asyncio.CancelledError:
+            if scope is None or not scope.cancelled:
+                raise
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            self._count(connection_id, "cancelled")
+            raise QueryCancelled() from None
+        finally:
+            if registration is not None:
+                await scope.unregister_async(registration)
+            try:
+                await conn.run_sync(reset_statement_timeout)
+            except DBAPIError:
+                pass
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                "default_timeout_ms": self.default_timeout_ms,
+                "connections": {
+                    connection_id: {"timeout_ms": self._timeouts.get(connection_id, self.default_timeout_ms), **stats}
+                    for connection_id, stats in self._stats.items()
+                },
+            }
+
+
+
+
+query_control = QueryControl(default_timeout_ms=int(os.getenv('SOURCE_STATEMENT_TIMEOUT_MS', 0)))
+
+# Seconds between checks whether the client of a running request disconnected
+DISCONNECT_POLL_SECONDS = float(os.getenv('SOURCE_DISCONNECT_POLL_SECONDS', 0.5))
+
+
+# Function to cancel the source queries of a request once its client disconnects
+async def watch_disconnect(request: Request, scope: QueryScope):
+    while True:
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+        if await request.is_disconnected():
+            query_control.record_cancel_requests(await run_in_threadpool(scope.cancel))
+            return
+
+
+# Dependency of APIs querying a source: sets the statement timeout of the request and
+# cancels its running queries when the client disconnects
+async def source_query_scope(request: Request,
+                             timeout_ms: Optional[int] = Query(None, description="Statement timeout of source queries in milliseconds, default of the connection if not given", ge=0)):
+    scope = QueryScope(timeout_ms)
+    current_query_scope.set(scope)
+    watcher = asyncio.create_task(watch_disconnect(request, scope))
+    try:
+        yield scope
+    finally:
+        watcher.cancel()
+
+
+# Drop the timeout and metrics of a connection when the connection row is deleted
+@event.listens_for(Connections, "after_delete")
+def remove_connection_query_control(mapper, db_connection, target):
+    query_control.remove_connection(target.connection_id)
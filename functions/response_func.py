@@ -0,0 +1,145 @@
+# Functions for encoding API responses as JSON or MessagePack, chosen by the Accept header of the request
+
+import json
+import asyncio
+import datetime
+import functools
+from contextvars import ContextVar
+from decimal import Decimal
+
+import msgpack
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from fastapi.routing import APIRoute
+from fastapi.datastructures import DefaultPlaceholder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# Media types accepted in the Accept header for each encoding
+ACCEPTED_MEDIA_TYPES = {
+    "application/json": JSON_MEDIA_TYPE,
+    "application/msgpack": MSGPACK_MEDIA_TYPE,
+    "application/x-msgpack": MSGPACK_MEDIA_TYPE,
+    "application/vnd.msgpack": MSGPACK_MEDIA_TYPE,
+}
+
+
+# Function to choose the encoding of a response from an Accept header, JSON unless MessagePack is preferred.
+# Media types are ranked by their q value, ties keep the order of the header.
+def negotiate_media_type(accept):
+    if not accept:
+        return JSON_MEDIA_TYPE
+    ranked = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type.lower() in ACCEPTED_MEDIA_TYPES and quality > 0:
+            ranked.append((-quality, position, ACCEPTED_MEDIA_TYPES[media_type.lower()]))
+    return min(ranked)[2] if ranked else JSON_MEDIA_TYPE
+
+
+
+# Function to encode values that neither orjson nor msgpack take directly, the same way as FastAPI does
+def encode_fallback(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    return jsonable_encoder(value)
+
+
+# Function to encode content as JSON, with orjson when it is installed
+def encode_json(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=encode_fallback, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+# Function to encode content as MessagePack
+def encode_msgpack(content):
+    return msgpack.packb(content, default=encode_fallback, use_bin_type=True, datetime=False)
+
+
+
+# Accept header of the request being handled, set by NegotiatedRoute
+current_accept = ContextVar("current_accept", default=None)
+
+
+# Response encoded as JSON or MessagePack depending on the Accept header of the request
+class NegotiatedResponse(JSONResponse):
+
+    def __init__(self, content, status_code=200, headers=None, media_type=None, background=None):
+        self.media_type = media_type or negotiate_media_type(current_accept.get())
+        super().__init__(content, status_code=status_code, headers=headers, media_type=self.media_type, background=background)
+        self.headers["Vary"] = "Accept"
+
+
+    def render(self, content):
+        if self.media_type == MSGPACK_MEDIA_TYPE:
+            return encode_msgpack(content)
+        return encode_json(content)
+
+
+
+# Function to wrap an endpoint so that its result is encoded directly into a NegotiatedResponse,
+# skipping jsonable_encoder. Headers and status code set on the Response parameter of the endpoint are kept.
+def encode_endpoint_result(call, status_code):
+    def respond(content, values):
+        if isinstance(content, Response):
+            return content
+        sub_response = next((value for value in values.values() if isinstance(value, Response)), None)
+        response = NegotiatedResponse(content, status_code=(sub_response.status_code if sub_response is not None else None) or status_code or 200)
+        if sub_response is not None:
+            response.headers.raw.extend(sub_response.headers.raw)
+        return response
+
+    if asyncio.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def endpoint(**values):
+            return respond(await call(**values), values)
+    else:
+        @functools.wraps(call)
+        def endpoint(**values):
+            return respond(call(**values), values)
+    return endpoint
+
+
+
+
+# Route answering in JSON, encoded with orjson, or in MessagePack for clients sending Accept: application/msgpack.
+# Routes without a response_model encode the result of the endpoint directly, routes with one keep the
+# validation of FastAPI and only use the negotiated encoding.
+class NegotiatedRoute(APIRoute):
+
+    def __init__(self, path, endpoint, **kwargs):
+        if isinstance(kwargs.get("response_class"), DefaultPlaceholder) or "response_class" not in kwargs:
+            kwargs["response_class"] = NegotiatedResponse
+        super().__init__(path, endpoint, **kwargs)
+
+
+    def get_route_handler(self):
+        if self.response_field is None:
+            self.dependant.call = encode_endpoint_result(self.dependant.call, self.status_code)
+        handler = super().get_route_handler()
+
+        async def negotiated_handler(request):
+            token = current_accept.set(request.headers.get("accept"))
+            try:
+                return await handler(request)
+            finally:
+                current_accept.reset(token)
+        return negotiated_handler
@@ -0,0 +1,229 @@
+# Functions for searching tables and columns across source connections
+
+import re
+import math
+import time
+import bisect
+import itertools
+import threading
+from collections import defaultdict, Counter
+
+from sqlalchemy import event
+
+from data.model import Connections, SchemaCatalog
+
+
+# Default minimum trigram similarity of fuzzy matches. Swapped letters in a short name change most of
+# its trigrams, eg: scroe and score have a similarity of 0.2, so the default is below pg_trgm's 0.3.
+FUZZY_THRESHOLD = 0.2
+
+
+# Function to split a name into the terms it is indexed under.
+# The whole name is a term, as well as each part of it, eg: customer_id, customer, id
+def name_terms(name):
+    name = name.lower()
+    terms = {name}
+    terms.update(part for part in re.split(r"[^0-9a-z]+", name) if part)
+    return terms
+
+
+# Function to get trigrams of a term, padded like pg_trgm so short terms have trigrams too
+def trigrams(term):
+    padded = f"  {term} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+
+
+# Inverted index of table and column names of every connection.
+# Each indexed table and column is a document, and each term of its name points to it.
+# Prefix lookups bisect a sorted list of terms, fuzzy lookups rank terms by shared trigrams.
+class ColumnSearchIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._documents = {} # document_id -> {"connection_id", "schema", "table", "column", "type"}
+        self._tables = defaultdict(set) # (connection_id, schema, table) -> document_ids
+        self._postings = defaultdict(set) # term -> document_ids
+        self._sorted_terms = [] # sorted again lazily after terms were added or removed
+        self._terms_changed = False
+        self._trigrams = defaultdict(set) # trigram -> terms
+        self._trigram_counts = {} # term -> number of trigrams
+        self._next_id = 0
+
+
+    def _add_term(self, term, document_id):
+        postings = self._postings[term]
+        if not postings:
+            self._terms_changed = True
+            term_trigrams = trigrams(term)
+            self._trigram_counts[term] = len(term_trigrams)
+            for trigram in term_trigrams:
+                self._trigrams[trigram].add(term)
+        postings.add(document_id)
+
+
+    def _remove_term(self, term, document_id):
+        postings = self._postings.get(term)
+        if postings is None:
+            return
+        postings.discard(document_id)
+        if not postings:
+            del self._postings[term]
+            self._terms_changed = True
+            del self._trigram_counts[term]
+            for trigram in trigrams(term):
+                self._trigrams[trigram].discard(term)
+                if not self._trigrams[trigram]:
+                    del self._trigrams[trigram]
+
+
+    def _add_document(self, document):
+        document_id = self._next_id
+        self._next_id += 1
+        self._documents[document_id] = document
+        self._tables[(document["connection_id"], document["schema"], document["table"])].add(document_id)
+        for term in name_terms(document["column"] or document["table"]):
+            self._add_term(term, document_id)
+
+
+    def _remove_table(self, key):
+        for document_id in self._tables.pop(key, set()):
+            document = self._documents.pop(document_id)
+            for term in name_terms(document["column"] or document["table"]):
+                self._remove_term(term, document_id)
+
+
+    # Index tables of a metadata dictionary, replacing earlier entries of the same tables.
+    # With replace_schema every table of the schema not in metadata is removed as well.
+    def update_tables(self, connection_id, metadata, schema=None, replace_schema=False):
+        with self._lock:
+            if replace_schema:
+                for key in [key for key in self._tables if key[0] == connection_id and key[1] == schema]:
+                    self._remove_table(key)
+            for table_name, table_info in metadata.items():
+                self._remove_table((connection_id, schema, table_name))
+                self._add_document({"connection_id": connection_id, "schema": schema, "table": table_name,
+                                    "column": None, "type": None})
+                for column_name, column_info in table_info.get("columns", {}).items():
+                    self._add_document({"connection_id": connection_id, "schema": schema, "table": table_name,
+                                        "column": column_name, "type": column_info.get("type")})
+
+
+    def remove_tables(self, connection_id, table_names, schema=None):
+        with self._lock:
+            for table_name in table_names:
+                self._remove_table((connection_id, schema, table_name))
+
+
+    def remove_connection(self, connection_id):
+        with self._lock:
+            for key in [key for key in self._tables if key[0] == connection_id]:
+                self._remove_table(key)
+
+
+    # Terms starting with the query, shortest first
+    def _prefix_terms(self, query):
+        if self._terms_changed:
+            self._sorted_terms = sorted(self._postings)
+            self._terms_changed = False
+        start = bisect.bisect_left(self._sorted_terms, query)
+        terms = []
+        for term in itertools.islice(self._sorted_terms, start, None):
+            if not term.startswith(query):
+                break
+            terms.append(term)
+        return [(term, len(query) / len(term)) for term in sorted(terms, key=len)]
+
+
+    # Terms sharing trigrams with the query, ranked by trigram similarity (Jaccard).
+    # A term reaching the threshold shares at least ceil(threshold * n) of the n query trigrams,
+    # so candidates only come from the n - ceil(threshold * n) + 1 rarest of them.
+    def _fuzzy_terms(self, query, threshold):
+        query_trigrams = trigrams(query)
+        rarest = sorted(query_trigrams, key=lambda trigram: len(self._trigrams.get(trigram, ())))
+        probe = len(rarest) - math.ceil(threshold * len(rarest)) + 1
+        candidates = set().union(*[self._trigrams.get(trigram, ()) for trigram in rarest[:probe]])
+        if not candidates:
+            return []
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(candidates.intersection(self._trigrams.get(trigram, ())))
+        scored = []
+        for term, count in shared.items():
+            score = count / (len(query_trigrams) + self._trigram_counts[term] - count)
+            if score >= threshold:
+                scored.append((term, score))
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored
+
+
+    # Search table and column names. mode is exact, prefix or fuzzy and kind is column, table or all.
+    # threshold is the minimum trigram similarity of fuzzy matches.
+    # Matching terms are not capped, their documents are filtered until limit results are found,
+    # so filters on connection, type and kind do not hide matches behind terms of other documents.
+    def search(self, query, mode="prefix", kind="column", connection_id=None, type_filter=None, limit=50, threshold=FUZZY_THRESHOLD):
+        started = time.perf_counter()
+        query = query.lower().strip()
+        with self._lock:
+            if mode == "exact":
+                terms = [(query, 1.0)] if query in self._postings else []
+            elif mode == "fuzzy":
+                terms = self._fuzzy_terms(query, threshold)
+            else:
+                terms = self._prefix_terms(query)
+
+            results = []
+            seen = set()
+            for term, score in terms:
+                for document_id in sorted(self._postings.get(term, ())):
+                    if document_id in seen:
+                        continue
+                    seen.add(document_id)
+                    document = self._documents[document_id]
+                    if kind == "column" and document["column"] is None:
+                        continue
+                    if kind == "table" and document["column"] is not None:
+                        continue
+                    if connection_id is not None and document["connection_id"] != connection_id:
+                        continue
+                    if type_filter and type_filter.lower() not in (document["type"] or "").lower():
+                        continue
+                    results.append({**document, "matched_term": term, "score": round(score, 3)})
+                    if len(results) >= limit:
+                        break
+                if len(results) >= limit:
+                    break
+        return {"results": results, "took_ms": round((time.perf_counter() - started) * 1000, 3)}
+
+
+    def stats(self):
+        with self._lock:
+            columns = sum(1 for document in self._documents.values() if document["column"] is not None)
+            return {
+                "tables": len(self._tables),
+                "columns": columns,
+                "terms": len(self._postings),
+                "trigrams": len(self._trigrams),
+            }
+
+
+
+
+search_index = ColumnSearchIndex()
+
+
+# Function to build the search index from the schema catalog of every connection
+def index_catalog(db):
+    tables = defaultdict(dict)
+    for row in db.query(SchemaCatalog).all():
+        tables[(row.connection_id, row.schema_name)][row.table_name] = row.table_metadata
+    for (connection_id, schema), metadata in tables.items():
+        search_index.update_tables(connection_id, metadata, schema=schema, replace_schema=True)
+
+
+
+# Remove tables of a connection from the index when the connection row is deleted
+@event.listens_for(Connections, "after_delete")
+def remove_connection_from_index(mapper, db_connection, target):
+    search_index.remove_connection(target.connection_id)
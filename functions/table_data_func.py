@@ -0,0 +1,370 @@
+# Functions for reading data of source tables
+
+import json
+import math
+import base64
+import random
+import decimal
+import datetime
+import operator
+
+from sqlalchemy import table as sql_table, column as sql_column, select, tuple_, func, text, and_, or_, union_all, literal, types
+
+from functions.metadata_manage_func import get_primary_and_unique_columns
+
+
+# Function to create a lightweight table construct with typed columns
+def source_table(table_name, columns):
+    schema = None
+    if "." in table_name:
+        schema, table_name = table_name.split(".", 1)
+    return sql_table(table_name, *[sql_column(column["name"], column["type"]) for column in columns], schema=schema)
+
+
+
+# Function to encode a pagination cursor, opaque to the client
+def encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data, default=str).encode()).decode()
+
+
+# Function to decode a pagination cursor
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(data, dict):
+        raise ValueError("Invalid cursor")
+    return data
+
+
+
+# Function to find columns usable for keyset pagination.
+# Primary key is preferred, otherwise a unique constraint with only not null columns.
+def get_seek_columns(inspector, table_name, columns):
+    identifiers = get_primary_and_unique_columns(inspector, table_name)
+    if identifiers["primary_keys_columns"]:
+        return identifiers["primary_keys_columns"].split(", ")
+
+    nullable = {column["name"]: column.get("nullable", True) for column in columns}
+    for unique_columns in identifiers["unique_columns"]:
+        unique_columns = unique_columns.split(", ")
+        if all(name in nullable and not nullable[name] for name in unique_columns):
+            return unique_columns
+    return None
+
+
+
+# Function to put the order_by columns in front of the key of the table for keyset pagination.
+# Returns the seek columns and their directions, or None when the table has no key.
+# Raises ValueError when an order_by column is nullable, as rows with NULLs can not be sought past.
+def get_ordered_seek_columns(seek_columns, order_by, columns):
+    if not seek_columns:
+        return None, None
+    if not order_by:
+        return seek_columns, [False] * len(seek_columns)
+    nullable = {column["name"]: column.get("nullable", True) for column in columns}
+    nullable_order = [name for name, _ in order_by if nullable.get(name, True)]
+    if nullable_order:
+        raise ValueError(f"Cursor pagination can not order by the nullable columns {nullable_order}")
+    names = [name for name, _ in order_by]
+    descending = [desc for _, desc in order_by]
+    for name in seek_columns:
+        if name not in names:
+            names.append(name)
+            descending.append(False)
+    return names, descending
+
+
+
+# Function to convert a value from JSON to the python type of a column, eg: ISO date strings to dates
+def coerce_value(column_type, value):
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return value
+    if value is None or isinstance(value, python_type):
+        return value
+    try:
+        if python_type in (datetime.datetime, datetime.date, datetime.time):
+            return python_type.fromisoformat(value)
+        if python_type is bool and isinstance(value, str):
+            return value.lower() in ("1", "true", "yes")
+        if python_type is int and isinstance(value, (float, decimal.Decimal)) and value != int(value):
+            # int() would truncate the value and compare against a different number
+            raise ValueError(value)
+        if python_type in (int, float, decimal.Decimal, str):
+            return python_type(value)
+    except (TypeError, ValueError, OverflowError, decimal.InvalidOperation):
+        raise ValueError(f"Invalid value {value!r} for a column of type {column_type}")
+    return value
+
+
+
+# Comparison operators of filters, besides between, in, is_null and not_null
+COMPARISON_OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "le": operator.le,
+    "gt": operator.gt,
+    "ge": operator.ge,
+}
+
+
+# Function to compile filters into where clauses on the source table.
+# Each filter is a dict with column, op and value, values are bound as typed parameters.
+def build_filter_clauses(source, filters):
+    clauses = []
+    for column_filter in filters or []:
+        column = source.c[column_filter["column"]]
+        op = column_filter["op"]
+        value = column_filter.get("value")
+        if op == "is_null":
+            clauses.append(column.is_(None))
+        elif op == "not_null":
+            clauses.append(column.is_not(None))
+        elif op in ("between", "in"):
+            if not isinstance(value, list) or not value or (op == "between" and len(value) != 2):
+                raise ValueError(f"Filter {op} on '{column.name}' needs a list of {'two values' if op == 'between' else 'values'}")
+            values = [coerce_value(column.type, item) for item in value]
+            clauses.append(column.between(*values) if op == "between" else column.in_(values))
+        elif op in COMPARISON_OPERATORS:
+            if value is None:
+                raise ValueError(f"Filter {op} on '{column.name}' needs a value, use is_null for NULL")
+            clauses.append(COMPARISON_OPERATORS[op](column, coerce_value(column.type, value)))
+        else:
+            raise ValueError(f"Unknown filter operator '{op}'")
+    return clauses
+
+
+
+# Function to build the where clause seeking after the last key of the previous page.
+# Keys ordered in one direction compare as a row value, mixed directions are expanded.
+def build_seek_clause(keys, after, descending):
+    after = [coerce_value(key.type, value) for key, value in zip(keys, after)]
+    if len(set(descending)) == 1:
+        left = keys[0] if len(keys) == 1 else tuple_(*keys)
+        right = after[0] if len(keys) == 1 else tuple_(*after)
+        return left < right if descending[0] else left > right
+    clauses = []
+    for index, key in enumerate(keys):
+        equal = [keys[position] == after[position] for position in range(index)]
+        clauses.append(and_(*equal, key < after[index] if descending[index] else key > after[index]))
+    return or_(*clauses)
+
+
+
+# Function to build select of one page, seeking after the last key when seek_columns are given.
+# where are compiled filter clauses, order_by is a list of (column name, descending) used when paging by OFFSET.
+def build_page_query(source, column_names, limit, offset=0, seek_columns=None, after=None, descending=None,
+                     where=None, order_by=None):
+    query = select(*[source.c[name] for name in column_names])
+    if where:
+        query = query.where(*where)
+    if seek_columns:
+        keys = [source.c[name] for name in seek_columns]
+        descending = descending or [False] * len(keys)
+        if after is not None:
+            query = query.where(build_seek_clause(keys, after, descending))
+        query = query.order_by(*[key.desc() if desc else key for key, desc in zip(keys, descending)])
+    else:
+        if order_by:
+            query = query.order_by(*[source.c[name].desc() if desc else source.c[name] for name, desc in order_by])
+        if offset:
+            query = query.offset(offset)
+    return query.limit(limit)
+
+
+
+# Function to build the cursor of the page following the given rows.
+# Both kinds of cursor carry the offset of the next page, keyset cursors only use it to number the page.
+def next_page_cursor(rows, limit, column_names, seek_columns=None, offset=0, descending=None):
+    if len(rows) < limit:
+        return None
+    if seek_columns:
+        last_row = rows[-1]
+        return encode_cursor({"key": seek_columns, "descending": descending or [False] * len(seek_columns),
+                              "after": [last_row[column_names.index(name)] for name in seek_columns],
+                              "offset": offset + len(rows)})
+    return encode_cursor({"offset": offset + len(rows)})
+
+
+
+# Function to turn rows into one list of values per column.
+# Column-major pages do not repeat the row structure, which makes them smaller and faster to decode.
+def column_major(rows, width):
+    if not rows:
+        return [[] for _ in range(width)]
+    return [list(values) for values in zip(*rows)]
+
+
+
+# Function to count rows of a table with COUNT(*), only rows matching the where clauses if given
+def count_rows(connection, source, where=None):
+    query = select(func.count()).select_from(source)
+    if where:
+        query = query.where(*where)
+    return connection.execute(query).scalar()
+
+
+
+# Function to read approximate row count of a table from the catalog of the source.
+# Returns None when the catalog has no estimate, eg: a Postgres table never analyzed.
+def estimate_row_count(connection, table_name):
+    schema = None
+    if "." in table_name:
+        schema, table_name = table_name.split(".", 1)
+
+    if connection.dialect.name == "postgresql":
+        query = text(
+            "SELECT c.reltuples::bigint FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relname = :table_name AND n.nspname = COALESCE(:schema, current_schema())"
+        )
+    elif connection.dialect.name == "mysql":
+        query = text(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_NAME = :table_name AND TABLE_SCHEMA = COALESCE(:schema, DATABASE())"
+        )
+    else:
+        return None
+
+    estimate = connection.execute(query, {"table_name": table_name, "schema": schema}).scalar()
+    if estimate is None or estimate < 0:
+        return None
+    return int(estimate)
+
+
+
+
+# Tables with fewer estimated rows are sampled with BERNOULLI on Postgres, larger ones with the block level SYSTEM method
+SYSTEM_SAMPLE_MIN_ROWS = 100000
+
+# Share of extra rows sampled by TABLESAMPLE, as the sampled number of rows varies around the percentage
+SAMPLE_OVERSAMPLING = {"system": 2.0, "bernoulli": 1.2}
+
+# Maximum number of key ranges read by the key range sampler
+SAMPLE_MAX_KEY_RANGES = 100
+
+# Percentage of a Postgres table sampled first when there is no row estimate, its rows give the estimate
+SAMPLE_UNKNOWN_SIZE_PERCENT = 1.0
+
+
+# Function to find the key of a table usable for key range sampling, a single integer column
+def get_sample_key(seek_columns, columns):
+    if not seek_columns or len(seek_columns) != 1:
+        return None
+    column_types = {column["name"]: column["type"] for column in columns}
+    if isinstance(column_types.get(seek_columns[0]), types.Integer):
+        return seek_columns[0]
+    return None
+
+
+
+# Function to sample a percentage of a table with TABLESAMPLE SYSTEM or BERNOULLI, repeatable with the seed
+def sampled_table(source, method, percent, seed):
+    sampling = func.system(percent) if method == "system" else func.bernoulli(percent)
+    return source.tablesample(sampling, name="sampled", seed=literal(seed))
+
+
+# Function to estimate the rows of a Postgres table without a catalog estimate, by counting the rows of a
+# SYSTEM sample of SAMPLE_UNKNOWN_SIZE_PERCENT of its pages. Tables of too few pages are estimated at 0 rows.
+def tablesample_row_estimate(connection, source, seed):
+    sampled = sampled_table(source, "system", SAMPLE_UNKNOWN_SIZE_PERCENT, seed)
+    sampled_rows = connection.execute(select(func.count()).select_from(sampled)).scalar()
+    return int(sampled_rows * 100 / SAMPLE_UNKNOWN_SIZE_PERCENT)
+
+
+# Function to read a sample of rows on Postgres with TABLESAMPLE SYSTEM or BERNOULLI and REPEATABLE seed.
+# The oversampled rows come back in physical order, so the sample is drawn from all of them with the seed
+# rather than cut with LIMIT, which would favour the first pages of the table.
+# Without an estimate the rows of the table are estimated from a small SYSTEM sample first,
+# tables estimated at 0 rows are small enough to be read whole.
+def tablesample_rows(connection, source, column_names, target, method, seed, total_rows):
+    details = {}
+    if not total_rows:
+        total_rows = details["estimated_rows"] = tablesample_row_estimate(connection, source, seed)
+    percent = 100.0
+    if total_rows:
+        percent = min(100.0, target * SAMPLE_OVERSAMPLING[method] * 100 / total_rows)
+    sampled = sampled_table(source, method, percent, seed)
+    rows = connection.execute(select(*[sampled.c[name] for name in column_names])).fetchall()
+    if len(rows) > target:
+        rows = [rows[index] for index in sorted(random.Random(seed).sample(range(len(rows)), target))]
+    return rows, {"percent": round(percent, 6), **details}
+
+
+
+# Function to sample rows by reading short runs of rows after random points of an integer key.
+# The key range comes from MIN and MAX of the key, and all runs are read with one UNION ALL
+# query that only touches the key index. Rows after gaps in the key are somewhat more likely.
+def key_range_rows(connection, source, column_names, target, seed, key):
+    key_column = source.c[key]
+    low, high = connection.execute(select(func.min(key_column), func.max(key_column))).one()
+    if low is None:
+        return [], {"key": key, "ranges": 0}
+
+    generator = random.Random(seed)
+    ranges = min(target, SAMPLE_MAX_KEY_RANGES, high - low + 1)
+    rows_per_range = math.ceil(target / ranges)
+    query_names = column_names if key in column_names else column_names + [key]
+    starts = sorted(generator.randint(low, high) for _ in range(ranges))
+    query = union_all(*[
+        select(select(*[source.c[name] for name in query_names]).where(key_column >= start).order_by(key_column)
+               .limit(rows_per_range).subquery())
+        for start in starts
+    ])
+
+    # Runs after close points overlap, each row is kept once
+    key_index = query_names.index(key)
+    rows = {}
+    for row in connection.execute(query):
+        rows.setdefault(row[key_index], row)
+    keys = sorted(rows)
+    if len(keys) > target:
+        keys = sorted(generator.sample(keys, target))
+    return [tuple(rows[value])[:len(column_names)] for value in keys], {"key": key, "ranges": ranges}
+
+
+
+# Function to sample rows by ordering the whole table randomly, seeded on MySQL only
+def random_order_rows(connection, source, column_names, target, seed):
+    order = func.rand(seed) if connection.dialect.name == "mysql" else func.random()
+    query = select(*[source.c[name] for name in column_names]).order_by(order).limit(target)
+    return connection.execute(query).fetchall(), {"seeded": connection.dialect.name == "mysql"}
+
+
+
+# Function to read a random sample of about target rows of a table.
+# method is auto, system, bernoulli, key_range or random. auto reads tables not larger than the target whole,
+# uses TABLESAMPLE on Postgres, and the key range sampler elsewhere when the table has a single integer key.
+# Returns the rows and details of the sampling, including the seed to repeat it.
+def sample_rows(connection, source, column_names, target, method="auto", seed=None, key=None, total_rows=None):
+    postgres = connection.dialect.name == "postgresql"
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    if method == "auto":
+        if total_rows is not None and total_rows <= target:
+            # Small tables are read whole
+            query = select(*[source.c[name] for name in column_names]).limit(target)
+            rows = connection.execute(query).fetchall()
+            return rows, {"method": "all", "seed": seed, "target_rows": target, "sampled_rows": len(rows)}
+        if postgres:
+            # Tables without an estimate are sampled by pages, their size is estimated by tablesample_rows
+            method = "system" if not total_rows or total_rows >= SYSTEM_SAMPLE_MIN_ROWS else "bernoulli"
+        else:
+            method = "key_range" if key else "random"
+
+    if method in ("system", "bernoulli"):
+        if not postgres:
+            raise ValueError(f"{method} sampling uses TABLESAMPLE and is only available on Postgres")
+        rows, details = tablesample_rows(connection, source, column_names, target, method, seed, total_rows)
+    elif method == "key_range":
+        if not key:
+            raise ValueError("key_range sampling needs a single integer primary or unique key")
+        rows, details = key_range_rows(connection, source, column_names, target, seed, key)
+    elif method == "random":
+        rows, details = random_order_rows(connection, source, column_names, target, seed)
+    else:
+        raise ValueError(f"Unknown sampling method '{method}'")
+    return rows, {"method": method, "seed": seed, "target_rows": target, "sampled_rows": len(rows), **details}
@@ -17,6 +17,14 @@ tags_metadata = [
         "name": "connection",
         "description": "Connection APIs.",
     },
+    {
+        "name": "catalog",
+        "description": "Schema catalog APIs. Stored metadata of source connections and the changes between refreshes.",
+    },
+    {
+        "name": "search",
+        "description": "Search APIs. Find tables and columns by name across all source connections.",
+    },
     {
         "name": "jobs",
         "description": "Jobs APIs.",
@@ -1,8 +1,13 @@
 from fastapi import FastAPI
 from fastapi.routing import APIRoute
-from data.database import engine
+from data.database import engine, SessionLocal
 from data.model import Base
-from apis import alpha, jobsAPI, pipelineAPI, transformationAPI, ingestionAPI, dummyAPI
+from apis import alpha, jobsAPI, pipelineAPI, transformationAPI, ingestionAPI, dummyAPI, catalogAPI, searchAPI
+from functions.catalog_func import catalog_refresher
+from functions.search_index_func import index_catalog
+from functions.admission_func import load_connection_limits
+from functions.dbt_runner_func import dbt_workers
+from functions.join_job_func import join_jobs, join_heartbeat
 from info.app_metadata import description, tags_metadata, contact
 from typing import List
 
@@ -23,6 +28,38 @@ app = FastAPI(
 Base.metadata.create_all(bind=engine, checkfirst=True)
 
 
+# Build the column search index from the schema catalog and load limits of source connections
+@app.on_event("startup")
+def build_search_index():
+    db = SessionLocal()
+    try:
+        index_catalog(db)
+        load_connection_limits(db)
+    finally:
+        db.close()
+
+# Heartbeat of this instance, which also fails joins of instances that stopped
+@app.on_event("startup")
+def start_join_heartbeat():
+    join_heartbeat.start()
+
+# Background refresh of the schema catalog of source connections
+@app.on_event("startup")
+def start_catalog_refresher():
+    catalog_refresher.start()
+
+@app.on_event("shutdown")
+def stop_catalog_refresher():
+    catalog_refresher.stop()
+
+# Wait for running joins, then stop the dbt worker processes and the heartbeat
+@app.on_event("shutdown")
+def stop_dbt_workers():
+    join_jobs.shutdown()
+    dbt_workers.shutdown()
+    join_heartbeat.stop()
+
+
 @app.get("/")
 def show_root():
     return {"Hello": "Please go to '<url>/docs' to view API end points in swagger form"}
@@ -44,4 +81,6 @@ app.include_router(jobsAPI.router)
 app.include_router(pipelineAPI.router)
 app.include_router(transformationAPI.router)
 app.include_router(ingestionAPI.router)
-app.include_router(dummyAPI.router)
\ No newline at end of file
+app.include_router(dummyAPI.router)
+app.include_router(catalogAPI.router)
+app.include_router(searchAPI.router)
\ No newline at end of file